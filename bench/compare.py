@@ -0,0 +1,51 @@
+from argparse import ArgumentParser
+import json
+import sys
+
+### Benchmark comparison ###
+
+# Compares two result files written by bench/load.py (for example from main
+# and from a branch) and exits with a non-zero status if any endpoint got
+# slower or lost throughput by more than the allowed threshold
+
+def parse_args():
+    parser = ArgumentParser(description="Compare two benchmark results")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--metric", default="p95_ms", choices=["p50_ms", "p95_ms", "p99_ms"])
+    parser.add_argument("--threshold", type=float, default=10, help="allowed regression in percent")
+    return parser.parse_args()
+
+def change(before: float, after: float) -> float:
+    if before == 0:
+        return 0.0
+    return (after - before) / before * 100
+
+def main():
+    args = parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    regressions = list()
+    print(f"{'endpoint':<48} {args.metric:>19} {'req/s':>19}")
+    endpoints = sorted(set(baseline["endpoints"]) & set(candidate["endpoints"]))
+    rows = [(e, baseline["endpoints"][e], candidate["endpoints"][e]) for e in endpoints]
+    rows.append(("total", baseline["total"], candidate["total"]))
+    for endpoint, before, after in rows:
+        latency = change(before[args.metric], after[args.metric])
+        throughput = change(before["throughput"], after["throughput"])
+        print(
+            f"{endpoint:<48} {after[args.metric]:>9.1f} ({latency:+6.1f}%) "
+            f"{after['throughput']:>9.1f} ({throughput:+6.1f}%)"
+        )
+        if latency > args.threshold or -throughput > args.threshold:
+            regressions.append(endpoint)
+
+    if regressions:
+        print(f"\nRegressed by more than {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
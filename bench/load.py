@@ -0,0 +1,351 @@
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from http.client import HTTPConnection
+from http.cookies import SimpleCookie
+from threading import Event, Lock, Thread
+from urllib.parse import urlencode, urlsplit
+import json
+import random
+import re
+import subprocess
+import time
+
+### Benchmark load driver ###
+
+# Replays a mix of requests against a running server seeded with
+# bench/seed.py, from a number of concurrent virtual players. Most players
+# just browse and play levels; some are logged in and also review levels and
+# use the editor. Latency is recorded per endpoint, and the results are
+# printed as a table and written as JSON so that runs on different branches
+# can be compared with bench/compare.py
+
+LEVEL_SORTS = ["newest", "trending", "plays", "clears", "rating", "hardest"]
+CSRF_TOKEN = re.compile(r'<meta name="csrf_token" content="([^"]*)">')
+PLAY_URL = re.compile(r"/level/(\d+)")
+
+# Actions and how often they're picked, for anonymous and logged in players
+ANONYMOUS_MIX = {
+    "home": 5,
+    "list_levels": 15,
+    "level_page": 15,
+    "level_data": 20,
+    "level_data_revalidate": 10,
+    "reviews": 10,
+    "mark_played": 20,
+    "mark_cleared": 5,
+}
+LOGGED_IN_MIX = {
+    **ANONYMOUS_MIX,
+    "my_levels": 3,
+    "user_page": 2,
+    "editor_page": 2,
+    "review": 3,
+    "editor_patch": 6,
+    "editor_data": 2,
+}
+
+def parse_args():
+    parser = ArgumentParser(description="Run a load test against a running server")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--players", type=int, default=32, help="number of concurrent virtual players")
+    parser.add_argument("--logged-in", type=float, default=0.25, help="share of players that log in")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds to run before recording")
+    parser.add_argument("--known-levels", type=int, default=1000, help="how many level ids to fetch up front")
+    parser.add_argument("--users", type=int, default=1000, help="number of users seeded by bench/seed.py")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="where to write the JSON results")
+    return parser.parse_args()
+
+class Client:
+    # A keep-alive connection with a cookie jar, like a browser tab
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.conn = HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        self.cookies = dict()
+        self.csrf_token = ""
+
+    def request(self, method: str, path: str, body = None, headers: dict = {}) -> tuple[int, bytes, dict]:
+        headers = dict(headers)
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        if body != None:
+            body = json.dumps({ **body, "csrf_token": self.csrf_token })
+            headers["Content-Type"] = "application/json"
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, ConnectionError):
+            self.conn.close()
+            raise
+        for header in response.headers.get_all("Set-Cookie") or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        return response.status, data, response.headers
+
+    def login(self, username: str, password: str):
+        self.request("POST", "/api/auth/login", { "username": username, "password": password })
+        _, page, _ = self.request("GET", "/")
+        match = CSRF_TOKEN.search(page.decode())
+        self.csrf_token = match.group(1) if match else ""
+
+class Results:
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = dict()
+        self.errors = dict()
+        self.rejected = dict()
+        self.recording = False
+
+    def record(self, endpoint: str, latency: float, ok: bool, rejected: bool = False):
+        # Rejected requests got an expected refusal (like a clear that didn't
+        # reach the goal), so they're neither errors nor successes
+        if not self.recording:
+            return
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            if rejected:
+                self.rejected[endpoint] = self.rejected.get(endpoint, 0) + 1
+            elif not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, duration: float) -> dict:
+        endpoints = dict()
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors.get(endpoint, 0),
+                "rejected": self.rejected.get(endpoint, 0),
+                "throughput": len(latencies) / duration,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "max_ms": latencies[-1] * 1000,
+            }
+        all_latencies = sorted(l for latencies in self.latencies.values() for l in latencies)
+        return {
+            "endpoints": endpoints,
+            "total": {
+                "requests": len(all_latencies),
+                "errors": sum(self.errors.values()),
+                "rejected": sum(self.rejected.values()),
+                "throughput": len(all_latencies) / duration,
+                "p50_ms": percentile(all_latencies, 50) * 1000,
+                "p95_ms": percentile(all_latencies, 95) * 1000,
+                "p99_ms": percentile(all_latencies, 99) * 1000,
+            },
+        }
+
+def percentile(values: list, p: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+class Player:
+    def __init__(self, args, index: int, level_ids: list, results: Results, stopping: Event):
+        self.args = args
+        self.rng = random.Random(args.seed * 100003 + index)
+        self.client = Client(args.url)
+        self.level_ids = level_ids
+        self.results = results
+        self.stopping = stopping
+        self.etags = dict()
+        self.logged_in = self.rng.random() < args.logged_in
+        self.username = f"bench-{index % args.users + 1}"
+        self.wip_id = None
+        self.wip_revision = 0
+
+    def run(self):
+        try:
+            if self.logged_in:
+                self.client.login(self.username, "benchmark")
+                self.create_wip_level()
+        except OSError:
+            self.logged_in = False
+        mix = LOGGED_IN_MIX if self.logged_in else ANONYMOUS_MIX
+        actions, weights = list(mix.keys()), list(mix.values())
+        while not self.stopping.is_set():
+            action = self.rng.choices(actions, weights)[0]
+            getattr(self, action)()
+
+    def timed(self, endpoint: str, method: str, path: str, body = None, headers: dict = {}, ok = (200,), rejected = ()) -> tuple[int, bytes, dict]:
+        start = time.perf_counter()
+        try:
+            status, data, response_headers = self.client.request(method, path, body, headers)
+        except OSError:
+            self.results.record(endpoint, time.perf_counter() - start, False)
+            return 0, b"", {}
+        self.results.record(endpoint, time.perf_counter() - start, status in ok, status in rejected)
+        return status, data, response_headers
+
+    def level_id(self) -> int:
+        # Popular levels are requested more often, like in the seeded events
+        return self.level_ids[int(len(self.level_ids) * self.rng.random() ** 3)]
+
+    def home(self):
+        self.timed("GET /", "GET", "/")
+
+    def list_levels(self):
+        query = { "sort": self.rng.choice(LEVEL_SORTS) }
+        status, data, _ = self.timed("GET /api/levels", "GET", f"/api/levels?{urlencode(query)}")
+        # Some players scroll down to the next page
+        if status == 200 and self.rng.random() < 0.3:
+            cursor = json.loads(data).get("next_cursor")
+            if cursor:
+                query["cursor"] = cursor
+                self.timed("GET /api/levels (next page)", "GET", f"/api/levels?{urlencode(query)}")
+
+    def my_levels(self):
+        self.timed("GET /api/levels/my", "GET", "/api/levels/my")
+
+    def user_page(self):
+        self.timed("GET /user", "GET", "/user")
+
+    def level_page(self):
+        self.timed("GET /level/<id>", "GET", f"/level/{self.level_id()}")
+
+    def level_data(self):
+        id = self.level_id()
+        accept = "application/x-platformer-level" if self.rng.random() < 0.5 else "application/json"
+        _, _, headers = self.timed("GET /api/levels/<id>/data", "GET", f"/api/levels/{id}/data", headers={ "Accept": accept })
+        if headers and headers.get("ETag"):
+            self.etags[(id, accept)] = headers.get("ETag")
+
+    def level_data_revalidate(self):
+        if len(self.etags) == 0:
+            return self.level_data()
+        (id, accept), etag = self.rng.choice(list(self.etags.items()))
+        self.timed(
+            "GET /api/levels/<id>/data (revalidate)", "GET", f"/api/levels/{id}/data",
+            headers={ "Accept": accept, "If-None-Match": etag }, ok=(200, 304),
+        )
+
+    def reviews(self):
+        self.timed("GET /api/levels/<id>/reviews", "GET", f"/api/levels/{self.level_id()}/reviews")
+
+    def mark_played(self):
+        self.timed("POST /api/levels/<id>/mark-as-played", "POST", f"/api/levels/{self.level_id()}/mark-as-played", {}, ok=(200, 202))
+
+    def mark_cleared(self):
+        # Seeded levels are random, so holding right for ten seconds rarely
+        # reaches the goal. The replay is still run in full, which is the
+        # expensive part, and the refusal is counted as rejected
+        self.timed(
+            "POST /api/levels/<id>/mark-as-cleared", "POST", f"/api/levels/{self.level_id()}/mark-as-cleared",
+            { "trace": [[2, 600]] }, ok=(200, 202), rejected=(400,)
+        )
+
+    def review(self):
+        # Users can only review a level once, so any earlier review is
+        # deleted first
+        id = self.level_id()
+        self.timed("DELETE /api/levels/<id>/reviews", "DELETE", f"/api/levels/{id}/reviews", {})
+        self.timed("POST /api/levels/<id>/reviews", "POST", f"/api/levels/{id}/reviews", {
+            "rating": self.rng.randint(0, 5),
+            "body": "Benchmark review",
+        })
+
+    def create_wip_level(self):
+        status, data, _ = self.client.request("POST", "/api/levels/wip", {})
+        if status == 200:
+            self.wip_id = int(json.loads(data)["url"].rstrip("/").split("/")[-1])
+
+    def editor_page(self):
+        if self.wip_id == None:
+            return
+        self.timed("GET /edit/<id>", "GET", f"/edit/{self.wip_id}")
+
+    def editor_patch(self):
+        if self.wip_id == None:
+            return
+        status, data, _ = self.timed("POST /api/levels/wip/<id>/patch", "POST", f"/api/levels/wip/{self.wip_id}/patch", {
+            "revision": self.wip_revision,
+            "ops": [{ "op": "add", "x": self.rng.randrange(22) * 32, "y": self.rng.randrange(22) * 32, "type": "block" }],
+        })
+        if status == 200:
+            self.wip_revision = json.loads(data)["revision"]
+
+    def editor_data(self):
+        if self.wip_id == None:
+            return
+        status, data, _ = self.timed("GET /api/levels/wip/<id>/data", "GET", f"/api/levels/wip/{self.wip_id}/data")
+        if status == 200:
+            self.wip_revision = json.loads(data)["revision"]
+
+def fetch_level_ids(args) -> list[int]:
+    # Most played first, so that the start of the list is the popular levels
+    client = Client(args.url)
+    ids, cursor = list(), None
+    while len(ids) < args.known_levels:
+        query = { "sort": "plays", "limit": 100 }
+        if cursor:
+            query["cursor"] = cursor
+        status, data, _ = client.request("GET", f"/api/levels?{urlencode(query)}")
+        if status != 200:
+            raise RuntimeError(f"Fetching levels failed with status {status}")
+        page = json.loads(data)
+        ids += [int(PLAY_URL.search(level["play_url"]).group(1)) for level in page["levels"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    if len(ids) == 0:
+        raise RuntimeError("The server has no levels, seed it with bench/seed.py first")
+    return ids[:args.known_levels]
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_summary(summary: dict):
+    print(f"{'endpoint':<48} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'rejected':>9}")
+    rows = list(summary["endpoints"].items()) + [("total", summary["total"])]
+    for endpoint, stats in rows:
+        print(
+            f"{endpoint:<48} {stats['throughput']:>9.1f} {stats['p50_ms']:>9.1f} "
+            f"{stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} {stats['errors']:>7} {stats['rejected']:>9}"
+        )
+
+def main():
+    args = parse_args()
+    level_ids = fetch_level_ids(args)
+    results = Results()
+    stopping = Event()
+
+    threads = [
+        Thread(target=Player(args, i, level_ids, results, stopping).run, daemon=True)
+        for i in range(args.players)
+    ]
+    for thread in threads:
+        thread.start()
+
+    print(f"Warming up for {args.warmup}s with {args.players} players...")
+    time.sleep(args.warmup)
+    results.recording = True
+    print(f"Recording for {args.duration}s...")
+    started_at = datetime.now(timezone.utc)
+    time.sleep(args.duration)
+    results.recording = False
+    stopping.set()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    summary = results.summary(args.duration)
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "started_at": started_at.isoformat(),
+                "git_revision": git_revision(),
+                "args": vars(args),
+                **summary,
+            }, f, indent=4)
+        print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
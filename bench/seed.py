@@ -0,0 +1,193 @@
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from os import getenv, path
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from werkzeug.security import generate_password_hash
+import json
+import random
+import sys
+import time
+
+# Make the app's modules importable
+sys.path.insert(0, path.join(path.dirname(__file__), "..", "src"))
+
+from models import level_data_hash, validate_level_data, LEVEL_SIZE, OBJECT_UNIT
+from levelformat import pack_level_data
+
+### Benchmark database seeding ###
+
+# Fills a fresh database with users, levels and play/clear/review events so
+# that the load driver (bench/load.py) has something realistic to work
+# against. Events are generated by Postgres itself with generate_series, so
+# millions of rows take seconds rather than minutes. Level popularity is
+# skewed so that a few levels get most of the plays, like on the real site
+#
+# Every seeded user is called "bench-<n>" and has the password "benchmark"
+
+BENCH_PASSWORD = "benchmark"
+OBJECT_TYPES = ["block", "block", "block", "spike", "ground-spike"]
+
+def parse_args():
+    parser = ArgumentParser(description="Seed a database for benchmarking")
+    parser.add_argument("--database-url", default=None, help="defaults to DATABASE_URL")
+    parser.add_argument("--reset", action="store_true", help="run sql/reset.sql first (deletes everything!)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--levels", type=int, default=5000)
+    parser.add_argument("--min-objects", type=int, default=50)
+    parser.add_argument("--max-objects", type=int, default=500)
+    parser.add_argument("--plays", type=int, default=2_000_000)
+    parser.add_argument("--clears", type=int, default=500_000)
+    parser.add_argument("--reviews", type=int, default=200_000)
+    parser.add_argument("--skew", type=float, default=3.0, help="higher makes popular levels more popular")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    return parser.parse_args()
+
+def random_level_data(rng: random.Random, object_count: int) -> dict:
+    cells = LEVEL_SIZE // OBJECT_UNIT
+    objects = [{
+        "x": rng.randrange(cells) * OBJECT_UNIT,
+        "y": rng.randrange(cells) * OBJECT_UNIT,
+        "type": rng.choice(OBJECT_TYPES),
+    } for _ in range(object_count)]
+    return validate_level_data({
+        "playerX": OBJECT_UNIT,
+        "playerY": OBJECT_UNIT,
+        "endX": LEVEL_SIZE - 2 * OBJECT_UNIT,
+        "endY": OBJECT_UNIT,
+        "objects": objects,
+    })
+
+@contextmanager
+def timed(label: str):
+    start = time.perf_counter()
+    print(f"{label}...", end=" ", flush=True)
+    yield
+    print(f"{time.perf_counter() - start:.1f}s")
+
+def seed_users(conn, args) -> tuple[int, int]:
+    # Hashing is slow on purpose, so every user shares the same hash
+    pw_hash = generate_password_hash(BENCH_PASSWORD)
+    ids = conn.execute(text("""
+        INSERT INTO Users (username, password, icon)
+        SELECT 'bench-' || n, :password, 'gradient'
+        FROM generate_series(1, :count) AS n
+        RETURNING id
+    """), {
+        "password": pw_hash,
+        "count": args.users,
+    }).scalars().all()
+    return min(ids), max(ids)
+
+def seed_levels(conn, args, rng: random.Random, first_user: int, user_count: int) -> tuple[int, int]:
+    ids = list()
+    for start in range(0, args.levels, args.batch_size):
+        count = min(args.batch_size, args.levels - start)
+        names, publishers, data, hashes, packed, published_at = [], [], [], [], [], []
+        for i in range(start, start + count):
+            level = random_level_data(rng, rng.randint(args.min_objects, args.max_objects))
+            serialized = json.dumps(level)
+            names.append(f"bench level {i}")
+            publishers.append(first_user + rng.randrange(user_count))
+            data.append(serialized)
+            hashes.append(level_data_hash(serialized))
+            packed.append(pack_level_data(level))
+            published_at.append(rng.randrange(365 * 24 * 3600))
+        ids += conn.execute(text("""
+            INSERT INTO Levels (name, publisher, data, data_hash, data_packed, published_at)
+            SELECT Level.name, Level.publisher, CAST(Level.data AS JSONB), Level.hash, Level.packed,
+                current_timestamp - make_interval(secs => Level.age)
+            FROM unnest(
+                CAST(:names AS TEXT[]), CAST(:publishers AS INT[]), CAST(:data AS TEXT[]),
+                CAST(:hashes AS TEXT[]), CAST(:packed AS BYTEA[]), CAST(:ages AS INT[])
+            ) AS Level(name, publisher, data, hash, packed, age)
+            RETURNING id
+        """), {
+            "names": names,
+            "publishers": publishers,
+            "data": data,
+            "hashes": hashes,
+            "packed": packed,
+            "ages": published_at,
+        }).scalars().all()
+    return min(ids), max(ids)
+
+def seed_events(conn, table: str, count: int, args, first_level: int, first_user: int):
+    # A quarter of the events are by players who aren't logged in. Events are 
+    # spread over the last 30 days so that trending scores have some history
+    conn.execute(text(f"""
+        INSERT INTO {table} (level_id, user_id, created_at)
+        SELECT :first_level + floor(:levels * power(random(), :skew))::INT,
+            CASE WHEN random() < 0.25 THEN NULL ELSE :first_user + floor(:users * random())::INT END,
+            current_timestamp - make_interval(secs => floor(random() * 30 * 24 * 3600)::INT)
+        FROM generate_series(1, :count)
+    """), {
+        "first_level": first_level,
+        "levels": args.levels,
+        "first_user": first_user,
+        "users": args.users,
+        "skew": args.skew,
+        "count": count,
+    })
+
+def seed_reviews(conn, args, first_level: int, first_user: int):
+    # Each (level, user) pair can only be reviewed once, so reviews walk
+    # through the pairs instead of picking them at random
+    count = min(args.reviews, args.levels * args.users)
+    conn.execute(text("""
+        INSERT INTO Reviews (level_id, user_id, rating, body, posted_at)
+        SELECT :first_level + n % :levels, :first_user + n / :levels,
+            floor(random() * 6)::INT, 'Benchmark review #' || n,
+            current_timestamp - make_interval(secs => floor(random() * 365 * 24 * 3600)::INT)
+        FROM generate_series(0, :count - 1) AS n
+    """), {
+        "first_level": first_level,
+        "levels": args.levels,
+        "first_user": first_user,
+        "count": count,
+    })
+
+def main():
+    load_dotenv()
+    args = parse_args()
+    rng = random.Random(args.seed)
+    engine = create_engine(args.database_url or getenv("DATABASE_URL"))
+
+    with engine.begin() as conn:
+        conn.execute(text("SELECT setseed(:seed)"), { "seed": (args.seed % 1000) / 1000 })
+
+        if args.reset:
+            with timed("Resetting database"):
+                with open(path.join(path.dirname(__file__), "..", "sql", "reset.sql")) as f:
+                    conn.exec_driver_sql(f.read())
+
+        with timed(f"Creating {args.users} users"):
+            first_user, _ = seed_users(conn, args)
+        with timed(f"Creating {args.levels} levels"):
+            first_level, _ = seed_levels(conn, args, rng, first_user, args.users)
+        with timed(f"Creating {args.plays} plays"):
+            seed_events(conn, "LevelPlays", args.plays, args, first_level, first_user)
+        with timed(f"Creating {args.clears} clears"):
+            seed_events(conn, "LevelClears", args.clears, args, first_level, first_user)
+        with timed(f"Creating {min(args.reviews, args.levels * args.users)} reviews"):
+            seed_reviews(conn, args, first_level, first_user)
+
+    # Stats are rebuilt the same way the app's rebuild-level-stats command
+    # does it, then the tables are analyzed so the planner has fresh numbers
+    from flask import Flask
+    from models import db
+    from stats import rebuild_level_stats
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = engine.url.render_as_string(hide_password=False)
+    db.init_app(app)
+    with app.app_context():
+        with timed("Rebuilding level stats"):
+            rebuild_level_stats()
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        with timed("Analyzing"):
+            conn.execute(text("ANALYZE"))
+
+if __name__ == "__main__":
+    main()
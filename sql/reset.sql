@@ -1,5 +1,7 @@
 
-DROP TABLE IF EXISTS Users, UnpublishedLevels, Levels, LevelPlays, LevelClears, Reviews;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+DROP TABLE IF EXISTS Users, UnpublishedLevels, Levels, LevelPlays, LevelClears, Reviews, LevelStats, LevelTrending, UnpublishedLevelEdits;
 
 CREATE TABLE Users (
     id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
@@ -14,8 +16,10 @@ CREATE TABLE Levels (
     id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
     name TEXT NOT NULL CHECK (LENGTH(name) <= 30),
     publisher INT REFERENCES Users NOT NULL,
-    published_at TIMESTAMP DEFAULT current_timestamp,
-    data JSON NOT NULL,
+    published_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
+    data JSONB NOT NULL,
+    data_hash TEXT NOT NULL,
+    data_packed BYTEA NULL,
     CONSTRAINT creator_may_only_have_one_published_level_of_same_name UNIQUE (name, publisher)
 );
 
@@ -23,19 +27,34 @@ CREATE TABLE UnpublishedLevels (
     id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
     creator INT REFERENCES Users,
     name TEXT NOT NULL CHECK (LENGTH(name) <= 30),
-    data JSON NOT NULL,
+    data JSONB NOT NULL,
     published_id INT REFERENCES Levels ON DELETE SET NULL,
+    -- Revision of the level, and the revision `data` is a snapshot of. Edits 
+    -- made after the snapshot are in UnpublishedLevelEdits
+    revision INT NOT NULL DEFAULT 0,
+    data_revision INT NOT NULL DEFAULT 0,
+    -- Upper bound on the number of objects in the level, exact after compaction
+    object_count INT NOT NULL DEFAULT 0,
     CONSTRAINT creator_may_only_have_one_created_level_of_same_name UNIQUE (name, creator)
 );
 
+CREATE TABLE UnpublishedLevelEdits (
+    level_id INT REFERENCES UnpublishedLevels ON DELETE CASCADE NOT NULL,
+    revision INT NOT NULL,
+    ops JSON NOT NULL,
+    PRIMARY KEY (level_id, revision)
+);
+
 CREATE TABLE LevelPlays (
     level_id INT REFERENCES Levels NOT NULL,
-    user_id INT REFERENCES Users NULL
+    user_id INT REFERENCES Users NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT current_timestamp
 );
 
 CREATE TABLE LevelClears (
     level_id INT REFERENCES Levels NOT NULL,
-    user_id INT REFERENCES Users NULL
+    user_id INT REFERENCES Users NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT current_timestamp
 );
 
 CREATE TABLE Reviews (
@@ -43,6 +62,65 @@ CREATE TABLE Reviews (
     user_id INT REFERENCES Users NOT NULL,
     rating INT NOT NULL CHECK(0 <= rating AND rating <= 5),
     body TEXT NOT NULL CHECK (LENGTH(body) <= 200),
-    posted_at TIMESTAMP DEFAULT current_timestamp,
+    posted_at TIMESTAMP NOT NULL DEFAULT current_timestamp,
     CONSTRAINT only_one_review_per_level_per_user UNIQUE (level_id, user_id)
 );
+
+-- Denormalized counters so that listings don't have to count LevelPlays, 
+-- LevelClears and Reviews for every level. Kept up to date by the API; use 
+-- `flask --app src/app.py rebuild-level-stats` to recompute them
+CREATE TABLE LevelStats (
+    level_id INT PRIMARY KEY REFERENCES Levels ON DELETE CASCADE,
+    plays BIGINT NOT NULL DEFAULT 0,
+    clears BIGINT NOT NULL DEFAULT 0,
+    reviews BIGINT NOT NULL DEFAULT 0,
+    rating_total BIGINT NOT NULL DEFAULT 0,
+    -- Number of reviews giving each rating from 0 to 5
+    rating_0 BIGINT NOT NULL DEFAULT 0,
+    rating_1 BIGINT NOT NULL DEFAULT 0,
+    rating_2 BIGINT NOT NULL DEFAULT 0,
+    rating_3 BIGINT NOT NULL DEFAULT 0,
+    rating_4 BIGINT NOT NULL DEFAULT 0,
+    rating_5 BIGINT NOT NULL DEFAULT 0,
+    rating REAL GENERATED ALWAYS AS (
+        CASE WHEN reviews > 0 THEN rating_total::REAL / reviews ELSE 0 END
+    ) STORED,
+    -- Share of plays that didn't end in a clear, smoothed so that levels 
+    -- with only a few plays don't end up at either extreme
+    difficulty REAL GENERATED ALWAYS AS (
+        1 - (clears + 1)::REAL / (plays + 2)
+    ) STORED,
+    -- Time-decayed play count, stored as a logarithm so that older scores 
+    -- never need to be decayed (see stats.py). Kept up to date by the 
+    -- trending refresher
+    trending DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+
+-- Plays up to this time have been counted into LevelStats.trending
+CREATE TABLE LevelTrending (
+    counted_until TIMESTAMP NOT NULL
+);
+INSERT INTO LevelTrending (counted_until) VALUES ('-infinity');
+
+-- Newest reviews of a level first, for paginating them
+CREATE INDEX reviews_newest ON Reviews (level_id, posted_at DESC, user_id DESC);
+
+-- Indexes backing the sort orders of the level listings
+CREATE INDEX levels_newest ON Levels (published_at DESC, id DESC);
+CREATE INDEX levels_by_publisher_newest ON Levels (publisher, published_at DESC, id DESC);
+CREATE INDEX level_stats_most_played ON LevelStats (plays DESC, level_id DESC);
+CREATE INDEX level_stats_most_cleared ON LevelStats (clears DESC, level_id DESC);
+CREATE INDEX level_stats_best_rated ON LevelStats (rating DESC, level_id DESC);
+CREATE INDEX level_stats_hardest ON LevelStats (difficulty DESC, level_id DESC);
+CREATE INDEX level_stats_trending ON LevelStats (trending DESC, level_id DESC);
+
+-- Events are only ever appended, so block range indexes are enough for 
+-- finding the recent ones and stay tiny
+CREATE INDEX level_plays_created_at ON LevelPlays USING BRIN (created_at);
+CREATE INDEX level_clears_created_at ON LevelClears USING BRIN (created_at);
+
+-- Indexes backing level search: prefix matches on level names use the 
+-- B-tree, substring matches on level names and usernames the trigram indexes
+CREATE INDEX levels_name_prefix ON Levels (lower(name) text_pattern_ops);
+CREATE INDEX levels_name_trigram ON Levels USING GIN (lower(name) gin_trgm_ops);
+CREATE INDEX users_username_trigram ON Users USING GIN (lower(username) gin_trgm_ops);
@@ -1,9 +1,10 @@
 
 from flask import Blueprint, request, session
 from sqlalchemy import text
-from werkzeug.security import check_password_hash, generate_password_hash
 from models import check_logged_in_mut, make_error_response, Login
 from models import db
+from passwords import password_hasher
+from sessions import regenerate_session
 from secrets import token_hex
 
 auth_api = Blueprint('auth_api', __name__, template_folder='../templates')
@@ -18,10 +19,11 @@ def api_auth_create_account():
         RETURNING id
     """), {
         "username": params.username,
-        "password": generate_password_hash(params.password),
+        "password": password_hasher.hash(params.password),
     }).fetchone()[0]
     db.session.commit()
 
+    regenerate_session()
     session['user_id'] = user_id
     session['username'] = params.username
     session['user_icon'] = 'gradient'
@@ -44,9 +46,21 @@ def api_auth_login_user():
         return make_error_response(403, "No such user")
     
     pw_hash, user_id, icon = result
-    if not check_password_hash(pw_hash, params.password):
+    if not password_hasher.verify(pw_hash, params.password):
         return make_error_response(403, "Wrong password")
 
+    if password_hasher.needs_rehash(pw_hash):
+        db.session.execute(text("""
+            UPDATE Users
+            SET password = :password
+            WHERE id = :user_id
+        """), {
+            "user_id": user_id,
+            "password": password_hasher.hash(params.password),
+        })
+        db.session.commit()
+
+    regenerate_session()
     session['user_id'] = user_id
     session['username'] = params.username
     session['user_icon'] = icon
@@ -57,9 +71,7 @@ def api_auth_login_user():
 @auth_api.route("/api/auth/logout", methods=["POST"])
 def api_auth_logout_user():
     if check_logged_in_mut():
-        del session['user_id']
-        del session['username']
-        del session['user_icon']
-        del session["csrf_token"]
+        # Clearing the session deletes it from the server-side store
+        session.clear()
         return {}, 200
     return {}, 400
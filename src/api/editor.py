@@ -1,61 +1,137 @@
 
-from flask import Blueprint, url_for, request, session
+from flask import Blueprint, current_app, url_for, request, session
 from sqlalchemy import text
-from wonderwords import RandomWord
-from models import check_logged_in, check_logged_in_mut, make_error_response, UpdateLevelMetadata
+from models import check_logged_in, check_logged_in_mut, make_error_response, level_data_hash, LevelPatch, UpdateLevelMetadata
+from models import validate_level_data, InvalidLevelData, MAX_LEVEL_OBJECTS
 from models import db
+from cache import response_cache
+from levelformat import try_pack_level_data
+from leveledits import compact_level_edits, load_wip_level_data, validate_level_ops
+from levelnames import level_names
+from ratelimit import rate_limit
+from verification import clear_verifier
+from api.levels import invalidate_level
 import json
 
 editor_api = Blueprint('editor_api', __name__, template_folder='../templates')
 
+def is_level_beaten(data: dict) -> bool:
+    # Levels can only be published once the creator has shown that they can 
+    # be beaten, by sending the inputs of a playtest that reached the goal
+    params = request.get_json(silent=True) or {}
+    return clear_verifier.verify(data, params.get("trace"))
+
 @editor_api.route("/api/levels/wip", methods=["POST"])
+@rate_limit("editor")
 def create_new_level():
     if not check_logged_in_mut():
         return make_error_response(403, 'You need to log in to create levels')
 
-    s = RandomWord()
-
-    name = ' '.join(s.random_words(4, word_max_length=6))
-    while db.session.execute(
-        text("SELECT name FROM UnpublishedLevels WHERE creator = :user_id AND name = :name"),
-        { "user_id": session["user_id"], "name": name }
-    ).fetchone() != None:
-        name = ' '.join(s.random_words(4, word_max_length=6))
-
-    id = db.session.execute(text("""
-        INSERT INTO UnpublishedLevels (creator, name, data)
-        VALUES (:creator, :name, :data)
-        RETURNING id
-    """), {
-        "name": name,
-        "creator": session["user_id"],
-        "data": json.dumps({})
-    }).fetchone()[0]
+    id = level_names.create_level(session["user_id"], json.dumps({}))
+    if id == None:
+        return make_error_response(503, 'Unable to find a free level name, try again')
     db.session.commit()
 
-    return { "url": url_for('edit_level', id=id) }, 200
+    return { "url": url_for('pages.edit_level', id=id) }, 200
 
 @editor_api.route("/api/levels/wip/<int:id>/update-data", methods=["POST"])
+@rate_limit("editor")
 def get_users_wip_level_update_data(id: int):
     if not check_logged_in_mut():
         return make_error_response(403, 'You need to log in to create levels')
 
-    data = request.json
+    try:
+        data = validate_level_data(request.json)
+    except InvalidLevelData as e:
+        return make_error_response(400, str(e))
 
-    db.session.execute(text("""
+    # Saving the whole level makes it the new snapshot, so any pending edits 
+    # are obsolete
+    result = db.session.execute(text("""
         UPDATE UnpublishedLevels
-        SET data = :data
+        SET data = :data, object_count = :object_count, revision = revision + 1, data_revision = revision + 1
         WHERE creator = :user_id AND id = :level_id
+        RETURNING revision
     """), {
         "data": json.dumps(data),
+        "object_count": len(data["objects"]),
         "user_id": session["user_id"],
         "level_id": id,
+    }).fetchone()
+    if result == None:
+        return make_error_response(404, 'Level not found')
+
+    db.session.execute(text("""
+        DELETE FROM UnpublishedLevelEdits
+        WHERE level_id = :level_id
+    """), {
+        "level_id": id,
     })
     db.session.commit()
 
-    return {}, 200
+    return { "revision": result[0] }, 200
+
+@editor_api.route("/api/levels/wip/<int:id>/patch", methods=["POST"])
+@rate_limit("editor")
+def patch_wip_level_data(id: int):
+    if not check_logged_in_mut():
+        return make_error_response(403, 'You need to log in to create levels')
+
+    params = LevelPatch(**request.json)
+    try:
+        ops, added = validate_level_ops(params.ops)
+    except InvalidLevelData as e:
+        return make_error_response(400, str(e))
+
+    # The edits only apply if nobody else has saved the level since the 
+    # client last synced with it, and if they don't make the level too big
+    result = db.session.execute(text("""
+        UPDATE UnpublishedLevels
+        SET revision = revision + 1, object_count = object_count + :added
+        WHERE creator = :user_id AND id = :level_id AND revision = :revision
+            AND object_count + :added <= :max_objects
+        RETURNING revision, data_revision
+    """), {
+        "user_id": session["user_id"],
+        "level_id": id,
+        "revision": params.revision,
+        "added": added,
+        "max_objects": MAX_LEVEL_OBJECTS,
+    }).fetchone()
+    if result == None:
+        db.session.rollback()
+        current = db.session.execute(text("""
+            SELECT revision
+            FROM UnpublishedLevels
+            WHERE creator = :user_id AND id = :level_id
+        """), {
+            "user_id": session["user_id"],
+            "level_id": id,
+        }).fetchone()
+        if current == None:
+            return make_error_response(404, 'Level not found')
+        if current[0] != params.revision:
+            return make_error_response(409, 'The level has been changed since it was loaded')
+        return make_error_response(400, f"Levels can have at most {MAX_LEVEL_OBJECTS} objects")
+
+    revision, data_revision = result
+    db.session.execute(text("""
+        INSERT INTO UnpublishedLevelEdits (level_id, revision, ops)
+        VALUES (:level_id, :revision, :ops)
+    """), {
+        "level_id": id,
+        "revision": revision,
+        "ops": json.dumps(ops),
+    })
+    db.session.commit()
+
+    if revision - data_revision >= current_app.config["LEVEL_EDIT_COMPACT_THRESHOLD"]:
+        compact_level_edits(id, session["user_id"])
+
+    return { "revision": revision }, 200
 
 @editor_api.route("/api/levels/wip/<int:id>/update-metadata", methods=["POST"])
+@rate_limit("editor")
 def get_users_wip_level_update(id: int):
     if not check_logged_in_mut():
         return make_error_response(403, 'You need to log in to create levels')
@@ -82,23 +158,21 @@ def get_users_wip_level_data(id: int):
     if not check_logged_in():
         return make_error_response(403, 'You need to log in to create levels')
 
-    result = db.session.execute(text("""
-        SELECT UnpublishedLevels.data
-        FROM Users
-        LEFT JOIN UnpublishedLevels ON Users.id = UnpublishedLevels.creator
-        WHERE Users.id = :user_id AND UnpublishedLevels.id = :level_id
-        GROUP BY UnpublishedLevels.id, UnpublishedLevels.name
-    """), {
-        "user_id": session["user_id"],
-        "level_id": id,
-    })
-    return result.fetchone()[0]
+    result = load_wip_level_data(id, session["user_id"])
+    if result == None:
+        return make_error_response(404, 'Level not found')
+
+    data, revision, _ = result
+    return { "data": data, "revision": revision }, 200
 
 @editor_api.route("/api/levels/wip/<int:id>/publish", methods=["POST"])
+@rate_limit("editor")
 def publish_level(id: int):
     if not check_logged_in_mut():
         return make_error_response(403, 'You need to log in to create levels')
 
+    compact_level_edits(id, session["user_id"])
+
     name, data = db.session.execute(text("""
         SELECT UnpublishedLevels.name, UnpublishedLevels.data
         FROM Users
@@ -110,14 +184,25 @@ def publish_level(id: int):
         "level_id": id,
     }).fetchone()
 
+    try:
+        data = validate_level_data(data)
+    except InvalidLevelData as e:
+        return make_error_response(400, str(e))
+    if not is_level_beaten(data):
+        return make_error_response(400, 'Playtest the level and reach the goal before publishing it')
+
+    data_packed = try_pack_level_data(data)
+    data = json.dumps(data)
     published_id = db.session.execute(text("""
-        INSERT INTO Levels (name, publisher, data)
-        VALUES (:name, :publisher, :data)
+        INSERT INTO Levels (name, publisher, data, data_hash, data_packed)
+        VALUES (:name, :publisher, :data, :data_hash, :data_packed)
         RETURNING id
     """), {
         "name": name,
         "publisher": session["user_id"],
-        "data": json.dumps(data)
+        "data": data,
+        "data_hash": level_data_hash(data),
+        "data_packed": data_packed,
     }).fetchone()[0]
 
     db.session.execute(text("""
@@ -129,41 +214,63 @@ def publish_level(id: int):
         "level_id": id,
         "published_id": published_id,
     })
+    db.session.execute(text("""
+        INSERT INTO LevelStats (level_id)
+        VALUES (:level_id)
+    """), {
+        "level_id": published_id,
+    })
     db.session.commit()
+    response_cache.invalidate("levels")
 
     return {}, 200
 
 @editor_api.route("/api/levels/wip/<int:id>/update", methods=["POST"])
+@rate_limit("editor")
 def update_level(id: int):
     if not check_logged_in_mut():
         return make_error_response(403, 'You need to log in to create levels')
 
+    compact_level_edits(id, session["user_id"])
+
     published_id, name, data = db.session.execute(text("""
-        SELECT UnpublishedLevels.published_id, UnpublishedLevels.name, json_agg(UnpublishedLevels.data)
-        FROM Users
-        LEFT JOIN UnpublishedLevels ON Users.id = UnpublishedLevels.creator
-        WHERE Users.id = :user_id AND UnpublishedLevels.id = :level_id
-        GROUP BY UnpublishedLevels.published_id, UnpublishedLevels.name
+        SELECT UnpublishedLevels.published_id, UnpublishedLevels.name, UnpublishedLevels.data
+        FROM UnpublishedLevels
+        WHERE UnpublishedLevels.creator = :user_id AND UnpublishedLevels.id = :level_id
     """), {
         "user_id": session["user_id"],
         "level_id": id,
     }).fetchone()
 
+    try:
+        data = validate_level_data(data)
+    except InvalidLevelData as e:
+        return make_error_response(400, str(e))
+    if not is_level_beaten(data):
+        return make_error_response(400, 'Playtest the level and reach the goal before publishing it')
+
+    data_packed = try_pack_level_data(data)
+    data = json.dumps(data)
     db.session.execute(text("""
         UPDATE Levels
-        SET name = :name, data = :data
+        SET name = :name, data = :data, data_hash = :data_hash, data_packed = :data_packed
         WHERE Levels.publisher = :user_id AND Levels.id = :level_id
     """), {
         "user_id": session["user_id"],
         "level_id": published_id,
         "name": name,
-        "data": json.dumps(data[0]),
+        "data": data,
+        "data_hash": level_data_hash(data),
+        "data_packed": data_packed,
     })
     db.session.commit()
+    invalidate_level(published_id)
+    response_cache.invalidate("levels")
 
     return {}, 200
 
 @editor_api.route("/api/levels/wip/<int:id>/delete", methods=["POST"])
+@rate_limit("editor")
 def delete_wip_level(id: int):
     if not check_logged_in_mut():
         return make_error_response(403, 'You need to log in to create levels')
@@ -180,20 +287,25 @@ def delete_wip_level(id: int):
     return {}, 200
 
 @editor_api.route("/api/levels/wip/<int:id>/unpublish", methods=["POST"])
+@rate_limit("editor")
 def unpublish_level(id: int):
     if not check_logged_in_mut():
         return make_error_response(403, 'You need to log in to create levels')
 
-    db.session.execute(text("""
+    unpublished = db.session.execute(text("""
         DELETE FROM Levels
         USING Users, UnpublishedLevels
         WHERE Users.id = :user_id AND
             UnpublishedLevels.id = :level_id AND
             Levels.id = UnpublishedLevels.published_id
+        RETURNING Levels.id
     """), {
         "user_id": session["user_id"],
         "level_id": id,
-    })
+    }).fetchall()
     db.session.commit()
+    for published_id, in unpublished:
+        invalidate_level(published_id)
+    response_cache.invalidate("levels")
 
     return {}, 200
@@ -1,80 +1,314 @@
 
-from flask import Blueprint, url_for, session
+from flask import Blueprint, Response, abort, current_app, request, url_for, session
 from sqlalchemy import text
 from models import check_logged_in, make_error_response
 from models import db
+from stats import bump_level_stats
+from events import event_buffer, EventBufferFull, EVENT_TABLES
+from cache import response_cache
+from database import primary_only
+from ratelimit import rate_limit
+from levelformat import LEVEL_FORMAT_MIMETYPE, try_pack_level_data
+from pagination import decode_cursor, encode_cursor, get_page_size
+from verification import clear_verifier
 import json
 
 levels_api = Blueprint('levels_api', __name__, template_folder='../templates')
 
-@levels_api.route("/api/levels")
-def get_all_levels():
-    result = db.session.execute(text("""
-        SELECT Levels.id, Levels.name, Levels.published_at, Users.id, Users.username,
-            (SELECT COUNT(*) FROM LevelPlays WHERE Levels.id = LevelPlays.level_id),
-            (SELECT COUNT(*) FROM LevelClears WHERE Levels.id = LevelClears.level_id),
-            (SELECT COUNT(*) FROM Reviews WHERE Levels.id = Reviews.level_id)
+# Sort orders available for level listings, mapped to the sort key, the column 
+# that breaks ties and the SQL type of the key. Each one is backed by a 
+# matching index in sql/reset.sql
+LEVEL_SORT_ORDERS = {
+    "newest": ("Levels.published_at", "Levels.id", "TIMESTAMP"),
+    "plays": ("LevelStats.plays", "LevelStats.level_id", "BIGINT"),
+    "clears": ("LevelStats.clears", "LevelStats.level_id", "BIGINT"),
+    "rating": ("LevelStats.rating", "LevelStats.level_id", "REAL"),
+    "trending": ("LevelStats.trending", "LevelStats.level_id", "DOUBLE PRECISION"),
+    "hardest": ("LevelStats.difficulty", "LevelStats.level_id", "REAL"),
+}
+
+def get_levels_page(conditions: list[str], params: dict):
+    sort = request.args.get("sort", "newest")
+    if sort not in LEVEL_SORT_ORDERS:
+        abort(400, f"Unknown sort order '{sort}'")
+    key, tiebreak, key_type = LEVEL_SORT_ORDERS[sort]
+
+    limit = get_page_size()
+    params = dict(params, limit=limit + 1)
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        params["after_key"], params["after_id"] = decode_cursor(cursor, 2)
+        conditions = conditions + [f"({key}, {tiebreak}) < (CAST(:after_key AS {key_type}), CAST(:after_id AS INT))"]
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    result = db.session.execute(text(f"""
+        SELECT Levels.id, Levels.name, Levels.published_at, Users.username,
+            LevelStats.plays, LevelStats.clears, LevelStats.reviews, LevelStats.rating, {key}
         FROM Levels
+        JOIN LevelStats ON LevelStats.level_id = Levels.id
         LEFT JOIN Users ON Users.id = Levels.publisher
-        GROUP BY Levels.id, Levels.name, Levels.published_at, Users.id, Users.username
-    """))
+        {where}
+        ORDER BY {key} DESC, {tiebreak} DESC
+        LIMIT :limit
+    """), params)
+    rows = result.fetchall()
 
-    response = list()
-    for id, name, published_at, user_id, publisher, plays, clears, reviews in result.fetchall():
-        response.append({
-            "name": str(name),
-            "publisher": str(publisher),
-            "published_at": str(published_at),
-            "plays": int(plays),
-            "clears": int(clears),
-            "reviews": int(reviews),
-            "play_url": url_for('play_level', id=id),
-        })
-    return json.dumps(response)
+    levels = [level_summary(*row[:-1]) for row in rows[:limit]]
+
+    # There's another page only if the query returned more rows than asked for
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last[-1], last[0])
+
+    return json.dumps({
+        "levels": levels,
+        "next_cursor": next_cursor,
+    })
+
+def level_summary(id: int, name: str, published_at, publisher: str, plays: int, clears: int, reviews: int, rating: float) -> dict:
+    return {
+        "name": str(name),
+        "publisher": str(publisher),
+        "published_at": str(published_at),
+        "plays": int(plays),
+        "clears": int(clears),
+        "reviews": int(reviews),
+        "rating": float(rating),
+        "play_url": url_for('pages.play_level', id=id),
+    }
+
+@levels_api.route("/api/levels")
+def get_all_levels():
+    key = ":".join(request.args.get(arg, "") for arg in ("sort", "limit", "cursor"))
+    cached = response_cache.get("levels", key)
+    if cached != None:
+        return cached
+
+    page = get_levels_page([], {})
+    response_cache.set("levels", key, page.encode(), current_app.config["LEVEL_LIST_CACHE_TTL"])
+    return page
 
 @levels_api.route("/api/levels/my")
 def get_users_levels():
     if not check_logged_in():
         return make_error_response(403, 'You need to log in to get your levels')
 
-    result = db.session.execute(text("""
-        SELECT Levels.id, Levels.name, Levels.published_at, Users.username, 
-            (SELECT COUNT(*) FROM LevelPlays WHERE Levels.id = LevelPlays.level_id),
-            (SELECT COUNT(*) FROM LevelClears WHERE Levels.id = LevelClears.level_id),
-            (SELECT COUNT(*) FROM Reviews WHERE Levels.id = Reviews.level_id)
-        FROM Levels
-        LEFT JOIN Users ON Users.id = Levels.publisher
-        WHERE Users.id = :user_id
-        GROUP BY Levels.id, Levels.name, Levels.published_at, Users.id, Users.username
-    """), {
+    return get_levels_page(["Levels.publisher = :user_id"], {
         "user_id": session["user_id"],
     })
 
-    response = list()
-    for id, name, published_at, publisher, plays, clears, reviews in result.fetchall():
-        response.append({
-            "name": str(name),
-            "publisher": str(publisher),
-            "published_at": str(published_at),
-            "plays": int(plays),
-            "clears": int(clears),
-            "reviews": int(reviews),
-            "play_url": url_for('play_level', id=id),
-        })
-    return json.dumps(response)
+### Search ###
+
+MAX_SEARCH_QUERY_LENGTH = 30
+# Substring matches need at least one whole trigram to use the trigram 
+# indexes, so shorter queries only match prefixes
+MIN_SUBSTRING_QUERY_LENGTH = 3
+# Matches are ranked among at most this many candidates from each index, 
+# which keeps unspecific queries (like the first letter typed) fast. The 
+# typeahead narrows them down as the user keeps typing
+SEARCH_CANDIDATES = 1000
+
+@levels_api.route("/api/levels/search")
+def search_levels():
+    query = " ".join(request.args.get("q", "").lower().split())[:MAX_SEARCH_QUERY_LENGTH]
+    if not query:
+        abort(400, "Missing search query")
+
+    # Results share the level list namespace, so they're invalidated along 
+    # with the listings whenever a level is published, updated or reviewed
+    key = ":".join(["search"] + [request.args.get(arg, "") for arg in ("limit", "cursor")] + [query])
+    cached = response_cache.get("levels", key)
+    if cached != None:
+        return cached
+
+    page = search_levels_page(query)
+    response_cache.set("levels", key, page.encode(), current_app.config["LEVEL_LIST_CACHE_TTL"])
+    return page
+
+def search_levels_page(query: str):
+    # Candidates are levels whose name starts with the query, levels whose 
+    # name contains it and levels by publishers whose username contains it, 
+    # found through the indexes in sql/reset.sql. They're ranked with exact 
+    # and prefix name matches first, then by trigram similarity. Each kind of
+    # candidate is taken in a fixed order, so every page of results is ranked
+    # over the same set. Prefix matches are taken in the order of the B-tree
+    # index, which always includes an exact match since it sorts first
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    prefix = f"{escaped}%"
+    limit = get_page_size()
+    params = {
+        "query": query,
+        "prefix": prefix,
+        "pattern": f"%{escaped}%" if len(query) >= MIN_SUBSTRING_QUERY_LENGTH else prefix,
+        "candidates": SEARCH_CANDIDATES,
+        "limit": limit + 1,
+    }
+
+    after = ""
+    cursor = request.args.get("cursor")
+    if cursor:
+        params["after_score"], params["after_id"] = decode_cursor(cursor, 2)
+        after = "WHERE (score, id) < (CAST(:after_score AS REAL), CAST(:after_id AS INT))"
+
+    result = db.session.execute(text(f"""
+        WITH Candidates AS (
+            (
+                SELECT id
+                FROM Levels
+                WHERE lower(name) LIKE :prefix
+                ORDER BY lower(name) USING ~<~
+                LIMIT :candidates
+            )
+            UNION
+            (
+                SELECT id
+                FROM Levels
+                WHERE lower(name) LIKE :pattern
+                ORDER BY id DESC
+                LIMIT :candidates
+            )
+            UNION
+            (
+                SELECT Levels.id
+                FROM Users
+                JOIN Levels ON Levels.publisher = Users.id
+                WHERE lower(Users.username) LIKE :pattern
+                ORDER BY Levels.id DESC
+                LIMIT :candidates
+            )
+        )
+        SELECT id, name, published_at, username, plays, clears, reviews, rating, score
+        FROM (
+            SELECT Levels.id, Levels.name, Levels.published_at, Users.username,
+                LevelStats.plays, LevelStats.clears, LevelStats.reviews, LevelStats.rating,
+                CAST(
+                    CASE
+                        WHEN lower(Levels.name) = :query THEN 2
+                        WHEN lower(Levels.name) LIKE :prefix THEN 1
+                        ELSE 0
+                    END + greatest(
+                        similarity(lower(Levels.name), :query),
+                        similarity(lower(coalesce(Users.username, '')), :query)
+                    )
+                AS REAL) AS score
+            FROM Candidates
+            JOIN Levels ON Levels.id = Candidates.id
+            JOIN LevelStats ON LevelStats.level_id = Levels.id
+            LEFT JOIN Users ON Users.id = Levels.publisher
+        ) AS Matches
+        {after}
+        ORDER BY score DESC, id DESC
+        LIMIT :limit
+    """), params)
+    rows = result.fetchall()
+
+    levels = [level_summary(*row[:-1]) for row in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(float(last[-1]), last[0])
+
+    return json.dumps({
+        "levels": levels,
+        "next_cursor": next_cursor,
+    })
+
+# Queries shared with the async handlers in asgi.py
+LEVEL_DATA_HASH_QUERY = text("""
+    SELECT data_hash
+    FROM Levels
+    WHERE id = :id
+""")
+LEVEL_DATA_QUERY = text("""
+    SELECT data, data_hash, CASE WHEN :packed THEN data_packed END
+    FROM Levels
+    WHERE id = :id
+""")
 
 @levels_api.route("/api/levels/<int:id>/data")
 def get_level_data(id: int):
-    result = db.session.execute(text("""
-        SELECT data
-        FROM Levels
-        WHERE id = :id
-    """), {
-        "id": id,
-    })
-    return result.fetchone()[0]
+    packed = wants_packed_level_data()
+    cached = get_cached_level_data(id, packed)
+    if cached == None:
+        # Revalidating clients only need the stored hash, not the data itself
+        if request.if_none_match:
+            result = db.session.execute(LEVEL_DATA_HASH_QUERY, { "id": id }).fetchone()
+            if result == None:
+                return make_error_response(404, 'Level not found')
+            if request.if_none_match.contains_weak(level_data_etag(result[0], packed)):
+                return make_level_data_response(level_data_etag(result[0], packed))
+
+        result = db.session.execute(LEVEL_DATA_QUERY, { "id": id, "packed": packed }).fetchone()
+        if result == None:
+            return make_error_response(404, 'Level not found')
+        cached = cache_level_data(id, packed, *result)
+
+    return make_level_data_response(*cached)
+
+def wants_packed_level_data() -> bool:
+    # Clients that can decode the compact format ask for it explicitly, 
+    # everyone else gets JSON
+    return request.accept_mimetypes.best_match(["application/json", LEVEL_FORMAT_MIMETYPE]) == LEVEL_FORMAT_MIMETYPE
+
+def get_cached_level_data(id: int, packed: bool) -> tuple[str, str, bytes] | None:
+    # Cache entries are the ETag, the content type and the data separated by 
+    # spaces
+    cached = response_cache.get("level-data", level_data_cache_key(id, packed))
+    if cached == None:
+        return None
+    etag, mimetype, data = cached.split(b" ", 2)
+    return etag.decode(), mimetype.decode(), data
+
+def cache_level_data(id: int, packed: bool, data, data_hash: str, data_packed: bytes | None) -> tuple[str, str, bytes]:
+    # Levels that haven't been migrated to the compact format yet are packed 
+    # on the fly, and levels that can't be packed are sent as JSON
+    if packed and data_packed == None:
+        data_packed = try_pack_level_data(data)
+    if packed and data_packed != None:
+        etag, mimetype, data = level_data_etag(data_hash, True), LEVEL_FORMAT_MIMETYPE, bytes(data_packed)
+    else:
+        etag, mimetype, data = level_data_etag(data_hash, False), "application/json", json.dumps(data).encode()
+
+    response_cache.set(
+        "level-data", level_data_cache_key(id, packed),
+        b" ".join([etag.encode(), mimetype.encode(), data]),
+        current_app.config["LEVEL_DATA_CACHE_TTL"]
+    )
+    return etag, mimetype, data
+
+def make_level_data_response(etag: str, mimetype: str | None = None, data: bytes | None = None):
+    if data == None or request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(data, mimetype=mimetype)
+
+    # Published data only changes when the level is updated, which also 
+    # changes the hash. Caches may reuse the data for a short while, after 
+    # which they revalidate it using the ETag (which is weakened when the 
+    # response is compressed, see compression.py)
+    response.set_etag(etag)
+    response.vary.add("Accept")
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["LEVEL_DATA_MAX_AGE"]
+    return response
+
+def level_data_etag(data_hash: str, packed: bool) -> str:
+    return f"{data_hash}-packed" if packed else data_hash
+
+def level_data_cache_key(id: int, packed: bool) -> str:
+    return f"{id}:packed" if packed else str(id)
+
+def invalidate_level(id: int):
+    # Drops every cached response for a published level
+    response_cache.invalidate("level-data", level_data_cache_key(id, False))
+    response_cache.invalidate("level-data", level_data_cache_key(id, True))
+    response_cache.invalidate("level-pages", id)
 
 @levels_api.route("/api/levels/wip")
+@primary_only
 def get_users_wip_levels():
     if not check_logged_in():
         return make_error_response(403, 'You need to log in to create levels')
@@ -91,36 +325,67 @@ def get_users_wip_levels():
 
     response = list()
     for id, name in result.fetchall():
-        print(f"{id}, {name}")
         if id != None and name != None:
             response.append({
                 "name": str(name),
-                "url": url_for('edit_level', id=int(id)),
+                "url": url_for('pages.edit_level', id=int(id)),
             })
     return json.dumps(response)
 
-@levels_api.route("/api/levels/<int:id>/mark-as-played", methods=["POST"])
-def mark_level_as_played(id: int):
-    db.session.execute(text("""
-        INSERT INTO LevelPlays (level_id, user_id)
+# Also shared with asgi.py
+LEVEL_EVENT_QUERIES = {
+    kind: text(f"""
+        INSERT INTO {table} (level_id, user_id)
         VALUES (:level_id, :user_id)
-    """), {
-        "level_id": id,
-        "user_id": session["user_id"]
-    })
-    db.session.commit()
+    """)
+    for kind, table in EVENT_TABLES.items()
+}
 
-    return {}, 200
+@levels_api.route("/api/levels/<int:id>/mark-as-played", methods=["POST"])
+@rate_limit("plays")
+def mark_level_as_played(id: int):
+    return record_level_event("plays", id)
 
 @levels_api.route("/api/levels/<int:id>/mark-as-cleared", methods=["POST"])
+@rate_limit("clears")
 def mark_level_as_cleared(id: int):
-    db.session.execute(text("""
-        INSERT INTO LevelClears (level_id, user_id)
-        VALUES (:level_id, :user_id)
-    """), {
+    # Clears come with the inputs the player used, which are replayed to 
+    # make sure they actually reach the goal
+    data = get_published_level_data(id)
+    if data == None:
+        return make_error_response(404, 'Level not found')
+    params = request.get_json(silent=True) or {}
+    if not clear_verifier.verify(data, params.get("trace")):
+        return make_error_response(400, 'Clear could not be verified')
+    return record_level_event("clears", id)
+
+def get_published_level_data(id: int) -> dict | None:
+    # The level's JSON data through the same cache as get_level_data
+    cached = get_cached_level_data(id, False)
+    if cached != None:
+        return json.loads(cached[2])
+    result = db.session.execute(LEVEL_DATA_QUERY, { "id": id, "packed": False }).fetchone()
+    if result == None:
+        return None
+    cache_level_data(id, False, *result)
+    return result[0]
+
+def record_level_event(kind: str, id: int):
+    if event_buffer.enabled:
+        return record_buffered_event(kind, id)
+
+    db.session.execute(LEVEL_EVENT_QUERIES[kind], {
         "level_id": id,
-        "user_id": session["user_id"]
+        "user_id": session.get("user_id")
     })
+    bump_level_stats(id, plays=int(kind == "plays"), clears=int(kind == "clears"))
     db.session.commit()
 
     return {}, 200
+
+def record_buffered_event(kind: str, id: int, block: bool = True):
+    try:
+        event_buffer.record(kind, id, session.get("user_id"), block)
+    except EventBufferFull:
+        return make_error_response(503, 'Server is too busy, try again later')
+    return {}, 202
@@ -3,47 +3,88 @@ from flask import Blueprint, request, session
 from sqlalchemy import text
 from models import check_logged_in, check_logged_in_mut, make_error_response, Review
 from models import db
+from cache import response_cache
+from stats import bump_level_rating, RATINGS
+from pagination import decode_cursor, encode_cursor, get_page_size
 import json
 
 reviews_api = Blueprint('reviews_api', __name__, template_folder='../templates')
 
 @reviews_api.route("/api/levels/<int:id>/reviews")
 def get_all_level_reviews(id: int):
-    result = db.session.execute(text("""
-        SELECT Users.id, Users.username, Reviews.rating, Reviews.body, Reviews.posted_at
-        FROM Reviews
-        LEFT JOIN Users ON Users.id = Reviews.user_id
-        LEFT JOIN Levels ON Levels.id = Reviews.level_id
-        WHERE Levels.id = :level_id
-        GROUP BY Users.id, Users.username, Reviews.rating, Reviews.body, Reviews.posted_at
+    stats = db.session.execute(text(f"""
+        SELECT reviews, rating, {", ".join(f"rating_{r}" for r in RATINGS)}
+        FROM LevelStats
+        WHERE level_id = :level_id
     """), {
         "level_id": id,
-    })
+    }).fetchone()
+    if stats == None:
+        return make_error_response(404, 'Level not found')
+
+    limit = get_page_size()
+    params = {
+        "level_id": id,
+        "limit": limit + 1,
+    }
+    conditions = ["Reviews.level_id = :level_id"]
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        params["after_posted_at"], params["after_user_id"] = decode_cursor(cursor, 2)
+        conditions.append("(Reviews.posted_at, Reviews.user_id) < (CAST(:after_posted_at AS TIMESTAMP), CAST(:after_user_id AS INT))")
+
+    result = db.session.execute(text(f"""
+        SELECT Reviews.user_id, Users.username, Reviews.rating, Reviews.body, Reviews.posted_at
+        FROM Reviews
+        LEFT JOIN Users ON Users.id = Reviews.user_id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY Reviews.posted_at DESC, Reviews.user_id DESC
+        LIMIT :limit
+    """), params)
+    rows = result.fetchall()
 
-    response = list()
-    for user_id, username, rating, body, posted_at in result.fetchall():
-        response.append({
+    reviews = list()
+    for user_id, username, rating, body, posted_at in rows[:limit]:
+        reviews.append({
             "user_id": int(user_id),
             "username": str(username),
             "rating": int(rating),
             "body": str(body),
             "posted_at": str(posted_at),
         })
-    return json.dumps(response)
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last.posted_at, last.user_id)
+
+    count, rating, *histogram = stats
+    return json.dumps({
+        "reviews": reviews,
+        "next_cursor": next_cursor,
+        "review_count": int(count),
+        "rating": float(rating),
+        "rating_counts": [int(n) for n in histogram],
+    })
 
 @reviews_api.route("/api/levels/<int:id>/reviews", methods=["DELETE"])
 def delete_level_reviews(id: int):
     if not check_logged_in_mut():
         return make_error_response(403, 'You need to log in to post reviews')
 
-    db.session.execute(text("""
+    deleted = db.session.execute(text("""
         DELETE FROM Reviews
         WHERE user_id = :user_id AND level_id = :level_id
+        RETURNING rating
     """), {
         "user_id": session["user_id"],
         "level_id": id,
-    })
+    }).fetchall()
+    for rating, in deleted:
+        bump_level_rating(id, rating, -1)
     db.session.commit()
+    response_cache.invalidate("levels")
 
     return {}, 200
 
@@ -53,6 +94,8 @@ def post_level_review(id: int):
         return make_error_response(403, 'You need to log in to post reviews')
 
     params = Review(**request.json)
+    if not isinstance(params.rating, int) or params.rating not in RATINGS:
+        return make_error_response(400, 'Ratings must be between 0 and 5')
 
     db.session.execute(text("""
         INSERT INTO Reviews (level_id, user_id, rating, body)
@@ -63,6 +106,8 @@ def post_level_review(id: int):
         "rating": params.rating,
         "body": params.body
     })
+    bump_level_rating(id, params.rating, 1)
     db.session.commit()
+    response_cache.invalidate("levels")
 
     return {}, 200
@@ -1,16 +1,29 @@
+from time import perf_counter
+# Taken before anything else is imported, so that the startup time reported
+# by warmup.py includes imports
+STARTED_AT = perf_counter()
 
-from flask import Flask, render_template, session
-from sqlalchemy import text
-from os import getenv, path
+from flask import Flask, current_app, request
+from os import getenv
 from dotenv import load_dotenv
 from werkzeug.exceptions import HTTPException
 from sqlalchemy.exc import IntegrityError
-from models import check_logged_in, check_logged_in_mut, make_error_response, db
-from api.auth import auth_api
-from api.user import user_api
-from api.editor import editor_api
-from api.levels import levels_api
-from api.reviews import reviews_api
+from models import make_error_response, db
+from trending import trending_refresher
+from events import event_buffer
+from cache import response_cache
+from database import database_url, engine_options, replica_router
+from metrics import metrics
+from profiling import request_profiler
+from passwords import password_hasher, password_pool
+from levelnames import level_names
+from compression import response_compressor
+from assets import static_assets
+from sessions import server_sessions
+from ratelimit import body_size_limits, rate_limiter
+from verification import clear_verifier, simulation_pool, InvalidTrace
+from workers import WorkerPoolFull, WorkerPoolTimeout
+from warmup import record_startup, warm_up
 import json
 import mimetypes
 
@@ -20,26 +33,147 @@ load_dotenv()
 # Recognize .mjs file extension as JavaScript
 mimetypes.add_type("text/javascript", ".mjs")
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = getenv("DATABASE_URL")
-app.secret_key = getenv("SECRET_KEY")
-app.template_folder = '../templates'
-db.init_app(app)
-app.register_blueprint(auth_api)
-app.register_blueprint(user_api)
-app.register_blueprint(levels_api)
-app.register_blueprint(reviews_api)
-app.register_blueprint(editor_api)
+### App factory ###
+
+# The extensions are module-level singletons that hold their state (and
+# their background threads, worker pools and fork hooks) for the whole
+# process, so there can only be one app per process
+created_app = None
+
+def create_app(config: dict | None = None) -> Flask:
+    # `config` overrides the settings read from the environment
+    global created_app
+    if created_app != None:
+        raise RuntimeError("The app has already been created in this process")
+
+    app = Flask(__name__, template_folder="templates")
+    app.config["DB_POOL_SIZE"] = int(getenv("DB_POOL_SIZE", "5"))
+    app.config["DB_MAX_OVERFLOW"] = int(getenv("DB_MAX_OVERFLOW", "10"))
+    app.config["DB_POOL_TIMEOUT"] = float(getenv("DB_POOL_TIMEOUT", "30"))
+    app.config["DB_POOL_RECYCLE"] = int(getenv("DB_POOL_RECYCLE", "1800"))
+    app.config["DB_POOL_PRE_PING"] = getenv("DB_POOL_PRE_PING", "1") == "1"
+    app.config["DB_STATEMENT_TIMEOUT"] = int(getenv("DB_STATEMENT_TIMEOUT", "0"))
+    app.config["DB_PREPARED_STATEMENTS"] = getenv("DB_PREPARED_STATEMENTS", "0") == "1"
+    app.config["DB_PREPARE_THRESHOLD"] = int(getenv("DB_PREPARE_THRESHOLD", "1"))
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url(getenv("DATABASE_URL"), app.config["DB_PREPARED_STATEMENTS"])
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config, "primary")
+    app.config["REPLICA_READ_YOUR_WRITES"] = float(getenv("REPLICA_READ_YOUR_WRITES", "10"))
+    if getenv("REPLICA_DATABASE_URL"):
+        app.config["SQLALCHEMY_BINDS"] = {
+            "replica": {
+                "url": database_url(getenv("REPLICA_DATABASE_URL"), app.config["DB_PREPARED_STATEMENTS"]),
+                **engine_options(app.config, "replica"),
+            },
+        }
+    app.config["METRICS"] = getenv("METRICS", "0") == "1"
+    app.config["PROFILING"] = getenv("PROFILING", "0") == "1"
+    app.config["SLOW_QUERY_THRESHOLD"] = float(getenv("SLOW_QUERY_THRESHOLD", "100"))
+    app.config["EVENT_BUFFER"] = getenv("EVENT_BUFFER", "0") == "1"
+    app.config["EVENT_BUFFER_SIZE"] = int(getenv("EVENT_BUFFER_SIZE", "10000"))
+    app.config["EVENT_BUFFER_BATCH"] = int(getenv("EVENT_BUFFER_BATCH", "1000"))
+    app.config["EVENT_BUFFER_FLUSH_INTERVAL"] = float(getenv("EVENT_BUFFER_FLUSH_INTERVAL", "1.0"))
+    app.config["EVENT_BUFFER_PUT_TIMEOUT"] = float(getenv("EVENT_BUFFER_PUT_TIMEOUT", "0.5"))
+    app.config["EVENT_BUFFER_RETRIES"] = int(getenv("EVENT_BUFFER_RETRIES", "5"))
+    app.config["EVENT_BUFFER_RETRY_DELAY"] = float(getenv("EVENT_BUFFER_RETRY_DELAY", "0.5"))
+    app.config["COMPRESSION"] = getenv("COMPRESSION", "1") == "1"
+    app.config["COMPRESS_MIN_SIZE"] = int(getenv("COMPRESS_MIN_SIZE", "1024"))
+    app.config["LEVEL_DATA_MAX_AGE"] = int(getenv("LEVEL_DATA_MAX_AGE", "60"))
+    app.config["CACHE_BACKEND"] = getenv("CACHE_BACKEND", "local")
+    app.config["CACHE_REDIS_URL"] = getenv("CACHE_REDIS_URL")
+    app.config["CACHE_MAX_BYTES"] = int(getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    app.config["SESSION_BACKEND"] = getenv("SESSION_BACKEND", "cookie")
+    app.config["SESSION_REDIS_URL"] = getenv("SESSION_REDIS_URL", getenv("CACHE_REDIS_URL"))
+    app.config["SESSION_CACHE_SIZE"] = int(getenv("SESSION_CACHE_SIZE", "10000"))
+    app.config["SESSION_CACHE_TTL"] = float(getenv("SESSION_CACHE_TTL", "5"))
+    app.config["RATE_LIMIT_BACKEND"] = getenv("RATE_LIMIT_BACKEND", "local")
+    app.config["RATE_LIMIT_REDIS_URL"] = getenv("RATE_LIMIT_REDIS_URL", getenv("CACHE_REDIS_URL"))
+    app.config["RATE_LIMIT_PLAYS"] = getenv("RATE_LIMIT_PLAYS", "60/60")
+    app.config["RATE_LIMIT_CLEARS"] = getenv("RATE_LIMIT_CLEARS", "30/60")
+    app.config["RATE_LIMIT_EDITOR"] = getenv("RATE_LIMIT_EDITOR", "120/60")
+    app.config["MAX_CONTENT_LENGTH"] = int(getenv("MAX_BODY_SIZE", str(1024 * 1024)))
+    app.config["EDITOR_MAX_BODY_SIZE"] = int(getenv("EDITOR_MAX_BODY_SIZE", str(2 * 1024 * 1024)))
+    app.config["LEVEL_DATA_CACHE_TTL"] = float(getenv("LEVEL_DATA_CACHE_TTL", "60"))
+    app.config["LEVEL_LIST_CACHE_TTL"] = float(getenv("LEVEL_LIST_CACHE_TTL", "10"))
+    app.config["LEVEL_PAGE_CACHE_TTL"] = float(getenv("LEVEL_PAGE_CACHE_TTL", "30"))
+    app.config["TRENDING_HALF_LIFE"] = float(getenv("TRENDING_HALF_LIFE", "24"))
+    app.config["TRENDING_REFRESH_INTERVAL"] = float(getenv("TRENDING_REFRESH_INTERVAL", "60"))
+    app.config["LEVEL_EDIT_COMPACT_THRESHOLD"] = int(getenv("LEVEL_EDIT_COMPACT_THRESHOLD", "50"))
+    app.config["PASSWORD_HASH_METHOD"] = getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+    app.config["PASSWORD_HASH_WORKERS"] = int(getenv("PASSWORD_HASH_WORKERS", "2"))
+    app.config["PASSWORD_HASH_QUEUE"] = int(getenv("PASSWORD_HASH_QUEUE", "32"))
+    app.config["PASSWORD_HASH_TIMEOUT"] = float(getenv("PASSWORD_HASH_TIMEOUT", "10"))
+    app.config["SIMULATION_WORKERS"] = int(getenv("SIMULATION_WORKERS", "2"))
+    app.config["SIMULATION_QUEUE"] = int(getenv("SIMULATION_QUEUE", "32"))
+    app.config["SIMULATION_TIMEOUT"] = float(getenv("SIMULATION_TIMEOUT", "10"))
+    app.config["WARMUP"] = getenv("WARMUP", "0") == "1"
+    app.config["STARTUP_BUDGET"] = float(getenv("STARTUP_BUDGET", "1.0"))
+    app.secret_key = getenv("SECRET_KEY")
+    if config != None:
+        app.config.update(config)
+
+    db.init_app(app)
+    replica_router.init_app(app, primary_blueprints=["auth_api", "editor_api"])
+    metrics.init_app(app)
+    request_profiler.init_app(app, db)
+    event_buffer.init_app(app)
+    trending_refresher.init_app(app)
+    response_cache.init_app(app)
+    server_sessions.init_app(app)
+    rate_limiter.init_app(app, quotas=["plays", "clears", "editor"])
+    body_size_limits.init_app(app, blueprint_limits={ "editor_api": app.config["EDITOR_MAX_BODY_SIZE"] })
+    password_hasher.init_app(app)
+    clear_verifier.init_app(app)
+    level_names.init_app(app)
+    response_compressor.init_app(app)
+    static_assets.init_app(app)
+    metrics.stats_collector("cache", response_cache.stats)
+    metrics.stats_collector("sessions", server_sessions.stats)
+    metrics.stats_collector("rate_limit", rate_limiter.stats)
+    metrics.stats_collector("event_buffer", event_buffer.stats)
+    metrics.stats_collector("trending_refresher", trending_refresher.stats)
+    metrics.stats_collector("worker_pool", password_pool.stats, pool=password_pool.name)
+    metrics.stats_collector("worker_pool", simulation_pool.stats, pool=simulation_pool.name)
+
+    # Blueprints (and whatever they import) are only loaded once an app is
+    # actually created
+    from api.auth import auth_api
+    from api.user import user_api
+    from api.editor import editor_api
+    from api.levels import levels_api
+    from api.reviews import reviews_api
+    from pages import pages
+    from commands import commands
+    app.register_blueprint(auth_api)
+    app.register_blueprint(user_api)
+    app.register_blueprint(levels_api)
+    app.register_blueprint(reviews_api)
+    app.register_blueprint(editor_api)
+    app.register_blueprint(pages)
+    app.register_blueprint(commands)
+
+    app.register_error_handler(Exception, handle_error)
+    app.register_error_handler(IntegrityError, handle_integrity_error)
+    app.register_error_handler(HTTPException, handle_http_error)
+    app.register_error_handler(InvalidTrace, handle_invalid_trace)
+    app.register_error_handler(WorkerPoolFull, handle_worker_pool_busy)
+    app.register_error_handler(WorkerPoolTimeout, handle_worker_pool_busy)
+
+    warmed_up_at = None
+    if app.config["WARMUP"]:
+        warmed_up_at = perf_counter()
+        warm_up(app, db)
+    record_startup(app, STARTED_AT, warmed_up_at)
+
+    created_app = app
+    return app
+
+### Error handlers ###
 
-### Error handler ###
-
-@app.errorhandler(Exception)
 def handle_error(e: Exception):
-    print(e)
+    current_app.logger.exception(f"Unhandled error in {request.method} {request.path}")
     return make_error_response(500, "Internal server error")
 
-@app.errorhandler(IntegrityError)
-def handle_error(e: IntegrityError):
+def handle_integrity_error(e: IntegrityError):
     human_readable_reasons = {
         "username_unique": "Username is taken",
         "username_length": "Usernames must be between 3 and 20 characters",
@@ -52,8 +186,15 @@ def handle_error(e: IntegrityError):
 
     return make_error_response(400, reason)
 
-@app.errorhandler(HTTPException)
-def handle_error(e: HTTPException):
+def handle_invalid_trace(e: InvalidTrace):
+    return make_error_response(400, str(e))
+
+def handle_worker_pool_busy(e: Exception):
+    # Password hashing or input replays are backed up
+    body, code = make_error_response(503, 'Server is too busy, try again later')
+    return body, code, { "Retry-After": "1" }
+
+def handle_http_error(e: HTTPException):
     response = e.get_response()
     response.data = json.dumps({
         "code": e.code,
@@ -62,70 +203,12 @@ def handle_error(e: HTTPException):
     response.content_type = "application/json"
     return response
 
-### Pages ###
-
-@app.route("/star-svg")
-def asset_star_svg():
-    return render_template("star.svg.j2")
-
-@app.route("/")
-def index():
-    return render_template("pages/home.html.j2")
-
-@app.route("/user")
-def userpage():
-    return render_template("pages/userpage.html.j2")
-
-@app.route("/edit/<int:id>")
-def edit_level(id: int):
-    if not check_logged_in():
-        return make_error_response(403, 'You need to log in to create levels')
-    
-    name, published_id = db.session.execute(text("""
-        SELECT UnpublishedLevels.name, UnpublishedLevels.published_id
-        FROM Users
-        LEFT JOIN UnpublishedLevels ON Users.id = UnpublishedLevels.creator
-        WHERE Users.id = :user_id AND UnpublishedLevels.id = :level_id
-        GROUP BY UnpublishedLevels.name, UnpublishedLevels.published_id
-    """), {
-        "user_id": session["user_id"],
-        "level_id": id,
-    }).fetchone()
-    
-    return render_template("pages/editor.html.j2", level_id=id, level_name=name, published_id=published_id)
-
-@app.route("/level/<int:id>")
-def play_level(id: int):
-    result = db.session.execute(text("""
-        SELECT Levels.id, Levels.name, Levels.published_at, Users.id, Users.username,
-            (SELECT COUNT(*) FROM LevelPlays WHERE Levels.id = LevelPlays.level_id),
-            (SELECT COUNT(*) FROM LevelClears WHERE Levels.id = LevelClears.level_id),
-            (SELECT COUNT(*) FROM Reviews WHERE Levels.id = Reviews.level_id)
-        FROM Levels
-        LEFT JOIN Users ON Users.id = Levels.publisher
-        WHERE Levels.id = :level_id
-        GROUP BY Levels.id, Levels.name, Levels.published_at, Users.id, Users.username
-    """), {
-        "level_id": id,
-    })
-    level_id, name, published_at, user_id, publisher, plays, clears, reviews = result.fetchall()[0]
-
-    user_has_review = False
-    if check_logged_in():
-        user_has_review = db.session.execute(text("""
-            SELECT COUNT(*)
-            FROM Reviews
-            WHERE Reviews.user_id = :user_id AND Reviews.level_id = :level_id
-        """), {
-            "level_id": id,
-            "user_id": session["user_id"],
-        }).fetchone()[0]
-    
-    return render_template(
-        "pages/level.html.j2",
-        level_id=id,
-        level_name=name,
-        level_creator=publisher,
-        level_published_at=published_at,
-        level_has_been_reviewed_by_current_user=user_has_review,
-    )
+def __getattr__(name: str):
+    # `app` is created on first access, which is how the WSGI server, the
+    # flask command and asgi.py find it, so that importing this module just
+    # for create_app() doesn't create one
+    global app
+    if name == "app":
+        app = created_app if created_app != None else create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
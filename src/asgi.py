@@ -0,0 +1,247 @@
+from flask import Flask, g, request, session
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from werkzeug.routing import Map, Rule
+from io import BytesIO
+from app import app as flask_app
+from models import make_error_response
+from database import async_database_url, async_engine_options
+from events import event_buffer
+from profiling import request_profiler
+from stats import BUMP_LEVEL_STATS
+from api.levels import LEVEL_DATA_HASH_QUERY, LEVEL_DATA_QUERY, LEVEL_EVENT_QUERIES
+from api.levels import cache_level_data, get_cached_level_data, level_data_etag, make_level_data_response
+from api.levels import record_buffered_event, wants_packed_level_data
+import asyncio
+import contextvars
+import sys
+
+### Async server ###
+
+# Serving the app with an ASGI server (`uvicorn --app-dir src asgi:app`)
+# handles the hottest endpoints, which do little besides waiting on the
+# database, on the event loop with an async engine, so that thousands of
+# slow clients don't each need a thread. Requests to those endpoints still
+# go through Flask's request context, so before/after request hooks, session
+# cookies, CSRF checks and error handlers all behave exactly as in the WSGI
+# app. Everything else is passed on to the WSGI app, which runs it in a
+# thread pool like before
+
+MAX_ASYNC_BODY_SIZE = 64 * 1024
+
+class AsyncDatabase:
+    def __init__(self):
+        self.engines = dict()
+
+    def init_app(self, app: Flask):
+        self.engines["primary"] = create_async_engine(
+            async_database_url(app.config["SQLALCHEMY_DATABASE_URI"]),
+            **async_engine_options(app.config, "primary-async"),
+        )
+        replica = app.config.get("SQLALCHEMY_BINDS", {}).get("replica")
+        if replica != None:
+            self.engines["replica"] = create_async_engine(
+                async_database_url(replica["url"]),
+                **async_engine_options(app.config, "replica-async"),
+            )
+        for engine in self.engines.values():
+            request_profiler.profile_engine(engine.sync_engine)
+
+    def engine(self) -> AsyncEngine:
+        # Follows the same routing as the sync session (see database.py)
+        if g.get("db_use_replica", False) and "replica" in self.engines:
+            return self.engines["replica"]
+        return self.engines["primary"]
+
+    async def dispose(self):
+        for engine in self.engines.values():
+            await engine.dispose()
+
+async_db = AsyncDatabase()
+
+### Async handlers ###
+
+async def get_level_data(id: int):
+    packed = wants_packed_level_data()
+    cached = get_cached_level_data(id, packed)
+    if cached == None:
+        async with async_db.engine().connect() as conn:
+            if request.if_none_match:
+                result = (await conn.execute(LEVEL_DATA_HASH_QUERY, { "id": id })).fetchone()
+                if result == None:
+                    return make_error_response(404, 'Level not found')
+                if request.if_none_match.contains_weak(level_data_etag(result[0], packed)):
+                    return make_level_data_response(level_data_etag(result[0], packed))
+
+            result = (await conn.execute(LEVEL_DATA_QUERY, { "id": id, "packed": packed })).fetchone()
+            if result == None:
+                return make_error_response(404, 'Level not found')
+        cached = cache_level_data(id, packed, *result)
+
+    return make_level_data_response(*cached)
+
+async def record_level_event(kind: str, id: int):
+    if event_buffer.enabled:
+        return record_buffered_event(kind, id, block=False)
+
+    async with async_db.engine().begin() as conn:
+        await conn.execute(LEVEL_EVENT_QUERIES[kind], {
+            "level_id": id,
+            "user_id": session.get("user_id"),
+        })
+        await conn.execute(BUMP_LEVEL_STATS, {
+            "level_id": id,
+            "plays": int(kind == "plays"),
+            "clears": int(kind == "clears"),
+        })
+
+    return {}, 200
+
+async def mark_level_as_played(id: int):
+    return await record_level_event("plays", id)
+
+# Marking levels as cleared replays the player's inputs, which is CPU-bound
+# work for the simulation pool, so it stays in the WSGI app
+ASYNC_ROUTES = Map([
+    Rule("/api/levels/<int:id>/data", endpoint=get_level_data, methods=["GET"]),
+    Rule("/api/levels/<int:id>/mark-as-played", endpoint=mark_level_as_played, methods=["POST"]),
+])
+
+### ASGI app ###
+
+def build_environ(scope: dict, body: bytes) -> dict:
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        # The server has already percent-decoded the path, WSGI wants it as
+        # latin-1 decoded bytes
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            environ[name] = value
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+class BodyTooLarge(Exception):
+    pass
+
+async def read_body(receive) -> bytes | None:
+    # Returns None if the client went away before sending the whole body
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if len(body) > MAX_ASYNC_BODY_SIZE:
+            raise BodyTooLarge()
+        if not message.get("more_body", False):
+            return bytes(body)
+
+async def dispatch(view, view_args: dict, environ: dict):
+    # The same steps as Flask's full_dispatch_request, with the view awaited.
+    # Opening and saving the session, before/after request hooks, error
+    # handlers and teardown may all wait on Redis or the database, so they
+    # run in the loop's thread pool instead of blocking the loop. Every step
+    # runs in the same context, so the request context pushed in one thread
+    # is the one the view sees and the one that gets popped at the end
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+
+    def run_sync(func, *args):
+        return loop.run_in_executor(None, context.run, func, *args)
+
+    ctx = flask_app.request_context(environ)
+    await run_sync(ctx.push)
+    try:
+        try:
+            rv = await run_sync(flask_app.preprocess_request)
+            if rv == None:
+                rv = await asyncio.create_task(view(**view_args), context=context)
+        except Exception as e:
+            rv = await run_sync(flask_app.handle_user_exception, e)
+        response = await run_sync(flask_app.finalize_request, rv)
+    except Exception as e:
+        # Unexpected errors are handled here so they're logged with their
+        # traceback
+        response = context.run(flask_app.handle_exception, e)
+    finally:
+        await run_sync(ctx.pop)
+    return response.status_code, list(response.get_wsgi_headers(environ).items()), b"".join(response.get_app_iter(environ))
+
+async def send_response(send, status: int, headers: list, body: bytes):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    })
+    await send({ "type": "http.response.body", "body": body })
+
+class AsyncApp:
+    def __init__(self):
+        self.wsgi = None
+
+    def init_app(self, app: Flask):
+        # asgiref comes with Flask's "async" extra, so it's only imported when
+        # actually serving over ASGI
+        try:
+            from asgiref.wsgi import WsgiToAsgi
+        except ImportError:
+            raise RuntimeError("The 'asgiref' package is required to use the async server")
+        self.wsgi = WsgiToAsgi(app)
+        async_db.init_app(app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        adapter = ASYNC_ROUTES.bind(scope.get("server", ("localhost", 80))[0], path_info=scope["path"])
+        try:
+            view, view_args = adapter.match(method=scope["method"])
+        except Exception:
+            # Not an async route (or a method it doesn't handle)
+            return await self.wsgi(scope, receive, send)
+
+        try:
+            body = await read_body(receive)
+        except BodyTooLarge:
+            return await send_response(send, 413, [], b"")
+        if body == None:
+            return
+
+        status, headers, data = await dispatch(view, view_args, build_environ(scope, body))
+        await send_response(send, status, headers, data)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({ "type": "lifespan.startup.complete" })
+            elif message["type"] == "lifespan.shutdown":
+                await async_db.dispose()
+                await send({ "type": "lifespan.shutdown.complete" })
+                return
+
+app = AsyncApp()
+app.init_app(flask_app)
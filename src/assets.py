@@ -0,0 +1,120 @@
+from flask import Flask, Response, abort, request
+from compression import available_encodings, compress, negotiate_encoding
+from hashlib import sha256
+from os import path, walk
+import mimetypes
+import posixpath
+import re
+
+### Static assets ###
+
+# At startup every file in the static folder is read into memory, given a
+# fingerprinted name containing a hash of its contents (`engine.mjs` becomes
+# `engine.3f2a9c1b04de.mjs`) and compressed once with every available
+# encoding. `url_for('static', ...)` links to the fingerprinted names, which
+# are served with an immutable Cache-Control, so browsers never ask for them
+# again until a deploy changes their contents
+#
+# JavaScript modules import each other by relative path, so those imports
+# are rewritten to the fingerprinted names as well. That way a change to
+# api.mjs also changes the names of the modules importing it
+#
+# In debug mode files are served straight from disk so that edits show up
+# without restarting the server
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+RELATIVE_IMPORT = re.compile(r"""(\b(?:from|import)\s*\(?\s*)(["'])(\.{1,2}/[^"']+)\2""")
+
+class StaticAsset:
+    def __init__(self, filename: str, data: bytes):
+        self.filename = filename
+        self.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        self.hash = sha256(data).hexdigest()[:12]
+        stem, ext = posixpath.splitext(filename)
+        self.fingerprinted_name = f"{stem}.{self.hash}{ext}"
+
+        # Compressed variants are only kept if they're actually smaller
+        self.variants = { None: data }
+        if self.mimetype.startswith(COMPRESSIBLE_TYPES):
+            for encoding in available_encodings():
+                compressed = compress(data, encoding, best=True)
+                if len(compressed) < len(data):
+                    self.variants[encoding] = compressed
+
+class StaticAssets:
+    def __init__(self):
+        self.enabled = False
+        self.assets = dict()
+        self.fingerprinted = dict()
+
+    def init_app(self, app: Flask):
+        self.enabled = not app.debug and app.static_folder != None
+        if self.enabled:
+            sources = dict()
+            for dirpath, _, filenames in walk(app.static_folder):
+                for name in filenames:
+                    fullpath = path.join(dirpath, name)
+                    filename = path.relpath(fullpath, app.static_folder).replace(path.sep, "/")
+                    with open(fullpath, "rb") as f:
+                        sources[filename] = f.read()
+            for filename in sources:
+                self.load_asset(filename, sources, set())
+
+            app.url_defaults(self.fingerprint_url)
+            app.view_functions["static"] = self.send_static
+        app.extensions["static_assets"] = self
+
+    def load_asset(self, filename: str, sources: dict[str, bytes], importers: set[str]) -> StaticAsset:
+        if filename in self.assets:
+            return self.assets[filename]
+        if filename in importers:
+            raise RuntimeError(f"Static module '{filename}' imports itself (through {', '.join(importers)})")
+
+        data = sources[filename]
+        if filename.endswith(".mjs"):
+            # Dependencies are fingerprinted first, since their names end up
+            # in this file's contents and so in its hash
+            def rewrite(match):
+                target = posixpath.normpath(posixpath.join(posixpath.dirname(filename), match[3]))
+                if target not in sources:
+                    return match[0]
+                dependency = self.load_asset(target, sources, importers | { filename })
+                rewritten = posixpath.join(posixpath.dirname(match[3]), posixpath.basename(dependency.fingerprinted_name))
+                return f"{match[1]}{match[2]}{rewritten}{match[2]}"
+            data = RELATIVE_IMPORT.sub(rewrite, data.decode()).encode()
+
+        asset = StaticAsset(filename, data)
+        self.assets[filename] = asset
+        self.fingerprinted[asset.fingerprinted_name] = asset
+        return asset
+
+    def fingerprint_url(self, endpoint: str, values: dict):
+        if endpoint == "static" and values.get("filename") in self.assets:
+            values["filename"] = self.assets[values["filename"]].fingerprinted_name
+
+    def send_static(self, filename: str):
+        asset = self.fingerprinted.get(filename)
+        immutable = asset != None
+        if asset == None:
+            # Old pages and hand-written links may still use the plain names
+            asset = self.assets.get(filename)
+            if asset == None:
+                abort(404)
+
+        encoding = negotiate_encoding([e for e in asset.variants if e != None])
+        response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        if encoding != None:
+            response.headers["Content-Encoding"] = encoding
+        if len(asset.variants) > 1:
+            response.vary.add("Accept-Encoding")
+        response.set_etag(asset.hash, weak=encoding != None)
+        response.cache_control.public = True
+        if immutable:
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+static_assets = StaticAssets()
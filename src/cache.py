@@ -0,0 +1,163 @@
+from flask import Flask
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+### Response cache ###
+
+# Serialized responses for hot endpoints (level data, listing pages) are kept
+# in a cache bounded by size in bytes. Entries are grouped into namespaces;
+# each namespace has a generation number that is part of every key, so a
+# whole namespace can be invalidated at once by bumping it. Stale entries
+# then just fall out of the cache as it evicts
+
+class LocalCacheBackend:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.generations = dict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= monotonic():
+                self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: bytes, ttl: float):
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, monotonic() + ttl)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+
+    def generation(self, namespace: str) -> int:
+        return self.generations.get(namespace, 0)
+
+    def bump_generation(self, namespace: str):
+        with self.lock:
+            self.generations[namespace] = self.generations.get(namespace, 0) + 1
+
+    def remove(self, key: str):
+        value, _ = self.entries.pop(key)
+        self.size -= len(key) + len(value)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+class RedisCacheBackend:
+    def __init__(self, url: str, prefix: str = "cache:"):
+        self.client = redis_from_url(url)
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> bytes | None:
+        value = self.client.get(self.prefix + key)
+        if value == None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.client.set(self.prefix + key, value, px=int(ttl * 1000))
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def generation(self, namespace: str) -> int:
+        return int(self.client.get(f"{self.prefix}generation:{namespace}") or 0)
+
+    def bump_generation(self, namespace: str):
+        self.client.incr(f"{self.prefix}generation:{namespace}")
+
+    def stats(self) -> dict:
+        # Redis is shared by every worker and evicts on its own (given a
+        # maxmemory policy), so evictions are read from the server
+        info = self.client.info("stats")
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": int(info.get("evicted_keys", 0)),
+        }
+
+def redis_from_url(url: str):
+    # Redis is only needed for shared backends in multi-worker deployments,
+    # so it's not a hard dependency
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError("The 'redis' package is required to use a Redis backend")
+    return redis.Redis.from_url(url)
+
+class ResponseCache:
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app: Flask):
+        backend = app.config.get("CACHE_BACKEND", "local")
+        if backend == "local":
+            self.backend = LocalCacheBackend(app.config.get("CACHE_MAX_BYTES", 64 * 1024 * 1024))
+        elif backend == "redis":
+            self.backend = RedisCacheBackend(app.config["CACHE_REDIS_URL"])
+        elif backend != "none":
+            raise ValueError(f"Unknown cache backend '{backend}'")
+        app.extensions["response_cache"] = self
+
+    def key(self, namespace: str, key) -> str:
+        return f"{namespace}:{self.backend.generation(namespace)}:{key}"
+
+    def get(self, namespace: str, key) -> bytes | None:
+        if self.backend == None:
+            return None
+        return self.backend.get(self.key(namespace, key))
+
+    def set(self, namespace: str, key, value: bytes, ttl: float):
+        if self.backend != None:
+            self.backend.set(self.key(namespace, key), value, ttl)
+
+    def invalidate(self, namespace: str, key = None):
+        if self.backend == None:
+            return
+        if key == None:
+            self.backend.bump_generation(namespace)
+        else:
+            self.backend.delete(self.key(namespace, key))
+
+    def stats(self) -> dict:
+        if self.backend == None:
+            return {}
+        return self.backend.stats()
+
+response_cache = ResponseCache()
@@ -0,0 +1,54 @@
+from flask import Blueprint
+from stats import rebuild_level_stats, refresh_level_trending
+from cache import response_cache
+from levelformat import pack_stored_levels
+from leveledits import compact_all_level_edits
+from levelarchive import export_levels, import_levels
+import click
+import sys
+
+# Registered without a group, so that the commands are run as
+# `flask --app src/app.py <command>`
+commands = Blueprint('commands', __name__, cli_group=None)
+
+@commands.cli.command("rebuild-level-stats")
+def rebuild_level_stats_command():
+    count = rebuild_level_stats()
+    print(f"Rebuilt stats for {count} levels")
+
+@commands.cli.command("refresh-trending")
+def refresh_trending_command():
+    count = refresh_level_trending()
+    if count == None:
+        print("Trending levels are already being refreshed")
+    else:
+        print(f"Refreshed trending scores of {count} levels")
+
+@commands.cli.command("compact-level-edits")
+def compact_level_edits_command():
+    count = compact_all_level_edits()
+    print(f"Compacted edits of {count} levels")
+
+@commands.cli.command("pack-levels")
+def pack_levels_command():
+    packed, skipped = pack_stored_levels()
+    print(f"Packed {packed} levels, {skipped} levels could not be packed")
+
+@commands.cli.command("export-levels")
+@click.argument("output", type=click.File("w"), default="-")
+@click.option("--packed", is_flag=True, help="Export level data in the compact format where possible")
+@click.option("--no-drafts", is_flag=True, help="Only export published levels")
+def export_levels_command(output, packed: bool, no_drafts: bool):
+    levels, drafts = export_levels(output, packed=packed, drafts=not no_drafts)
+    print(f"Exported {levels} levels and {drafts} unpublished levels", file=sys.stderr)
+
+@commands.cli.command("import-levels")
+@click.argument("input", type=click.File("r"), default="-")
+@click.option("--batch-size", type=int, default=1000)
+def import_levels_command(input, batch_size: int):
+    counts = import_levels(input, batch_size)
+    response_cache.invalidate("levels")
+    print(
+        f"Imported {counts['levels']} levels with {counts['reviews']} reviews and {counts['drafts']} unpublished levels, "
+        f"skipped {counts['skipped']} that already exist, belong to unknown users or are invalid"
+    )
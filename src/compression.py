@@ -0,0 +1,85 @@
+from flask import Flask, Response, request
+import gzip
+
+### Response compression ###
+
+# Large JSON responses (level lists, level data, reviews) and pages are
+# compressed with brotli or gzip, whichever the client prefers, once they
+# are at least COMPRESS_MIN_SIZE bytes. Below that the headers cost more than
+# compression saves. Brotli needs the optional 'brotli' package; without it
+# only gzip is offered
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = { "application/json", "text/html" }
+
+# Dynamic responses are compressed on every request, so they use fast
+# settings. Static assets are compressed once at startup with the best ones
+FAST_LEVELS = { "br": 4, "gzip": 6 }
+BEST_LEVELS = { "br": 11, "gzip": 9 }
+
+def available_encodings() -> list[str]:
+    return ["br", "gzip"] if brotli != None else ["gzip"]
+
+def compress(data: bytes, encoding: str, best: bool = False) -> bytes:
+    levels = BEST_LEVELS if best else FAST_LEVELS
+    if encoding == "br":
+        return brotli.compress(data, quality=levels["br"])
+    # mtime=0 keeps the output (and so static asset hashes) reproducible
+    return gzip.compress(data, compresslevel=levels["gzip"], mtime=0)
+
+def negotiate_encoding(encodings) -> str | None:
+    # Picks the encoding the client gave the highest quality, preferring the
+    # order of `encodings` on ties
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def weaken_etag(response: Response):
+    # A strong ETag promises byte-identical bodies, which no longer holds
+    # once the body depends on the negotiated encoding
+    etag, weak = response.get_etag()
+    if etag != None and not weak:
+        response.set_etag(etag, weak=True)
+
+class ResponseCompressor:
+    def __init__(self):
+        self.enabled = False
+
+    def init_app(self, app: Flask):
+        self.enabled = app.config.get("COMPRESSION", True)
+        self.min_size = app.config.get("COMPRESS_MIN_SIZE", 1024)
+        if self.enabled:
+            app.after_request(self.compress_response)
+        app.extensions["response_compressor"] = self
+
+    def compress_response(self, response: Response):
+        if (
+            response.status_code != 200 or
+            response.direct_passthrough or
+            response.is_streamed or
+            "Content-Encoding" in response.headers or
+            response.mimetype not in COMPRESSIBLE_MIMETYPES
+        ):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+        encoding = negotiate_encoding(available_encodings())
+        if encoding == None:
+            return response
+
+        response.set_data(compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        weaken_etag(response)
+        return response
+
+response_compressor = ResponseCompressor()
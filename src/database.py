@@ -0,0 +1,164 @@
+from flask import Flask, current_app, g, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from metrics import metrics
+from time import perf_counter, time
+from weakref import WeakSet
+
+### Connection pool ###
+
+# Pool settings come from the DB_* environment variables (see app.py and the
+# README). Pools are instrumented so that checkout waits, timeouts and
+# connections opened beyond the pool size show up in the metrics, which is
+# what's needed to size workers against Postgres' max_connections
+
+pool_checkout_time = metrics.histogram("db_pool_checkout_seconds", "Time spent waiting for a database connection")
+pool_timeouts = metrics.counter("db_pool_timeouts_total", "Checkouts that gave up waiting for a database connection")
+pool_overflows = metrics.counter("db_pool_overflow_connections_total", "Connections opened beyond the pool size")
+pool_in_use = metrics.gauge("db_pool_connections_in_use", "Database connections currently checked out")
+pool_idle = metrics.gauge("db_pool_connections_idle", "Database connections open and waiting in the pool")
+pool_overflow = metrics.gauge("db_pool_overflow", "Database connections currently open beyond the pool size")
+
+pools = WeakSet()
+
+class PoolInstrumentation:
+    bind_name = "default"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pools.add(self)
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_timeouts.inc(bind=self.bind_name)
+            raise
+        pool_checkout_time.observe(perf_counter() - start, bind=self.bind_name)
+        return connection
+
+    def _create_connection(self):
+        if self.overflow() > 0:
+            pool_overflows.inc(bind=self.bind_name)
+        return super()._create_connection()
+
+def instrumented_pool(bind_name: str, base: type = QueuePool) -> type:
+    # The name is a class attribute so that it survives the pool being
+    # recreated (which SQLAlchemy does through the pool's class)
+    return type(f"Instrumented{base.__name__}", (PoolInstrumentation, base), { "bind_name": bind_name })
+
+@metrics.collector
+def collect_pool_metrics():
+    for pool in list(pools):
+        pool_in_use.set(pool.checkedout(), bind=pool.bind_name)
+        pool_idle.set(pool.checkedin(), bind=pool.bind_name)
+        pool_overflow.set(max(pool.overflow(), 0), bind=pool.bind_name)
+
+def database_url(url: str, prepared_statements: bool) -> str:
+    # Server-side prepared statements need psycopg 3; psycopg2 always sends
+    # the full query text
+    if not prepared_statements or url == None:
+        return url
+    try:
+        import psycopg
+    except ImportError:
+        raise RuntimeError("The 'psycopg' package is required to use prepared statements")
+    return make_url(url).set(drivername="postgresql+psycopg").render_as_string(hide_password=False)
+
+def async_database_url(url: str) -> str:
+    # The async engine always uses asyncpg, which prepares statements by 
+    # itself
+    try:
+        import asyncpg
+    except ImportError:
+        raise RuntimeError("The 'asyncpg' package is required to use the async server")
+    return make_url(url).set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+
+def async_engine_options(config: dict, bind_name: str) -> dict:
+    connect_args = dict()
+    if config["DB_STATEMENT_TIMEOUT"] > 0:
+        connect_args["server_settings"] = { "statement_timeout": str(config["DB_STATEMENT_TIMEOUT"]) }
+
+    return {
+        "poolclass": instrumented_pool(bind_name, AsyncAdaptedQueuePool),
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+        "connect_args": connect_args,
+    }
+
+def engine_options(config: dict, bind_name: str) -> dict:
+    connect_args = dict()
+    if config["DB_STATEMENT_TIMEOUT"] > 0:
+        connect_args["options"] = f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT']}"
+    if config["DB_PREPARED_STATEMENTS"]:
+        # psycopg prepares a statement once it's been run this many times on
+        # a connection. Every query in the API is a fixed text() statement,
+        # so they all get prepared
+        connect_args["prepare_threshold"] = config["DB_PREPARE_THRESHOLD"]
+
+    return {
+        "poolclass": instrumented_pool(bind_name),
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+        "connect_args": connect_args,
+    }
+
+### Read replica ###
+
+# With REPLICA_DATABASE_URL set, GET requests read from a replica through the
+# "replica" bind. Blueprints and views that only make sense against the
+# primary (like the editor, which reads back what the user just saved) are
+# marked as primary only. After a logged in user writes something, their
+# reads stay on the primary for a while so that they see their own changes
+# even if the replica lags behind
+
+READ_METHODS = ("GET", "HEAD")
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind == None and not self._flushing and g.get("db_use_replica", False):
+            return self._db.engines["replica"]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def primary_only(view):
+    view.db_primary_only = True
+    return view
+
+class ReplicaRouter:
+    def __init__(self):
+        self.enabled = False
+        self.primary_blueprints = set()
+
+    def init_app(self, app: Flask, primary_blueprints: list[str] = []):
+        self.enabled = app.config.get("SQLALCHEMY_BINDS", {}).get("replica") != None
+        self.read_your_writes = app.config.get("REPLICA_READ_YOUR_WRITES", 10.0)
+        self.primary_blueprints = set(primary_blueprints)
+        if self.enabled:
+            app.before_request(self.choose_bind)
+            app.after_request(self.remember_write)
+        app.extensions["replica_router"] = self
+
+    def choose_bind(self):
+        view = current_app.view_functions.get(request.endpoint)
+        g.db_use_replica = (
+            request.method in READ_METHODS and
+            request.blueprint not in self.primary_blueprints and
+            not getattr(view, "db_primary_only", False) and
+            session.get("rw_until", 0) < time()
+        )
+
+    def remember_write(self, response):
+        if request.method not in READ_METHODS and response.status_code < 400 and "user_id" in session:
+            session["rw_until"] = time() + self.read_your_writes
+        return response
+
+replica_router = ReplicaRouter()
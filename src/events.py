@@ -0,0 +1,158 @@
+from flask import Flask
+from sqlalchemy import text
+from queue import Queue, Empty, Full
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from models import db
+from stats import bump_many_level_stats
+import atexit
+import os
+
+### Buffered play/clear ingestion ###
+
+# Play and clear events are the most frequent writes by far, so instead of
+# committing each one separately they can be queued in-process and written
+# in bulk by a background thread. The queue is bounded; once it's full,
+# requests wait a little for room and are then rejected, so a slow database
+# pushes back on clients instead of growing the buffer without limit.
+# Events have already been acknowledged when they're queued, so batches that
+# fail to write are retried with backoff before they're given up on
+
+EVENT_TABLES = {
+    "plays": "LevelPlays",
+    "clears": "LevelClears",
+}
+
+class EventBufferFull(Exception):
+    pass
+
+class EventBuffer:
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.lock = Lock()
+        self.stopping = Event()
+        self.written = 0
+        self.retried = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def init_app(self, app: Flask):
+        self.app = app
+        self.enabled = app.config.get("EVENT_BUFFER", False)
+        self.queue = Queue(maxsize=app.config.get("EVENT_BUFFER_SIZE", 10000))
+        self.batch_size = app.config.get("EVENT_BUFFER_BATCH", 1000)
+        self.flush_interval = app.config.get("EVENT_BUFFER_FLUSH_INTERVAL", 1.0)
+        self.put_timeout = app.config.get("EVENT_BUFFER_PUT_TIMEOUT", 0.5)
+        self.retries = app.config.get("EVENT_BUFFER_RETRIES", 5)
+        self.retry_delay = app.config.get("EVENT_BUFFER_RETRY_DELAY", 0.5)
+        app.extensions["event_buffer"] = self
+        atexit.register(self.stop)
+
+    def record(self, kind: str, level_id: int, user_id: int | None, block: bool = True):
+        # Callers that can't block (like the async handlers) are rejected 
+        # right away when the queue is full
+        self.ensure_started()
+        try:
+            self.queue.put((kind, level_id, user_id), block=block, timeout=self.put_timeout)
+        except Full:
+            self.rejected += 1
+            raise EventBufferFull()
+
+    def ensure_started(self):
+        # The flusher is started lazily so that every forked worker process
+        # gets its own thread instead of inheriting a dead one
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.stopping.clear()
+                self.thread = Thread(target=self.run, name="event-buffer", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = self.take_batch()
+            if len(batch) > 0:
+                self.flush(batch)
+
+    def take_batch(self) -> list:
+        batch = list()
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                if self.stopping.is_set():
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=max(deadline - monotonic(), 0)))
+            except Empty:
+                break
+        return batch
+
+    def flush(self, batch: list):
+        # The batch is written in one transaction, so retrying it after a
+        # failure can't record any event twice
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            with self.app.app_context():
+                try:
+                    write_level_events(batch)
+                    self.written += len(batch)
+                    return
+                except Exception:
+                    db.session.rollback()
+                    if attempt == self.retries:
+                        self.dropped += len(batch)
+                        self.app.logger.exception(f"Dropped {len(batch)} buffered level events")
+                        return
+                    self.retried += 1
+                    self.app.logger.warning(f"Writing {len(batch)} buffered level events failed, retrying in {delay}s", exc_info=True)
+            sleep(delay)
+            delay *= 2
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue != None else 0,
+            "written": self.written,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+        }
+
+def write_level_events(events: list):
+    counts = dict()
+    for kind, table in EVENT_TABLES.items():
+        rows = [(level_id, user_id) for k, level_id, user_id in events if k == kind]
+        if len(rows) == 0:
+            continue
+
+        # Events for levels that have been unpublished in the meantime are
+        # skipped rather than failing the whole batch
+        db.session.execute(text(f"""
+            INSERT INTO {table} (level_id, user_id)
+            SELECT Events.level_id, Events.user_id
+            FROM unnest(CAST(:level_ids AS INT[]), CAST(:user_ids AS INT[])) AS Events(level_id, user_id)
+            WHERE EXISTS (SELECT 1 FROM Levels WHERE Levels.id = Events.level_id)
+        """), {
+            "level_ids": [level_id for level_id, _ in rows],
+            "user_ids": [user_id for _, user_id in rows],
+        })
+        for level_id, _ in rows:
+            plays, clears = counts.get(level_id, (0, 0))
+            counts[level_id] = (plays + (kind == "plays"), clears + (kind == "clears"))
+
+    bump_many_level_stats(counts)
+    db.session.commit()
+
+event_buffer = EventBuffer()
@@ -0,0 +1,294 @@
+from sqlalchemy import text
+from typing import TextIO
+from models import db, level_data_hash, validate_level_data, InvalidLevelData
+from stats import RATINGS
+from levelformat import try_pack_level_data, unpack_level_data
+from leveledits import apply_level_ops
+import base64
+import json
+import struct
+import zlib
+
+### Level export and import ###
+
+# Published levels (with their reviews) and unpublished levels can be
+# exported to and imported from newline-delimited JSON, one level per line,
+# for backups and for moving levels between databases. Users are referred to
+# by username, so that the ids don't need to match between databases; the
+# users themselves are not exported and have to exist in the target database
+#
+# Published levels look like
+#   { "type": "level", "name": ..., "publisher": "username",
+#     "published_at": "2024-01-01T00:00:00", "data": { ... } or null,
+#     "packed": "base64 of the compact format" or null,
+#     "reviews": [{ "user": "username", "rating": 5, "body": ..., "posted_at": ... }] }
+# and unpublished ones (with any pending edits applied) like
+#   { "type": "draft", "name": ..., "creator": "username",
+#     "published": name of the published level or null, "data": { ... } }
+#
+# Exports read through a server-side cursor and imports insert a batch at a
+# time, so neither ever holds more than a batch of levels in memory. Levels
+# that already exist (same name and publisher) are skipped rather than
+# overwritten, so an interrupted import can simply be run again. Play and
+# clear events are not exported
+
+EXPORT_BATCH_SIZE = 1000
+
+def export_levels(output: TextIO, packed: bool = False, drafts: bool = True) -> tuple[int, int]:
+    # Published levels are serialized by Postgres itself, which is a lot
+    # faster than parsing and re-encoding their data here. With `packed`,
+    # levels that have compact data are exported as that instead of JSON
+    levels = 0
+    for line, in db.session.execute(text("""
+        SELECT CAST(json_build_object(
+            'type', 'level',
+            'name', Levels.name,
+            'publisher', Users.username,
+            'published_at', Levels.published_at,
+            'data', CASE WHEN :packed AND Levels.data_packed IS NOT NULL THEN NULL ELSE Levels.data END,
+            'packed', CASE WHEN :packed THEN translate(encode(Levels.data_packed, 'base64'), E'\\n', '') END,
+            'reviews', COALESCE((
+                SELECT json_agg(json_build_object(
+                    'user', Reviewers.username,
+                    'rating', Reviews.rating,
+                    'body', Reviews.body,
+                    'posted_at', Reviews.posted_at
+                ) ORDER BY Reviews.posted_at, Reviews.user_id)
+                FROM Reviews
+                JOIN Users AS Reviewers ON Reviewers.id = Reviews.user_id
+                WHERE Reviews.level_id = Levels.id
+            ), '[]')
+        ) AS TEXT)
+        FROM Levels
+        JOIN Users ON Users.id = Levels.publisher
+        ORDER BY Levels.id
+    """), { "packed": packed }, execution_options={ "yield_per": EXPORT_BATCH_SIZE }):
+        output.write(line)
+        output.write("\n")
+        levels += 1
+
+    # Drafts come after every published level so that importing them can
+    # link them to the levels they were published as
+    draft_count = 0
+    if drafts:
+        for name, creator, published, data, edits in db.session.execute(text("""
+            SELECT UnpublishedLevels.name, Users.username, Levels.name, UnpublishedLevels.data, (
+                SELECT json_agg(UnpublishedLevelEdits.ops ORDER BY UnpublishedLevelEdits.revision)
+                FROM UnpublishedLevelEdits
+                WHERE UnpublishedLevelEdits.level_id = UnpublishedLevels.id
+                    AND UnpublishedLevelEdits.revision > UnpublishedLevels.data_revision
+            )
+            FROM UnpublishedLevels
+            JOIN Users ON Users.id = UnpublishedLevels.creator
+            LEFT JOIN Levels ON Levels.id = UnpublishedLevels.published_id
+            ORDER BY UnpublishedLevels.id
+        """), execution_options={ "yield_per": EXPORT_BATCH_SIZE }):
+            for ops in edits or []:
+                data = apply_level_ops(data, ops)
+            output.write(json.dumps({
+                "type": "draft",
+                "name": name,
+                "creator": creator,
+                "published": published,
+                "data": data,
+            }))
+            output.write("\n")
+            draft_count += 1
+
+    return levels, draft_count
+
+class LevelImporter:
+    def __init__(self, batch_size: int = EXPORT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.levels = list()
+        self.drafts = list()
+        self.counts = {
+            "levels": 0,
+            "reviews": 0,
+            "drafts": 0,
+            "skipped": 0,
+        }
+
+    def run(self, input: TextIO) -> dict[str, int]:
+        for number, line in enumerate(input, start=1):
+            if line.strip() == "":
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {number} is not valid JSON: {e}")
+            if not isinstance(record, dict) or record.get("type") not in ("level", "draft"):
+                raise ValueError(f"Line {number} is not a level")
+
+            if record["type"] == "level":
+                self.levels.append(record)
+                if len(self.levels) >= self.batch_size:
+                    self.flush_levels()
+            else:
+                self.drafts.append(record)
+                if len(self.drafts) >= self.batch_size:
+                    self.flush_drafts()
+
+        self.flush_drafts()
+        return self.counts
+
+    def user_ids(self, usernames: set) -> dict[str, int]:
+        return dict(db.session.execute(text("""
+            SELECT username, id
+            FROM Users
+            WHERE username = ANY(CAST(:usernames AS TEXT[]))
+        """), {
+            "usernames": list(usernames),
+        }).fetchall())
+
+    def level_data(self, record: dict) -> dict | None:
+        # Levels with invalid data are skipped like those of unknown users
+        try:
+            if record.get("data") == None and record.get("packed") != None:
+                return validate_level_data(unpack_level_data(base64.b64decode(record["packed"])))
+            return validate_level_data(record.get("data"))
+        except (InvalidLevelData, ValueError, TypeError, IndexError, struct.error, zlib.error):
+            return None
+
+    def flush_levels(self):
+        records, self.levels = self.levels, list()
+        if len(records) == 0:
+            return
+
+        users = self.user_ids(
+            { record.get("publisher") for record in records if isinstance(record.get("publisher"), str) } |
+            { review["user"] for record in records for review in valid_reviews(record) }
+        )
+        levels = list()
+        for record in records:
+            data = self.level_data(record)
+            if data == None or not valid_name(record.get("name")) or not known_user(users, record.get("publisher")):
+                continue
+            serialized = json.dumps(data)
+            levels.append((record, serialized, try_pack_level_data(data)))
+
+        # Levels that already exist are left alone, and so are their reviews
+        inserted = db.session.execute(text("""
+            INSERT INTO Levels (name, publisher, published_at, data, data_hash, data_packed)
+            SELECT Level.name, Level.publisher, COALESCE(Level.published_at, current_timestamp),
+                CAST(Level.data AS JSONB), Level.hash, Level.packed
+            FROM unnest(
+                CAST(:names AS TEXT[]), CAST(:publishers AS INT[]), CAST(:published_at AS TIMESTAMP[]),
+                CAST(:data AS TEXT[]), CAST(:hashes AS TEXT[]), CAST(:packed AS BYTEA[])
+            ) AS Level(name, publisher, published_at, data, hash, packed)
+            ON CONFLICT ON CONSTRAINT creator_may_only_have_one_published_level_of_same_name DO NOTHING
+            RETURNING id, name, publisher
+        """), {
+            "names": [record["name"] for record, _, _ in levels],
+            "publishers": [users[record["publisher"]] for record, _, _ in levels],
+            "published_at": [record.get("published_at") for record, _, _ in levels],
+            "data": [serialized for _, serialized, _ in levels],
+            "hashes": [level_data_hash(serialized) for _, serialized, _ in levels],
+            "packed": [packed for _, _, packed in levels],
+        }).fetchall()
+        level_ids = { (name, publisher): id for id, name, publisher in inserted }
+
+        reviews = [
+            (level_ids[(record["name"], users[record["publisher"]])], users[review["user"]], review)
+            for record, _, _ in levels
+            if (record["name"], users[record["publisher"]]) in level_ids
+            for review in valid_reviews(record)
+            if review["user"] in users
+        ]
+        # The new levels' stats are created along with their reviews
+        histogram = ", ".join(f"rating_{r}" for r in RATINGS)
+        review_count = db.session.execute(text(f"""
+            WITH Inserted AS (
+                INSERT INTO Reviews (level_id, user_id, rating, body, posted_at)
+                SELECT Review.level_id, Review.user_id, Review.rating, Review.body,
+                    COALESCE(Review.posted_at, current_timestamp)
+                FROM unnest(
+                    CAST(:level_ids AS INT[]), CAST(:user_ids AS INT[]), CAST(:ratings AS INT[]),
+                    CAST(:bodies AS TEXT[]), CAST(:posted_at AS TIMESTAMP[])
+                ) AS Review(level_id, user_id, rating, body, posted_at)
+                ON CONFLICT ON CONSTRAINT only_one_review_per_level_per_user DO NOTHING
+                RETURNING level_id, rating
+            )
+            INSERT INTO LevelStats (level_id, reviews, rating_total, {histogram})
+            SELECT NewLevels.id, COALESCE(LevelReviews.count, 0), COALESCE(LevelReviews.rating_total, 0),
+                {", ".join(f"COALESCE(LevelReviews.rating_{r}, 0)" for r in RATINGS)}
+            FROM unnest(CAST(:new_level_ids AS INT[])) AS NewLevels(id)
+            LEFT JOIN (
+                SELECT level_id, COUNT(*) AS count, SUM(rating) AS rating_total,
+                    {", ".join(f"COUNT(*) FILTER (WHERE rating = {r}) AS rating_{r}" for r in RATINGS)}
+                FROM Inserted
+                GROUP BY level_id
+            ) AS LevelReviews ON LevelReviews.level_id = NewLevels.id
+            RETURNING reviews
+        """), {
+            "level_ids": [level_id for level_id, _, _ in reviews],
+            "user_ids": [user_id for _, user_id, _ in reviews],
+            "ratings": [review["rating"] for _, _, review in reviews],
+            "bodies": [review["body"] for _, _, review in reviews],
+            "posted_at": [review.get("posted_at") for _, _, review in reviews],
+            "new_level_ids": list(level_ids.values()),
+        }).scalars().all()
+        db.session.commit()
+
+        self.counts["levels"] += len(level_ids)
+        self.counts["reviews"] += sum(review_count)
+        self.counts["skipped"] += len(records) - len(level_ids)
+
+    def flush_drafts(self):
+        # Drafts may have been published as levels that are still waiting
+        # in the current batch
+        self.flush_levels()
+        records, self.drafts = self.drafts, list()
+        if len(records) == 0:
+            return
+
+        users = self.user_ids({ record.get("creator") for record in records if isinstance(record.get("creator"), str) })
+        drafts = list()
+        for record in records:
+            data = self.level_data(record)
+            if data == None or not valid_name(record.get("name")) or not known_user(users, record.get("creator")):
+                continue
+            published = record.get("published") if valid_name(record.get("published")) else None
+            drafts.append((record, published, data))
+
+        inserted = db.session.execute(text("""
+            INSERT INTO UnpublishedLevels (creator, name, data, published_id, object_count)
+            SELECT Draft.creator, Draft.name, CAST(Draft.data AS JSONB), Levels.id, Draft.object_count
+            FROM unnest(
+                CAST(:creators AS INT[]), CAST(:names AS TEXT[]), CAST(:data AS TEXT[]),
+                CAST(:published AS TEXT[]), CAST(:object_counts AS INT[])
+            ) AS Draft(creator, name, data, published, object_count)
+            LEFT JOIN Levels ON Levels.name = Draft.published AND Levels.publisher = Draft.creator
+            ON CONFLICT ON CONSTRAINT creator_may_only_have_one_created_level_of_same_name DO NOTHING
+        """), {
+            "creators": [users[record["creator"]] for record, _, _ in drafts],
+            "names": [record["name"] for record, _, _ in drafts],
+            "data": [json.dumps(data) for _, _, data in drafts],
+            "published": [published for _, published, _ in drafts],
+            "object_counts": [len(data["objects"]) for _, _, data in drafts],
+        }).rowcount
+        db.session.commit()
+
+        self.counts["drafts"] += inserted
+        self.counts["skipped"] += len(records) - inserted
+
+def known_user(users: dict[str, int], name) -> bool:
+    return isinstance(name, str) and name in users
+
+def valid_name(name) -> bool:
+    return isinstance(name, str) and 0 < len(name) <= 30
+
+def valid_reviews(record: dict) -> list[dict]:
+    # Reviews that wouldn't pass the checks in sql/reset.sql are dropped
+    reviews = record.get("reviews")
+    if not isinstance(reviews, list):
+        return []
+    return [
+        review for review in reviews
+        if isinstance(review, dict) and isinstance(review.get("user"), str)
+        and isinstance(review.get("rating"), int) and 0 <= review["rating"] <= 5
+        and isinstance(review.get("body"), str) and len(review["body"]) <= 200
+    ]
+
+def import_levels(input: TextIO, batch_size: int = EXPORT_BATCH_SIZE) -> dict[str, int]:
+    return LevelImporter(batch_size).run(input)
@@ -0,0 +1,164 @@
+from sqlalchemy import text
+from models import db, InvalidLevelData, TRANSIENT_OBJECT_TYPES
+from models import validate_level_coordinate, validate_level_object, validate_level_object_type
+import json
+
+### Incremental level edits ###
+
+# Instead of rewriting the whole level on every save, the editor can send a
+# list of operations against the revision it last saw. Operations are
+# appended to UnpublishedLevelEdits, and the level's data column is a
+# snapshot as of `data_revision` that gets brought up to date (compacted)
+# once enough edits have piled up, or before the level is published.
+#
+# Supported operations:
+#   { "op": "add", "x": 0, "y": 0, "type": "block" }
+#   { "op": "remove", "x": 0, "y": 0, "type": "block" }
+#   { "op": "move", "type": "block", "from": { "x": 0, "y": 0 }, "to": { "x": 32, "y": 0 } }
+#   { "op": "set", "playerX": 0, "playerY": 0, "endX": 0, "endY": 0 } (any subset)
+
+LEVEL_SET_KEYS = ("playerX", "playerY", "endX", "endY")
+# Bigger changes than this should be saved as full level data instead
+MAX_LEVEL_EDIT_OPS = 1000
+
+def validate_level_point(point) -> dict:
+    if not isinstance(point, dict):
+        raise InvalidLevelData("Positions must be objects")
+    return {
+        "x": validate_level_coordinate(point.get("x"), "x"),
+        "y": validate_level_coordinate(point.get("y"), "y"),
+    }
+
+def validate_level_ops(ops) -> tuple[list, int]:
+    # Returns the operations normalized the same way as full level data, and
+    # how many objects they add to the level at most. Removals don't count
+    # against that, since the objects they remove might not exist
+    if not isinstance(ops, list):
+        raise InvalidLevelData("Edits must be a list of operations")
+    if len(ops) > MAX_LEVEL_EDIT_OPS:
+        raise InvalidLevelData(f"At most {MAX_LEVEL_EDIT_OPS} edits can be saved at once")
+
+    result = list()
+    added = 0
+    for op in ops:
+        kind = op.get("op") if isinstance(op, dict) else None
+        match kind:
+            case "add" | "remove":
+                obj = validate_level_object(op)
+                if obj != None:
+                    result.append({ "op": kind, **obj })
+                    if kind == "add":
+                        added += 1
+            case "move":
+                type = validate_level_object_type(op.get("type"))
+                if type not in TRANSIENT_OBJECT_TYPES:
+                    result.append({
+                        "op": kind,
+                        "type": type,
+                        "from": validate_level_point(op.get("from")),
+                        "to": validate_level_point(op.get("to")),
+                    })
+            case "set":
+                result.append({
+                    "op": kind,
+                    **{ key: validate_level_coordinate(op[key], key) for key in LEVEL_SET_KEYS if key in op },
+                })
+            case _:
+                raise InvalidLevelData(f"Unknown level edit operation '{kind}'")
+
+    return result, added
+
+def find_object(objects: list, type: str, x, y) -> int | None:
+    for i, obj in enumerate(objects):
+        if obj.get("type") == type and obj.get("x") == x and obj.get("y") == y:
+            return i
+    return None
+
+def apply_level_ops(data: dict, ops: list) -> dict:
+    # Removing or moving an object that doesn't exist is not an error; the
+    # end result is the same as if it had been removed already
+    data = dict(data)
+    objects = list(data.get("objects") or [])
+    for op in ops:
+        match op["op"]:
+            case "add":
+                objects.append({ "x": op["x"], "y": op["y"], "type": op["type"] })
+            case "remove":
+                i = find_object(objects, op["type"], op["x"], op["y"])
+                if i != None:
+                    objects.pop(i)
+            case "move":
+                i = find_object(objects, op["type"], op["from"]["x"], op["from"]["y"])
+                if i != None:
+                    objects[i] = { "x": op["to"]["x"], "y": op["to"]["y"], "type": op["type"] }
+            case "set":
+                for key in LEVEL_SET_KEYS:
+                    if key in op:
+                        data[key] = op[key]
+    data["objects"] = objects
+    return data
+
+def load_wip_level_data(level_id: int, creator: int, lock: bool = False) -> tuple[dict, int, int] | None:
+    result = db.session.execute(text(f"""
+        SELECT data, revision, data_revision
+        FROM UnpublishedLevels
+        WHERE id = :level_id AND creator = :creator
+        {"FOR UPDATE" if lock else ""}
+    """), {
+        "level_id": level_id,
+        "creator": creator,
+    }).fetchone()
+    if result == None:
+        return None
+
+    data, revision, data_revision = result
+    if revision > data_revision:
+        for ops, in db.session.execute(text("""
+            SELECT ops
+            FROM UnpublishedLevelEdits
+            WHERE level_id = :level_id AND revision > :data_revision
+            ORDER BY revision
+        """), {
+            "level_id": level_id,
+            "data_revision": data_revision,
+        }):
+            data = apply_level_ops(data, ops)
+
+    return data, revision, data_revision
+
+def compact_level_edits(level_id: int, creator: int):
+    result = load_wip_level_data(level_id, creator, lock=True)
+    if result == None:
+        return
+    data, revision, data_revision = result
+    if revision == data_revision:
+        return
+
+    db.session.execute(text("""
+        UPDATE UnpublishedLevels
+        SET data = :data, data_revision = :revision, object_count = :object_count
+        WHERE id = :level_id
+    """), {
+        "level_id": level_id,
+        "data": json.dumps(data),
+        "revision": revision,
+        "object_count": len(data["objects"]),
+    })
+    db.session.execute(text("""
+        DELETE FROM UnpublishedLevelEdits
+        WHERE level_id = :level_id AND revision <= :revision
+    """), {
+        "level_id": level_id,
+        "revision": revision,
+    })
+    db.session.commit()
+
+def compact_all_level_edits() -> int:
+    levels = db.session.execute(text("""
+        SELECT id, creator
+        FROM UnpublishedLevels
+        WHERE revision > data_revision
+    """)).fetchall()
+    for level_id, creator in levels:
+        compact_level_edits(level_id, creator)
+    return len(levels)
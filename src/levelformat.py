@@ -0,0 +1,121 @@
+from sqlalchemy import text
+from models import db
+import struct
+import zlib
+
+### Compact level format ###
+
+# Levels can also be sent in a compact binary format instead of JSON. The
+# format starts with a magic string and a version byte, followed by a zlib
+# stream containing (all little-endian):
+#
+#   flags: u8 (bit 0: player position present, bit 1: end position present)
+#   padding: u8
+#   playerX, playerY, endX, endY: i16
+#   object count: u32
+#   object x coordinates: i16 * count
+#   object y coordinates: i16 * count
+#   object types: u8 * count
+#
+# Storing the objects as columns makes them compress well and lets the engine
+# decode them with a single pass over each column. Coordinates are rounded to
+# whole pixels
+
+LEVEL_FORMAT_MIMETYPE = "application/x-platformer-level"
+LEVEL_FORMAT_MAGIC = b"PLVL"
+LEVEL_FORMAT_VERSION = 1
+LEVEL_FORMAT_OBJECT_TYPES = ["block", "spike", "ground-spike"]
+
+HEADER = struct.Struct("<BxhhhhI")
+
+def pack_level_data(data: dict) -> bytes:
+    flags = 0
+    if data.get("playerX") != None and data.get("playerY") != None:
+        flags |= 1
+    if data.get("endX") != None and data.get("endY") != None:
+        flags |= 2
+
+    objects = data.get("objects") or []
+    try:
+        header = HEADER.pack(
+            flags,
+            round(data["playerX"]) if flags & 1 else 0,
+            round(data["playerY"]) if flags & 1 else 0,
+            round(data["endX"]) if flags & 2 else 0,
+            round(data["endY"]) if flags & 2 else 0,
+            len(objects),
+        )
+        xs = struct.pack(f"<{len(objects)}h", *(round(obj["x"]) for obj in objects))
+        ys = struct.pack(f"<{len(objects)}h", *(round(obj["y"]) for obj in objects))
+        types = bytes(LEVEL_FORMAT_OBJECT_TYPES.index(obj["type"]) for obj in objects)
+    except (struct.error, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Level can't be packed: {e}")
+
+    payload = zlib.compress(header + xs + ys + types, 9)
+    return LEVEL_FORMAT_MAGIC + bytes([LEVEL_FORMAT_VERSION]) + payload
+
+def try_pack_level_data(data: dict) -> bytes | None:
+    try:
+        return pack_level_data(data)
+    except ValueError:
+        return None
+
+def unpack_level_data(packed: bytes) -> dict:
+    if packed[:4] != LEVEL_FORMAT_MAGIC or packed[4] != LEVEL_FORMAT_VERSION:
+        raise ValueError("Unsupported level format")
+
+    payload = zlib.decompress(packed[5:])
+    flags, player_x, player_y, end_x, end_y, count = HEADER.unpack_from(payload)
+    xs = struct.unpack_from(f"<{count}h", payload, HEADER.size)
+    ys = struct.unpack_from(f"<{count}h", payload, HEADER.size + count * 2)
+    types = payload[HEADER.size + count * 4:HEADER.size + count * 5]
+
+    data = {
+        "objects": [
+            { "x": x, "y": y, "type": LEVEL_FORMAT_OBJECT_TYPES[type] }
+            for x, y, type in zip(xs, ys, types)
+        ],
+    }
+    if flags & 1:
+        data["playerX"], data["playerY"] = player_x, player_y
+    if flags & 2:
+        data["endX"], data["endY"] = end_x, end_y
+    return data
+
+def pack_stored_levels(batch_size: int = 500) -> tuple[int, int]:
+    # Levels published before the compact format existed only have JSON data;
+    # pack them a batch at a time. Levels that can't be packed (for example
+    # because they have coordinates out of range) are left as JSON only
+    packed, skipped = 0, 0
+    after_id = 0
+    while True:
+        rows = db.session.execute(text("""
+            SELECT id, data
+            FROM Levels
+            WHERE data_packed IS NULL AND id > :after_id
+            ORDER BY id
+            LIMIT :limit
+        """), {
+            "after_id": after_id,
+            "limit": batch_size,
+        }).fetchall()
+        if len(rows) == 0:
+            return packed, skipped
+
+        updates = [(id, try_pack_level_data(data)) for id, data in rows]
+        updates = [(id, data) for id, data in updates if data != None]
+        if len(updates) > 0:
+            db.session.execute(text("""
+                UPDATE Levels
+                SET data_packed = Packed.data
+                FROM unnest(CAST(:ids AS INT[]), CAST(:data AS BYTEA[])) AS Packed(id, data)
+                WHERE Levels.id = Packed.id
+            """), {
+                "ids": [id for id, _ in updates],
+                "data": [data for _, data in updates],
+            })
+            db.session.commit()
+
+        packed += len(updates)
+        skipped += len(rows) - len(updates)
+        after_id = rows[-1][0]
@@ -0,0 +1,68 @@
+from flask import Flask
+from sqlalchemy import text
+from models import db
+import random
+
+### Level name generation ###
+
+# New levels get a random name made of a few short words. The word list is
+# loaded once into a tuple, and a batch of candidate names is handed to the
+# database at once so that picking one the creator hasn't used yet takes a
+# single statement no matter how many levels they already have. The word
+# list takes a while to load, so it's only loaded once it's needed (or when
+# the app is warmed up, see warmup.py)
+
+LEVEL_NAME_WORDS = 4
+LEVEL_NAME_MAX_WORD_LENGTH = 6
+LEVEL_NAME_CANDIDATES = 16
+# A batch only fails to produce a free name if every candidate is taken, or
+# a concurrent request took the picked one first
+LEVEL_NAME_ATTEMPTS = 3
+
+class LevelNameGenerator:
+    def __init__(self):
+        self.words = None
+
+    def init_app(self, app: Flask):
+        app.extensions["level_names"] = self
+
+    def load_words(self):
+        from wonderwords import RandomWord
+        # RandomWord.filter() checks word lengths by removing words from a list
+        # one at a time, which is slow on the full list; filtering here instead
+        # is instant
+        self.words = tuple(sorted(
+            word for word in RandomWord().filter()
+            if len(word) <= LEVEL_NAME_MAX_WORD_LENGTH
+        ))
+
+    def random_name(self) -> str:
+        if self.words == None:
+            self.load_words()
+        return ' '.join(random.sample(self.words, LEVEL_NAME_WORDS))
+
+    def create_level(self, creator: int, data: str) -> int | None:
+        for _ in range(LEVEL_NAME_ATTEMPTS):
+            id = db.session.execute(text("""
+                INSERT INTO UnpublishedLevels (creator, name, data)
+                SELECT :creator, Candidates.name, :data
+                FROM unnest(CAST(:names AS TEXT[])) WITH ORDINALITY AS Candidates(name, i)
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM UnpublishedLevels
+                    WHERE creator = :creator AND name = Candidates.name
+                )
+                ORDER BY Candidates.i
+                LIMIT 1
+                ON CONFLICT ON CONSTRAINT creator_may_only_have_one_created_level_of_same_name DO NOTHING
+                RETURNING id
+            """), {
+                "creator": creator,
+                "names": [self.random_name() for _ in range(LEVEL_NAME_CANDIDATES)],
+                "data": data,
+            }).scalar()
+            if id != None:
+                return id
+        return None
+
+level_names = LevelNameGenerator()
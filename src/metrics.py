@@ -0,0 +1,141 @@
+from flask import Flask, Response
+from threading import Lock
+
+### Metrics ###
+
+# A small registry of counters, gauges and histograms that can be rendered in
+# the Prometheus text format on /metrics. Values are kept per process, so
+# when running several workers each one has to be scraped on its own (or the
+# metrics summed over them). Things that already keep their own statistics
+# (like the cache or the worker pools) are read when rendering through
+# collectors instead of being duplicated here
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(labels: dict) -> str:
+    if len(labels) == 0:
+        return ""
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = Lock()
+        self.values = dict()
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return self.header() + [
+            f"{self.name}{format_labels(dict(labels))} {value}"
+            for labels, value in values
+        ]
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.items())
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[tuple(labels.items())] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.items())
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = ([0] * len(self.buckets), 0, 0.0)
+            buckets, count, total = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    buckets[i] += 1
+            self.values[key] = (buckets, count + 1, total + value)
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = [(labels, (list(buckets), count, total)) for labels, (buckets, count, total) in self.values.items()]
+        lines = self.header()
+        for labels, (buckets, count, total) in values:
+            labels = dict(labels)
+            for bound, n in zip(self.buckets, buckets):
+                lines.append(f"{self.name}_bucket{format_labels({ **labels, 'le': bound })} {n}")
+            lines.append(f"{self.name}_bucket{format_labels({ **labels, 'le': '+Inf' })} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = dict()
+        self.collectors = list()
+        self.lock = Lock()
+
+    def init_app(self, app: Flask):
+        # The endpoint is opt-in since it's meant to be scraped from inside
+        # the deployment, not by players
+        if app.config.get("METRICS", False):
+            app.add_url_rule("/metrics", "metrics", self.metrics_endpoint)
+        app.extensions["metrics"] = self
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.register(Counter(name, help))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self.register(Gauge(name, help))
+
+    def histogram(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def collector(self, fn):
+        # Collectors are called before rendering to update gauges from
+        # statistics kept elsewhere
+        self.collectors.append(fn)
+        return fn
+
+    def stats_collector(self, prefix: str, stats, **labels):
+        # Exposes a stats() dictionary of numbers as gauges named
+        # "<prefix>_<key>"
+        def collect():
+            for key, value in stats().items():
+                self.gauge(f"{prefix}_{key}", f"{key.replace('_', ' ').capitalize()} ({prefix})").set(value, **labels)
+        self.collector(collect)
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            collect()
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = list()
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def metrics_endpoint(self):
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+metrics = MetricsRegistry()
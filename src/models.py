@@ -2,6 +2,9 @@
 from flask import request, session
 from dataclasses import dataclass
 from flask_sqlalchemy import SQLAlchemy
+from database import RoutingSession
+from hashlib import sha256
+from math import isfinite
 import json
 
 ### Models ###
@@ -14,6 +17,11 @@ class CSRFCheck:
 class UpdateLevelMetadata(CSRFCheck):
     name: str
 
+@dataclass
+class LevelPatch(CSRFCheck):
+    revision: int
+    ops: list
+
 @dataclass
 class Review(CSRFCheck):
     rating: int
@@ -28,6 +36,70 @@ class Login(CSRFCheck):
     username: str
     password: str
 
+### Level data ###
+
+# Level data is validated and normalized once when it's written, so that 
+# everything reading it back can trust its shape
+
+LEVEL_SIZE = 704
+OBJECT_UNIT = 32
+MAX_LEVEL_OBJECTS = 10000
+LEVEL_OBJECT_TYPES = ("block", "spike", "ground-spike")
+# Objects the engine creates on its own (from the end position or while 
+# playing) that may end up in saved data. They're dropped instead of stored
+TRANSIENT_OBJECT_TYPES = ("goal", "player", "particles")
+
+class InvalidLevelData(ValueError):
+    pass
+
+def validate_level_coordinate(value, name: str) -> int:
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or not isfinite(value):
+        raise InvalidLevelData(f"'{name}' must be a number")
+    if not -OBJECT_UNIT <= value <= LEVEL_SIZE:
+        raise InvalidLevelData(f"'{name}' is outside of the level")
+    return round(value)
+
+def validate_level_object_type(value) -> str:
+    if value not in LEVEL_OBJECT_TYPES and value not in TRANSIENT_OBJECT_TYPES:
+        raise InvalidLevelData(f"Unknown object type '{value}'")
+    return value
+
+def validate_level_object(obj) -> dict | None:
+    if not isinstance(obj, dict):
+        raise InvalidLevelData("Level objects must be objects")
+    type = validate_level_object_type(obj.get("type"))
+    if type in TRANSIENT_OBJECT_TYPES:
+        return None
+    return {
+        "x": validate_level_coordinate(obj.get("x"), "x"),
+        "y": validate_level_coordinate(obj.get("y"), "y"),
+        "type": type,
+    }
+
+def validate_level_data(data) -> dict:
+    if not isinstance(data, dict):
+        raise InvalidLevelData("Level data must be an object")
+
+    result = dict()
+    for key in ("playerX", "playerY", "endX", "endY"):
+        if data.get(key) != None:
+            result[key] = validate_level_coordinate(data[key], key)
+
+    objects = data.get("objects") or []
+    if not isinstance(objects, list):
+        raise InvalidLevelData("Level objects must be a list")
+    objects = [obj for obj in map(validate_level_object, objects) if obj != None]
+    if len(objects) > MAX_LEVEL_OBJECTS:
+        raise InvalidLevelData(f"Levels can have at most {MAX_LEVEL_OBJECTS} objects")
+    result["objects"] = objects
+
+    return result
+
+def level_data_hash(data: str) -> str:
+    # Used as the ETag of published level data, so it's stored alongside the 
+    # level instead of being recomputed on every request
+    return sha256(data.encode()).hexdigest()[:32]
+
 def make_error_response(code: int, reason: str):
     return json.dumps({
         "code": code,
@@ -47,4 +119,4 @@ def check_logged_in():
 def check_logged_in_mut():
     return check_csrf() and ('user_id' in session)
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={ "class_": RoutingSession })
@@ -0,0 +1,80 @@
+from flask import Blueprint, Response, current_app, render_template, session
+from sqlalchemy import text
+from models import check_logged_in, make_error_response, db
+from cache import response_cache
+from database import primary_only
+
+pages = Blueprint('pages', __name__, template_folder='templates')
+
+@pages.route("/star-svg")
+def asset_star_svg():
+    return render_template("star.svg.j2")
+
+@pages.route("/")
+def index():
+    return render_template("pages/home.html.j2")
+
+@pages.route("/user")
+def userpage():
+    return render_template("pages/userpage.html.j2")
+
+@pages.route("/edit/<int:id>")
+@primary_only
+def edit_level(id: int):
+    if not check_logged_in():
+        return make_error_response(403, 'You need to log in to create levels')
+    
+    name, published_id = db.session.execute(text("""
+        SELECT UnpublishedLevels.name, UnpublishedLevels.published_id
+        FROM Users
+        LEFT JOIN UnpublishedLevels ON Users.id = UnpublishedLevels.creator
+        WHERE Users.id = :user_id AND UnpublishedLevels.id = :level_id
+        GROUP BY UnpublishedLevels.name, UnpublishedLevels.published_id
+    """), {
+        "user_id": session["user_id"],
+        "level_id": id,
+    }).fetchone()
+    
+    return render_template("pages/editor.html.j2", level_id=id, level_name=name, published_id=published_id)
+
+@pages.route("/level/<int:id>")
+def play_level(id: int):
+    # The page is the same for every visitor who isn't logged in, so those 
+    # are served from the cache
+    anonymous = not check_logged_in()
+    if anonymous:
+        cached = response_cache.get("level-pages", id)
+        if cached != None:
+            return Response(cached, mimetype="text/html")
+
+    # Whether the user has reviewed the level is resolved in the same query 
+    # through the unique (level_id, user_id) index on Reviews
+    result = db.session.execute(text("""
+        SELECT Levels.name, Levels.published_at, Users.username,
+            EXISTS (
+                SELECT 1
+                FROM Reviews
+                WHERE Reviews.level_id = Levels.id AND Reviews.user_id = :user_id
+            )
+        FROM Levels
+        LEFT JOIN Users ON Users.id = Levels.publisher
+        WHERE Levels.id = :level_id
+    """), {
+        "level_id": id,
+        "user_id": session.get("user_id"),
+    }).fetchone()
+    if result == None:
+        return make_error_response(404, 'Level not found')
+    name, published_at, publisher, user_has_review = result
+
+    page = render_template(
+        "pages/level.html.j2",
+        level_id=id,
+        level_name=name,
+        level_creator=publisher,
+        level_published_at=published_at,
+        level_has_been_reviewed_by_current_user=user_has_review,
+    )
+    if anonymous:
+        response_cache.set("level-pages", id, page.encode(), current_app.config["LEVEL_PAGE_CACHE_TTL"])
+    return page
@@ -0,0 +1,36 @@
+from flask import abort, request
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+import binascii
+import json
+
+### Keyset pagination ###
+
+# Pages are addressed by an opaque cursor holding the sort key of the last
+# row on the previous page, so fetching any page is an index range scan no
+# matter how deep into the list it is
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+def get_page_size() -> int:
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400, "Page size must be a number")
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def encode_cursor(*values) -> str:
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str, length: int) -> list:
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        abort(400, "Invalid page cursor")
+    if not isinstance(values, list) or len(values) != length:
+        abort(400, "Invalid page cursor")
+    if not all(isinstance(v, (str, int, float)) for v in values):
+        abort(400, "Invalid page cursor")
+    return values
@@ -0,0 +1,41 @@
+from flask import Flask
+from werkzeug.security import check_password_hash, generate_password_hash
+from workers import WorkerPool
+
+### Password hashing ###
+
+# Hashing is deliberately slow, so it's done in a worker pool. The hash
+# method (and its cost parameters) is configurable with PASSWORD_HASH_METHOD
+# using Werkzeug's syntax, for example "scrypt:32768:8:1" or
+# "pbkdf2:sha256:600000". Hashes made with other parameters are still
+# accepted and get rehashed the next time the user logs in
+
+password_pool = WorkerPool("password-hash")
+
+class PasswordHasher:
+    def __init__(self):
+        self.method = None
+        self.expanded_method = None
+
+    def init_app(self, app: Flask):
+        self.method = app.config.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+        self.expanded_method = None
+        password_pool.init_app(app, "PASSWORD_HASH")
+        app.extensions["password_hasher"] = self
+
+    def hash(self, password: str) -> str:
+        return password_pool.run(generate_password_hash, password, self.method)
+
+    def verify(self, pw_hash: str, password: str) -> bool:
+        return password_pool.run(check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash: str) -> bool:
+        # Werkzeug hashes look like "method$salt$hash", where the method has
+        # every parameter filled in (so "scrypt" is stored as
+        # "scrypt:32768:8:1"). Rather than repeating Werkzeug's defaults
+        # here, the configured method is expanded by hashing once with it
+        if self.expanded_method == None:
+            self.expanded_method = self.hash("").split("$", 1)[0]
+        return pw_hash.split("$", 1)[0] != self.expanded_method
+
+password_hasher = PasswordHasher()
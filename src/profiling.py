@@ -0,0 +1,84 @@
+from flask import Flask, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Engine, event
+from metrics import metrics
+from time import perf_counter
+
+### Request profiling ###
+
+# With PROFILING=1, every request records how long it took, how many SQL
+# statements it ran and how long those took in total. The numbers are added
+# to the response as a Server-Timing header (which shows up in the browser's
+# dev tools) and to the per-endpoint histograms on /metrics. Statements
+# slower than SLOW_QUERY_THRESHOLD milliseconds are logged along with the
+# endpoint that ran them
+
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+request_duration = metrics.histogram("http_request_duration_seconds", "Time spent handling requests")
+request_statements = metrics.histogram("http_request_sql_statements", "SQL statements run per request", STATEMENT_BUCKETS)
+request_db_time = metrics.histogram("http_request_db_seconds", "Time spent in SQL statements per request")
+slow_statements = metrics.counter("sql_slow_statements_total", "SQL statements slower than the slow query threshold")
+
+class RequestProfiler:
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+
+    def init_app(self, app: Flask, db: SQLAlchemy):
+        self.app = app
+        self.enabled = app.config.get("PROFILING", False)
+        self.slow_query_threshold = app.config.get("SLOW_QUERY_THRESHOLD", 100) / 1000
+        if self.enabled:
+            app.before_request(self.start_request)
+            app.after_request(self.finish_request)
+            with app.app_context():
+                for engine in db.engines.values():
+                    self.profile_engine(engine)
+        app.extensions["request_profiler"] = self
+
+    def profile_engine(self, engine: Engine):
+        if self.enabled:
+            event.listen(engine, "before_cursor_execute", self.before_statement)
+            event.listen(engine, "after_cursor_execute", self.after_statement)
+
+    def start_request(self):
+        g.profile_start = perf_counter()
+        g.profile_statements = 0
+        g.profile_db_time = 0.0
+
+    def finish_request(self, response):
+        if "profile_start" not in g:
+            return response
+
+        duration = perf_counter() - g.profile_start
+        endpoint = request.endpoint or "unknown"
+        request_duration.observe(duration, endpoint=endpoint)
+        request_statements.observe(g.profile_statements, endpoint=endpoint)
+        request_db_time.observe(g.profile_db_time, endpoint=endpoint)
+
+        response.headers.add(
+            "Server-Timing",
+            f'db;dur={g.profile_db_time * 1000:.1f};desc="{g.profile_statements} SQL statements", '
+            f"total;dur={duration * 1000:.1f}"
+        )
+        return response
+
+    def before_statement(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profile_start", []).append(perf_counter())
+
+    def after_statement(self, conn, cursor, statement, parameters, context, executemany):
+        duration = perf_counter() - conn.info["profile_start"].pop()
+        endpoint = None
+        if has_request_context() and "profile_start" in g:
+            g.profile_statements += 1
+            g.profile_db_time += duration
+            endpoint = request.endpoint
+
+        if duration >= self.slow_query_threshold:
+            slow_statements.inc()
+            self.app.logger.warning(
+                f"Slow SQL statement ({duration * 1000:.1f} ms, endpoint {endpoint}): {' '.join(statement.split())}"
+            )
+
+request_profiler = RequestProfiler()
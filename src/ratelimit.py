@@ -0,0 +1,205 @@
+from flask import Flask, Request, current_app, request, session
+from models import make_error_response
+from cache import redis_from_url
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+import math
+
+### Rate limiting ###
+
+# Endpoints that write to the database on every request (marking levels as
+# played or cleared, and saving in the editor) are rate limited with token
+# buckets. Each quota is configured as `RATE_LIMIT_<NAME>=<requests>/<seconds>`:
+# a client can make that many requests in a burst, and gets another one back
+# every `seconds / requests` seconds. Requests over the quota get a 429 with a
+# Retry-After header without touching the database
+#
+# Clients are told apart by their user id when logged in and by their IP
+# address otherwise. Anonymous session ids aren't used, since a client can
+# get a new one just by dropping its cookie
+#
+# The `local` backend keeps the buckets in each worker process, so with N
+# workers a client can get up to N times the quota. The `redis` backend
+# shares them between every worker
+
+class LocalRateLimitBackend:
+    def __init__(self, max_buckets: int):
+        # Buckets are moved to the end when used, so the ones at the front
+        # have been idle the longest (and are most likely full again anyway)
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        # Takes a token from the bucket, returning 0 if there was one or the
+        # number of seconds until there will be
+        now = monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            "buckets": len(self.buckets),
+        }
+
+# The same as LocalRateLimitBackend.take(), run atomically on the Redis
+# server using its clock. Buckets expire once they would be full again
+REDIS_TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated_at", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1)
+return tostring(wait)
+"""
+
+class RedisRateLimitBackend:
+    def __init__(self, url: str, prefix: str = "ratelimit:"):
+        self.client = redis_from_url(url)
+        self.prefix = prefix
+        self.take_script = self.client.register_script(REDIS_TAKE_SCRIPT)
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        return float(self.take_script(keys=[self.prefix + key], args=[capacity, rate]))
+
+    def stats(self) -> dict:
+        return {}
+
+def parse_quota(value: str) -> tuple[float, float]:
+    # "<requests>/<seconds>" to the bucket's capacity and its refill rate in
+    # tokens per second
+    try:
+        requests, seconds = (float(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid rate limit '{value}', expected '<requests>/<seconds>'")
+    if requests < 1 or seconds <= 0:
+        raise ValueError(f"Invalid rate limit '{value}'")
+    return requests, requests / seconds
+
+def rate_limit(quota: str):
+    # Counts requests to the view towards the RATE_LIMIT_<QUOTA> quota
+    def decorator(view):
+        view.rate_limit = quota
+        return view
+    return decorator
+
+class RateLimiter:
+    def __init__(self):
+        self.backend = None
+        self.quotas = dict()
+        self.limited = dict()
+        self.errors = 0
+
+    def init_app(self, app: Flask, quotas: list[str] = []):
+        backend = app.config.get("RATE_LIMIT_BACKEND", "local")
+        if backend == "local":
+            self.backend = LocalRateLimitBackend(app.config.get("RATE_LIMIT_MAX_BUCKETS", 100000))
+        elif backend == "redis":
+            self.backend = RedisRateLimitBackend(app.config["RATE_LIMIT_REDIS_URL"])
+        elif backend != "none":
+            raise ValueError(f"Unknown rate limit backend '{backend}'")
+        self.quotas = {
+            quota: parse_quota(app.config[f"RATE_LIMIT_{quota.upper()}"])
+            for quota in quotas
+        }
+        self.limited = { quota: 0 for quota in quotas }
+        if self.backend != None:
+            app.before_request(self.check)
+        app.extensions["rate_limiter"] = self
+
+    def client_key(self) -> str:
+        user_id = session.get("user_id")
+        if user_id != None:
+            return f"user:{user_id}"
+        return f"ip:{request.remote_addr}"
+
+    def check(self):
+        view = current_app.view_functions.get(request.endpoint)
+        quota = getattr(view, "rate_limit", None)
+        if quota == None:
+            return None
+
+        capacity, rate = self.quotas[quota]
+        try:
+            wait = self.backend.take(f"{quota}:{self.client_key()}", capacity, rate)
+        except Exception:
+            # A shared backend being down shouldn't take the endpoints down
+            # with it, so requests are let through until it's back
+            self.errors += 1
+            current_app.logger.exception("Rate limit backend failed, letting the request through")
+            return None
+        if wait <= 0:
+            return None
+
+        self.limited[quota] += 1
+        body, code = make_error_response(429, 'Too many requests, try again later')
+        return body, code, { "Retry-After": str(math.ceil(wait)) }
+
+    def stats(self) -> dict:
+        stats = self.backend.stats() if self.backend != None else {}
+        for quota, limited in self.limited.items():
+            stats[f"{quota}_limited"] = limited
+        stats["backend_errors"] = self.errors
+        return stats
+
+rate_limiter = RateLimiter()
+
+### Request body limits ###
+
+# Flask's MAX_CONTENT_LENGTH applies to every request. Blueprints that take
+# bigger bodies (like the editor, which sends whole levels) get their own
+# limit instead. Bodies whose Content-Length is over the limit get a 413
+# before the view runs. Chunked bodies (without a Content-Length) are cut off
+# at the limit by Werkzeug while they're read, so they fail to parse instead
+
+class BodySizeLimitedRequest(Request):
+    @property
+    def max_content_length(self) -> int | None:
+        if not current_app:
+            return None
+        return current_app.extensions["body_size_limits"].limit(self.blueprint)
+
+class BodySizeLimits:
+    def __init__(self):
+        self.blueprint_limits = dict()
+
+    def init_app(self, app: Flask, blueprint_limits: dict[str, int] = {}):
+        self.blueprint_limits = dict(blueprint_limits)
+        app.request_class = BodySizeLimitedRequest
+        app.before_request(self.check_content_length)
+        app.extensions["body_size_limits"] = self
+
+    def limit(self, blueprint: str | None) -> int | None:
+        if blueprint in self.blueprint_limits:
+            return self.blueprint_limits[blueprint]
+        return current_app.config["MAX_CONTENT_LENGTH"]
+
+    def check_content_length(self):
+        limit = request.max_content_length
+        if limit != None and request.content_length != None and request.content_length > limit:
+            return make_error_response(413, f"Request body can be at most {limit} bytes")
+        return None
+
+body_size_limits = BodySizeLimits()
@@ -0,0 +1,234 @@
+from flask import Flask, Request, Response, session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from cache import redis_from_url
+from collections import OrderedDict
+from secrets import token_urlsafe
+from threading import Lock
+from time import monotonic
+import re
+
+### Server-side sessions ###
+
+# With SESSION_BACKEND set to `memory` or `redis`, session data (the logged
+# in user's id, name, icon and CSRF token) is kept on the server and the
+# cookie only holds a random session id. Logging out deletes the stored
+# session, so the id stops working right away instead of the cookie staying
+# valid for as long as someone keeps a copy of it
+#
+# With the shared Redis store every worker also keeps a small LRU of the
+# sessions it has seen recently, so most requests (including rendering the
+# "Logged in as" header) don't touch Redis at all. Changes made by another
+# worker, like logging out, show up once the entry is older than
+# SESSION_CACHE_TTL seconds
+#
+# The default `cookie` backend keeps Flask's signed cookie sessions
+
+SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{43}$")
+
+class ServerSession(SecureCookieSession):
+    def __init__(self, initial = None, sid: str | None = None):
+        super().__init__(initial)
+        self.sid = sid
+        self.replaced_sid = None
+
+    def regenerate(self):
+        # Moves the data to a new id, which is saved at the end of the request
+        if self.sid != None:
+            self.replaced_sid = self.sid
+            self.sid = None
+        self.modified = True
+
+class MemorySessionStore:
+    def __init__(self):
+        # Every entry lives for the same time and is moved to the end when
+        # written, so the entries at the front always expire first
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, sid: str) -> bytes | None:
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry == None or entry[1] <= monotonic():
+                return None
+            return entry[0]
+
+    def set(self, sid: str, value: bytes, ttl: float):
+        now = monotonic()
+        with self.lock:
+            self.entries.pop(sid, None)
+            self.entries[sid] = (value, now + ttl)
+            while self.entries[next(iter(self.entries))][1] <= now:
+                self.entries.popitem(last=False)
+
+    def delete(self, sid: str):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+    def stats(self) -> dict:
+        return {
+            "stored": len(self.entries),
+        }
+
+class RedisSessionStore:
+    def __init__(self, url: str, prefix: str = "session:"):
+        self.client = redis_from_url(url)
+        self.prefix = prefix
+
+    def get(self, sid: str) -> bytes | None:
+        return self.client.get(self.prefix + sid)
+
+    def set(self, sid: str, value: bytes, ttl: float):
+        self.client.set(self.prefix + sid, value, px=int(ttl * 1000))
+
+    def delete(self, sid: str):
+        self.client.delete(self.prefix + sid)
+
+    def stats(self) -> dict:
+        return {}
+
+class SessionCache:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sid: str) -> dict | None:
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry == None or entry[1] <= monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(sid)
+            self.hits += 1
+            return dict(entry[0])
+
+    def set(self, sid: str, data: dict):
+        with self.lock:
+            self.entries.pop(sid, None)
+            self.entries[sid] = (dict(data), monotonic() + self.ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, sid: str):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+    def stats(self) -> dict:
+        return {
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "cache_entries": len(self.entries),
+        }
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, cache: SessionCache | None):
+        self.store = store
+        self.cache = cache
+
+    def open_session(self, app: Flask, request: Request) -> ServerSession:
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid == None or not SESSION_ID.match(sid):
+            return ServerSession()
+        data = self.load(sid)
+        if data == None:
+            return ServerSession()
+        return ServerSession(data, sid)
+
+    def load(self, sid: str) -> dict | None:
+        if self.cache != None:
+            data = self.cache.get(sid)
+            if data != None:
+                return data
+        value = self.store.get(sid)
+        if value == None:
+            return None
+        data = self.serializer.loads(value.decode())
+        if self.cache != None:
+            self.cache.set(sid, data)
+        return data
+
+    def delete(self, sid: str):
+        self.store.delete(sid)
+        if self.cache != None:
+            self.cache.delete(sid)
+
+    def save_session(self, app: Flask, session: ServerSession, response: Response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if session.replaced_sid != None:
+            self.delete(session.replaced_sid)
+
+        # Sessions that end up empty (like after logging out) are deleted
+        if not session:
+            if session.sid != None:
+                self.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified and session.sid != None:
+            return
+        if session.sid == None:
+            session.sid = token_urlsafe(32)
+        data = dict(session)
+        self.store.set(
+            session.sid, self.serializer.dumps(data).encode(),
+            app.permanent_session_lifetime.total_seconds()
+        )
+        if self.cache != None:
+            self.cache.set(session.sid, data)
+
+        response.set_cookie(
+            name, session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+class ServerSessions:
+    def __init__(self):
+        self.interface = None
+
+    def init_app(self, app: Flask):
+        backend = app.config.get("SESSION_BACKEND", "cookie")
+        if backend == "memory":
+            # The store is already in memory, so it doesn't need a cache
+            self.interface = ServerSessionInterface(MemorySessionStore(), None)
+        elif backend == "redis":
+            self.interface = ServerSessionInterface(
+                RedisSessionStore(app.config["SESSION_REDIS_URL"]),
+                SessionCache(app.config.get("SESSION_CACHE_SIZE", 10000), app.config.get("SESSION_CACHE_TTL", 5))
+            )
+        elif backend != "cookie":
+            raise ValueError(f"Unknown session backend '{backend}'")
+        if self.interface != None:
+            app.session_interface = self.interface
+        app.extensions["server_sessions"] = self
+
+    def stats(self) -> dict:
+        if self.interface == None:
+            return {}
+        stats = self.interface.store.stats()
+        if self.interface.cache != None:
+            stats.update(self.interface.cache.stats())
+        return stats
+
+def regenerate_session():
+    # Called when logging in, so that a session id someone got hold of
+    # before that can't be used to act as the logged in user
+    if isinstance(session, ServerSession):
+        session.regenerate()
+
+server_sessions = ServerSessions()
@@ -0,0 +1,228 @@
+from models import LEVEL_SIZE, OBJECT_UNIT
+from verification import KEY_LEFT, KEY_RIGHT, KEY_UP
+import numpy as np
+
+### Level simulation ###
+
+# A headless port of the player physics in static/engine.mjs, used to replay
+# input traces recorded by the engine. Replaying a trace proves that it
+# reaches the goal, which is how clears are verified and how levels are
+# shown to be beatable before they're published
+#
+# The engine runs its physics at a fixed 60 ticks per second and records
+# which keys were held on every tick, so replaying a trace gives exactly the
+# same positions as in the browser as long as the arithmetic here matches
+# the engine's operation for operation. Keep the two in sync!
+#
+# Objects are put in a uniform grid so that each tick only tests the
+# objects near the player, and those are tested all at once with NumPy
+
+SOLID = 0
+DEADLY = 1
+GOAL = 2
+
+# Hitbox (x, y, width, height) of each type relative to the object's
+# position, and how the player collides with it
+OBJECT_HITBOXES = {
+    "block": ((0, 0, OBJECT_UNIT, OBJECT_UNIT), SOLID),
+    "spike": ((OBJECT_UNIT / 4, 0, OBJECT_UNIT / 2, OBJECT_UNIT / 2), DEADLY),
+    "ground-spike": ((OBJECT_UNIT / 4, 0, OBJECT_UNIT / 2, OBJECT_UNIT / 3), DEADLY),
+    "goal": ((0, 0, OBJECT_UNIT, OBJECT_UNIT), GOAL),
+}
+
+GRAVITY = -1.35
+SPEED_SLOW_DOWN_GROUND = 0.45
+SPEED_SLOW_DOWN_AIR = 0.25
+SPEED_ACC_X_GROUND = 2.5
+SPEED_ACC_X_AIR = 1.9
+SPEED_CAP_X = 6.8
+SPEED_CAP_Y = 14
+
+class ObjectGrid:
+    def __init__(self, left, right, bottom, top, kind, cell_size: int = OBJECT_UNIT):
+        self.arrays = (left, right, bottom, top, kind)
+        self.cell_size = cell_size
+        self.cells = dict()
+        for i in range(len(kind)):
+            for cx in range(self.cell(left[i]), self.cell(right[i]) + 1):
+                for cy in range(self.cell(bottom[i]), self.cell(top[i]) + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
+        # The player moves a few pixels per tick, so the same cells are
+        # queried over and over
+        self.queries = dict()
+
+    def cell(self, coord: float) -> int:
+        return int(coord // self.cell_size)
+
+    def query(self, x0: float, x1: float, y0: float, y1: float) -> tuple:
+        # Returns the bounds and kinds of every object in the cells touching
+        # the box, or None if there are none
+        key = (self.cell(x0), self.cell(x1), self.cell(y0), self.cell(y1))
+        if key not in self.queries:
+            indices = sorted(set(
+                i
+                for cx in range(key[0], key[1] + 1)
+                for cy in range(key[2], key[3] + 1)
+                for i in self.cells.get((cx, cy), ())
+            ))
+            self.queries[key] = tuple(a[indices] for a in self.arrays) if indices else None
+        return self.queries[key]
+
+class LevelSimulation:
+    def __init__(self, data: dict):
+        # The same defaults as Level.playerOrig() and Level.endOrig()
+        player_x = data.get("playerX")
+        player_y = data.get("playerY")
+        end_x = data.get("endX")
+        end_y = data.get("endY")
+        self.start = (
+            player_x if player_x != None else LEVEL_SIZE / 2,
+            player_y if player_y != None else LEVEL_SIZE / 2,
+        )
+        goal = {
+            "type": "goal",
+            "x": end_x if end_x != None else LEVEL_SIZE / 2 - OBJECT_UNIT * 5,
+            "y": end_y if end_y != None else LEVEL_SIZE / 2,
+        }
+
+        objects = [obj for obj in data.get("objects") or [] if obj["type"] in OBJECT_HITBOXES] + [goal]
+        left = np.empty(len(objects))
+        right = np.empty(len(objects))
+        bottom = np.empty(len(objects))
+        top = np.empty(len(objects))
+        kind = np.empty(len(objects), dtype=np.int8)
+        for i, obj in enumerate(objects):
+            (x, y, width, height), collision = OBJECT_HITBOXES[obj["type"]]
+            # Same order of operations as GameObject.abshitbox()
+            left[i] = x + obj["x"]
+            bottom[i] = y + obj["y"]
+            right[i] = left[i] + width
+            top[i] = bottom[i] + height
+            kind[i] = collision
+        self.grid = ObjectGrid(left, right, bottom, top, kind)
+
+        self.reset()
+        self.cleared = False
+
+    def reset(self):
+        self.x, self.y = self.start
+        self.speed_x = 0
+        self.speed_y = 0
+        self.block_above = None
+        self.block_below = None
+        self.block_left = None
+        self.block_right = None
+
+    def check_collisions(self):
+        # PlayerObject.checkCollisions()
+        self.block_above = None
+        self.block_below = None
+        self.block_left = None
+        self.block_right = None
+
+        player_left = 0 + self.x
+        player_bottom = 0 + self.y
+        player_right = player_left + OBJECT_UNIT
+        player_top = player_bottom + OBJECT_UNIT
+        reach_x = max(self.speed_x, 4)
+        reach_y = max(self.speed_y, 4)
+
+        nearby = self.grid.query(
+            player_left - reach_x, player_right + reach_x,
+            player_bottom - reach_y, player_top + reach_y,
+        )
+        if nearby != None:
+            left, right, bottom, top, kind = nearby
+            same_x = (player_right > left) & (player_left < right)
+            same_y = (player_top > bottom) & (player_bottom < top)
+            below = same_x & (np.abs(player_bottom - top) < reach_y)
+            above = same_x & (np.abs(player_top - bottom) < reach_y)
+            at_left = same_y & (np.abs(player_left - right) < reach_x)
+            at_right = same_y & (np.abs(player_right - left) < reach_x)
+            touching = below | above | at_left | at_right
+
+            if np.any(touching & (kind == DEADLY)):
+                self.reset()
+                return
+            if np.any(touching & (kind == GOAL)):
+                self.cleared = True
+                return
+
+            solid = kind == SOLID
+            if np.any(below & solid):
+                self.block_below = float(np.max(top[below & solid]))
+            if np.any(above & solid):
+                self.block_above = float(np.min(bottom[above & solid]))
+            if np.any(at_left & solid):
+                self.block_left = float(np.max(right[at_left & solid]))
+            if np.any(at_right & solid):
+                self.block_right = float(np.min(left[at_right & solid]))
+
+        # Level borders
+        if abs(player_top - (LEVEL_SIZE - OBJECT_UNIT)) < reach_y:
+            self.block_above = LEVEL_SIZE - OBJECT_UNIT
+        if abs(player_bottom - OBJECT_UNIT) < reach_y:
+            self.block_below = OBJECT_UNIT
+        if abs(player_right - (LEVEL_SIZE - OBJECT_UNIT)) < reach_x:
+            self.block_right = LEVEL_SIZE - OBJECT_UNIT
+        if abs(player_left - OBJECT_UNIT) < reach_x:
+            self.block_left = OBJECT_UNIT
+
+    def tick(self, keys: int):
+        # PlayerObject.tick() with a delta of 1
+        self.check_collisions()
+        if self.cleared:
+            return
+
+        on_ground = self.block_below != None
+        slow_down = SPEED_SLOW_DOWN_GROUND if on_ground else SPEED_SLOW_DOWN_AIR
+        acc_x = SPEED_ACC_X_GROUND if on_ground else SPEED_ACC_X_AIR
+        left, right, up = keys & KEY_LEFT, keys & KEY_RIGHT, keys & KEY_UP
+
+        if left and right:
+            acc_x = 0
+        elif left:
+            acc_x = -acc_x
+        elif not right:
+            acc_x = 0
+
+        self.speed_x += acc_x * 1
+        self.speed_y += GRAVITY * 1
+
+        if not left and not right:
+            if self.speed_x < 0:
+                self.speed_x += slow_down
+            elif self.speed_x > 0:
+                self.speed_x -= slow_down
+            if abs(self.speed_x) <= slow_down:
+                self.speed_x = 0
+
+        if up and self.speed_y <= 0 and on_ground:
+            self.speed_y = SPEED_CAP_Y
+
+        self.speed_x = min(max(self.speed_x, -SPEED_CAP_X), +SPEED_CAP_X)
+        self.speed_y = min(max(self.speed_y, -SPEED_CAP_Y), +SPEED_CAP_Y * 2)
+
+        if self.block_below != None and self.speed_y <= 0:
+            self.y = self.block_below
+            self.speed_y = 0
+        if self.block_above != None and self.speed_y > 0:
+            self.y = self.block_above - OBJECT_UNIT
+            self.speed_y = 0
+        if self.block_left != None and self.speed_x < 0:
+            self.x = self.block_left
+            self.speed_x = 0
+        if self.block_right != None and self.speed_x > 0:
+            self.x = self.block_right - OBJECT_UNIT
+            self.speed_x = 0
+
+        self.x += self.speed_x * 1
+        self.y += self.speed_y * 1
+
+    def run(self, trace: list[tuple[int, int]]) -> bool:
+        for keys, ticks in trace:
+            for _ in range(ticks):
+                self.tick(keys)
+                if self.cleared:
+                    return True
+        return False
@@ -2,14 +2,17 @@
 
 export const api = {
     /**
-     * Make an API request
+     * Make an API request. Failed requests include the HTTP status code if 
+     * the server responded at all
      * @param {string} url 
      * @param {object} params
      * @param {'GET' | 'POST' | 'DELETE'} method
-     * @returns {Promise<{ ok: true, value: any } | { ok: false, error: string }>}
+     * @returns {Promise<{ ok: true, value: any } | { ok: false, error: string, status?: number }>}
      */
     async request(url, params, method) {
         const paramsInUrl = method === 'GET';
+        /** @type {number | undefined} */
+        let status = undefined;
         try {
             if (paramsInUrl) {
                 url += '?' + new URLSearchParams(params);
@@ -24,6 +27,7 @@ export const api = {
                 },
                 credentials: 'same-origin'
             });
+            status = res.status;
             const json = await res.json();
             if (!res.ok) {
                 throw json.reason;
@@ -31,7 +35,7 @@ export const api = {
             return { ok: true, value: json };
         }
         catch(e) {
-            return { ok: false, error: `${e}` };
+            return { ok: false, error: `${e}`, status };
         }
     },
 
@@ -39,7 +43,7 @@ export const api = {
      * Make a GET request
      * @param {string} url 
      * @param {object} params
-     * @returns {Promise<{ ok: true, value: any } | { ok: false, error: string }>}
+     * @returns {Promise<{ ok: true, value: any } | { ok: false, error: string, status?: number }>}
      */
     async get(url, params = {}) {
         return await this.request(url, params, 'GET');
@@ -49,7 +53,7 @@ export const api = {
      * Make a POST request
      * @param {string} url 
      * @param {object} params 
-     * @returns {Promise<{ ok: true, value: any } | { ok: false, error: string }>}
+     * @returns {Promise<{ ok: true, value: any } | { ok: false, error: string, status?: number }>}
      */
     async post(url, params = {}) {
         return await this.request(url, params, 'POST');
@@ -59,7 +63,7 @@ export const api = {
      * Make a DELETE request
      * @param {string} url 
      * @param {object} params 
-     * @returns {Promise<{ ok: true, value: any } | { ok: false, error: string }>}
+     * @returns {Promise<{ ok: true, value: any } | { ok: false, error: string, status?: number }>}
      */
     async delete(url, params = {}) {
         return await this.request(url, params, 'DELETE');
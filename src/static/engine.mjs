@@ -112,6 +112,44 @@ document.addEventListener('mouseup', e => {
     inputManager.mouseDown = false;
 });
 
+/**
+ * Physics ticks per second. Each tick advances the physics by a delta of 1
+ */
+const TICK_RATE = 60;
+/**
+ * Ticks to catch up on at most per frame, so that coming back to a 
+ * background tab doesn't fast-forward through the level
+ */
+const MAX_TICKS_PER_FRAME = 10;
+
+const KEY_LEFT = 1;
+const KEY_RIGHT = 2;
+const KEY_UP = 4;
+
+/**
+ * The keys held on every physics tick of an attempt, run-length encoded as 
+ * `[keys, ticks]` pairs. The server replays these to verify clears
+ */
+class InputTrace {
+    constructor() {
+        /**
+         * @type {[number, number][]}
+         */
+        this.runs = [];
+    }
+
+    record() {
+        const keys = (inputManager.left ? KEY_LEFT : 0) | (inputManager.right ? KEY_RIGHT : 0) | (inputManager.up ? KEY_UP : 0);
+        const last = this.runs[this.runs.length - 1];
+        if (last && last[0] === keys) {
+            last[1] += 1;
+        }
+        else {
+            this.runs.push([keys, 1]);
+        }
+    }
+}
+
 /**
  * @typedef {'block' | 'spike' | 'ground-spike' | 'goal' | 'player' | 'particles'} ObjectType
  * @typedef {'deco' | 'solid' | 'deadly' | 'goal'} ObjectCollision
@@ -570,44 +608,45 @@ class PlayerObject extends GameObject {
             return Math.abs(a - b) < Math.max(speed, 4);
         }
 
-        // Check all objects (no way there would be so many that this would be laggy haha)
+        // The outcome must not depend on the order of the objects, since the 
+        // server replays clears (see simulation.py) with the objects in 
+        // whatever order it has them. Touching anything deadly kills the 
+        // player, then touching the goal wins, and when several blocks are 
+        // touched on the same side the one closest to the player counts
+        let deadly = false;
+        /** @type {Hitbox | undefined} */
+        let goal = undefined;
         for (const obj_ of level.objects) {
-            if (obj_.type === 'player') continue;
+            if (obj_.type === 'player' || obj_.collision === 'deco') continue;
             
             const obj = obj_.abshitbox();
             if (obj) {
                 const sameX = player.right() > obj.left() && player.left() < obj.right();
                 const sameY = player.top() > obj.bottom() && player.bottom() < obj.top();
-                if (hitboxTouching(player.bottom(), obj.top(), this.speed.y) && sameX) {
-                    switch (obj_.collision) {
-                        case 'solid': this.collidingBlockBelow = obj.top(); break;
-                        case 'deadly': this.kill(); break;
-                        case 'goal': this.win(obj.x, obj.y); break;
-                    }
-                }
-                if (hitboxTouching(player.top(), obj.bottom(), this.speed.y) && sameX) {
-                    switch (obj_.collision) {
-                        case 'solid': this.collidingBlockAbove = obj.bottom(); break;
-                        case 'deadly': this.kill(); break;
-                        case 'goal': this.win(obj.x, obj.y); break;
-                    }
-                }
-                if (hitboxTouching(player.left(), obj.right(), this.speed.x) && sameY) {
-                    switch (obj_.collision) {
-                        case 'solid': this.collidingBlockLeft = obj.right(); break;
-                        case 'deadly': this.kill(); break;
-                        case 'goal': this.win(obj.x, obj.y); break;
-                    }
-                }
-                if (hitboxTouching(player.right(), obj.left(), this.speed.x) && sameY) {
-                    switch (obj_.collision) {
-                        case 'solid': this.collidingBlockRight = obj.left(); break;
-                        case 'deadly': this.kill(); break;
-                        case 'goal': this.win(obj.x, obj.y); break;
-                    }
+                const below = hitboxTouching(player.bottom(), obj.top(), this.speed.y) && sameX;
+                const above = hitboxTouching(player.top(), obj.bottom(), this.speed.y) && sameX;
+                const left  = hitboxTouching(player.left(), obj.right(), this.speed.x) && sameY;
+                const right = hitboxTouching(player.right(), obj.left(), this.speed.x) && sameY;
+                switch (obj_.collision) {
+                    case 'solid': {
+                        if (below) this.collidingBlockBelow = Math.max(this.collidingBlockBelow ?? -Infinity, obj.top());
+                        if (above) this.collidingBlockAbove = Math.min(this.collidingBlockAbove ?? +Infinity, obj.bottom());
+                        if (left)  this.collidingBlockLeft  = Math.max(this.collidingBlockLeft ?? -Infinity, obj.right());
+                        if (right) this.collidingBlockRight = Math.min(this.collidingBlockRight ?? +Infinity, obj.left());
+                    } break;
+                    case 'deadly': deadly ||= below || above || left || right; break;
+                    case 'goal': if (below || above || left || right) goal = obj; break;
                 }
             }
         }
+        if (deadly) {
+            this.kill();
+            return;
+        }
+        if (goal) {
+            this.win(goal.x, goal.y);
+            return;
+        }
 
         // Check level borders
         if (hitboxTouching(player.top(), level.height - OBJECT_UNIT, this.speed.y)) {
@@ -691,6 +730,7 @@ class PlayerObject extends GameObject {
             return;
         }
 
+        this.level.trace.record();
         this.checkCollisions();
 
         const SPEED_SLOW_DOWN = this.collidingBlockBelow !== undefined ? 0.45 : 0.25;
@@ -964,6 +1004,9 @@ class PlayerObject extends GameObject {
  * @typedef {{ x: number, y: number, type: ObjectType }} LevelDataObject
  * @typedef {{ playerX: number | undefined, playerY: number | undefined, endX: number | undefined, endY: number | undefined, objects: LevelDataObject[] | undefined }} LevelData
  * @typedef {'place' | 'edit' | 'eraser'} EditorTool
+ * @typedef {{ op: 'add' | 'remove', x: number, y: number, type: ObjectType }
+ *     | { op: 'move', type: ObjectType, from: GridPoint, to: GridPoint }
+ *     | { op: 'set', playerX?: number, playerY?: number, endX?: number, endY?: number }} LevelEditOp
  */
 
 /**
@@ -1062,6 +1105,28 @@ class Level {
          * @type {boolean}
          */
         this.debug = false;
+        /**
+         * Inputs of the current attempt (since the level was loaded, or since 
+         * the playtest started in the editor)
+         * @type {InputTrace}
+         */
+        this.trace = new InputTrace();
+        /**
+         * Inputs of the last playtest that reached the goal, which proves to 
+         * the server that the level can be beaten
+         * @type {InputTrace | undefined}
+         */
+        this.clearedTrace = undefined;
+        /**
+         * The revision of the level on the server the last time it was synced
+         * @type {number | undefined}
+         */
+        this.revision = undefined;
+        /**
+         * The level data as of `revision`
+         * @type {LevelData | undefined}
+         */
+        this.savedData = undefined;
 
         this.scheduleRender(canvas);
 
@@ -1086,12 +1151,19 @@ class Level {
         const ctx = /** @type {CanvasRenderingContext2D} */ (canvas.getContext('2d'));
         ctx.setTransform(1, 0, 0, -1, 0, canvas.height - 1);
 
-        let prevFrame = 0;
+        /** @type {number | undefined} */
+        let prevFrame = undefined;
+        let pendingTicks = 0;
         const schedule = (/** @type {number} */ frameStamp) => {
-            const delta = (frameStamp - prevFrame) * 60 / 1000;
-
-            // Physics run at a constant tick rate
-            this.tick(delta);
+            // Physics run at a constant tick rate, so that they play the same 
+            // at any framerate and can be replayed by the server
+            if (prevFrame !== undefined) {
+                pendingTicks = Math.min(pendingTicks + (frameStamp - prevFrame) * TICK_RATE / 1000, MAX_TICKS_PER_FRAME);
+            }
+            while (pendingTicks >= 1) {
+                this.tick(1);
+                pendingTicks -= 1;
+            }
 
             // Render every frame you can
             ctx.clearRect(0, 0, canvas.width, canvas.height);
@@ -1175,6 +1247,7 @@ class Level {
                 this.createObject(obj.type, obj.x, obj.y);
             }
         });
+        this.trace = new InputTrace();
     }
 
     reset() {
@@ -1186,12 +1259,13 @@ class Level {
     }
     win() {
         if (this.editorMode) {
+            this.clearedTrace = this.trace;
             this.setPlaytesting(false);
         }
         else {
             this.winning = true;
             this.canvas.parentElement?.querySelector('.overlay')?.classList.remove('hidden');
-            api.post(`/api/levels/${this.id}/mark-as-cleared`);
+            api.post(`/api/levels/${this.id}/mark-as-cleared`, { trace: this.trace.runs });
         }
     }
 
@@ -1216,8 +1290,9 @@ class Level {
                     gridY = Math.floor(y / OBJECT_UNIT) * OBJECT_UNIT;
                 }
                 else {
-                    gridX -= OBJECT_UNIT / 2;
-                    gridY -= OBJECT_UNIT / 2;
+                    // The server stores whole-pixel coordinates
+                    gridX = Math.round(gridX - OBJECT_UNIT / 2);
+                    gridY = Math.round(gridY - OBJECT_UNIT / 2);
                 }
     
                 if (this.editorGhostObject && this.editorTool == 'place') {
@@ -1339,28 +1414,36 @@ class Level {
     updateData() {
         if (!this.editorMode || !this.data || !this.player) return;
 
-        this.data.playerX = this.player.x;
-        this.data.playerY = this.player.y;
+        this.data.playerX = Math.round(this.player.x);
+        this.data.playerY = Math.round(this.player.y);
 
-        this.data.endX = this.goal?.x;
-        this.data.endY = this.goal?.y;
+        this.data.endX = this.goal ? Math.round(this.goal.x) : undefined;
+        this.data.endY = this.goal ? Math.round(this.goal.y) : undefined;
 
         this.data.objects = [];
         for (const obj of this.objects) {
             if (obj == this.editorGhostObject || obj == this.player) {
                 continue;
             }
+            // The player, goal and particles aren't stored with the objects
+            if (obj.type == 'goal' || obj.type == 'player' || obj.type == 'particles') {
+                continue;
+            }
             this.data.objects?.push({
                 type: obj.type,
-                x: obj.x,
-                y: obj.y,
+                x: Math.round(obj.x),
+                y: Math.round(obj.y),
             });
         }
     }
     async serverAction(action) {
         try {
             await this.saveToServer();
-            const res = await api.post(`/api/levels/wip/${this.id}/${action}`, this.data);
+            // Publishing needs a playtest that reached the goal
+            const res = await api.post(`/api/levels/wip/${this.id}/${action}`, {
+                ...this.data,
+                trace: this.clearedTrace?.runs,
+            });
             if (!res.ok) {
                 throw res.error;
             }
@@ -1369,13 +1452,129 @@ class Level {
             alert(`Error syncing level to servers: ${e}`);
         }
     }
+    /**
+     * Get the edits needed to turn the last saved level data into the current 
+     * one
+     * @returns {LevelEditOp[]}
+     */
+    diffSavedData() {
+        /** @type {LevelEditOp[]} */
+        const ops = [];
+        const saved = this.savedData ?? /** @type {LevelData} */ ({});
+        const current = this.data ?? /** @type {LevelData} */ ({});
+
+        /** @type {LevelEditOp & { op: 'set' }} */
+        const set = { op: 'set' };
+        for (const key of /** @type {const} */ (['playerX', 'playerY', 'endX', 'endY'])) {
+            if (saved[key] !== current[key] && current[key] !== undefined) {
+                set[key] = current[key];
+            }
+        }
+        if (Object.keys(set).length > 1) {
+            ops.push(set);
+        }
+
+        // Objects don't have identities, so compare the levels as multisets of 
+        // objects and pair up removals and additions of the same type as moves
+        const objKey = (/** @type {LevelDataObject} */ obj) => `${obj.type}:${obj.x}:${obj.y}`;
+        /** @type {Map<string, number>} */
+        const unmatched = new Map();
+        for (const obj of saved.objects ?? []) {
+            unmatched.set(objKey(obj), (unmatched.get(objKey(obj)) ?? 0) + 1);
+        }
+        /** @type {LevelDataObject[]} */
+        const added = [];
+        for (const obj of current.objects ?? []) {
+            const count = unmatched.get(objKey(obj)) ?? 0;
+            if (count > 0) {
+                unmatched.set(objKey(obj), count - 1);
+            }
+            else {
+                added.push(obj);
+            }
+        }
+        for (const obj of saved.objects ?? []) {
+            const count = unmatched.get(objKey(obj)) ?? 0;
+            if (count === 0) {
+                continue;
+            }
+            unmatched.set(objKey(obj), count - 1);
+
+            const moved = added.findIndex(a => a.type === obj.type);
+            if (moved !== -1) {
+                const [to] = added.splice(moved, 1);
+                ops.push({ op: 'move', type: obj.type, from: { x: obj.x, y: obj.y }, to: { x: to.x, y: to.y } });
+            }
+            else {
+                ops.push({ op: 'remove', x: obj.x, y: obj.y, type: obj.type });
+            }
+        }
+        for (const obj of added) {
+            ops.push({ op: 'add', x: obj.x, y: obj.y, type: obj.type });
+        }
+
+        return ops;
+    }
+    /**
+     * Send only the edits made since the last save, falling back to saving
+     * the whole level if the server can't apply them. If the level has been
+     * saved somewhere else in the meantime, the newer version is loaded
+     * instead of being overwritten
+     * @returns {Promise<void>}
+     */
+    async syncToServer() {
+        if (this.revision !== undefined) {
+            const res = await api.post(`/api/levels/wip/${this.id}/patch`, {
+                revision: this.revision,
+                ops: this.diffSavedData(),
+            });
+            if (res.ok) {
+                this.revision = res.value.revision;
+                return;
+            }
+            if (res.status === 409) {
+                await this.reloadFromServer();
+                throw 'The level was changed somewhere else, so the latest saved version has been loaded';
+            }
+            // Only edits the server refused to apply (for example because
+            // there are too many of them) are worth sending as a whole level
+            if (res.status !== 400) {
+                throw res.error;
+            }
+        }
+        const res = await api.post(`/api/levels/wip/${this.id}/update-data`, { ...this.data });
+        if (!res.ok) {
+            throw res.error;
+        }
+        this.revision = res.value.revision;
+    }
+    /**
+     * Replace the level being edited with the latest version on the server
+     * @returns {Promise<void>}
+     */
+    async reloadFromServer() {
+        const res = await api.get(`/api/levels/wip/${this.id}/data`);
+        if (!res.ok) {
+            throw res.error;
+        }
+        const { data, revision } = /** @type {{ data: LevelData, revision: number }} */ (res.value);
+        this.loadData(data);
+        if (this.editorGhostObject) {
+            this.setEditorObj(this.editorGhostObject.type);
+        }
+        this.revision = revision;
+        this.savedData = structuredClone(data);
+        this.clearedTrace = undefined;
+        this.editorHasUnsavedChanges = false;
+        if (this.onEditorChange) {
+            this.onEditorChange(false);
+        }
+    }
     async saveToServer() {
         try {
             this.updateData();
-            const res = await api.post(`/api/levels/wip/${this.id}/update-data`, this.data);
-            if (!res.ok) {
-                throw res.error;
-            }
+            await this.syncToServer();
+            this.savedData = structuredClone(this.data);
             this.editorHasUnsavedChanges = false;
             if (this.onEditorChange) {
                 this.onEditorChange(false);
@@ -1399,6 +1598,7 @@ class Level {
         this.playtesting = mode;
         if (mode) {
             this.updateData();
+            this.trace = new InputTrace();
         }
         this.reset();
         if (this.onEditorPlaytest) {
@@ -1450,6 +1650,75 @@ class Level {
     }
 }
 
+const LEVEL_FORMAT_MIMETYPE = 'application/x-platformer-level';
+const LEVEL_FORMAT_MAGIC = 'PLVL';
+const LEVEL_FORMAT_VERSION = 1;
+/** @type {ObjectType[]} */
+const LEVEL_FORMAT_OBJECT_TYPES = ['block', 'spike', 'ground-spike'];
+
+/**
+ * Decode level data in the compact binary format (see `src/levelformat.py` 
+ * for the layout)
+ * @param {ArrayBuffer} buffer 
+ * @returns {Promise<LevelData>}
+ */
+async function decodeLevelData(buffer) {
+    const header = new Uint8Array(buffer, 0, 5);
+    if (String.fromCharCode(...header.subarray(0, 4)) !== LEVEL_FORMAT_MAGIC || header[4] !== LEVEL_FORMAT_VERSION) {
+        throw 'Unsupported level format';
+    }
+
+    const stream = new Blob([buffer.slice(5)]).stream().pipeThrough(new DecompressionStream('deflate'));
+    const view = new DataView(await new Response(stream).arrayBuffer());
+
+    const flags = view.getUint8(0);
+    const count = view.getUint32(10, true);
+    const xs = 14;
+    const ys = xs + count * 2;
+    const types = ys + count * 2;
+
+    /** @type {LevelDataObject[]} */
+    const objects = new Array(count);
+    for (let i = 0; i < count; i += 1) {
+        objects[i] = {
+            x: view.getInt16(xs + i * 2, true),
+            y: view.getInt16(ys + i * 2, true),
+            type: LEVEL_FORMAT_OBJECT_TYPES[view.getUint8(types + i)],
+        };
+    }
+
+    return {
+        playerX: flags & 1 ? view.getInt16(2, true) : undefined,
+        playerY: flags & 1 ? view.getInt16(4, true) : undefined,
+        endX: flags & 2 ? view.getInt16(6, true) : undefined,
+        endY: flags & 2 ? view.getInt16(8, true) : undefined,
+        objects,
+    };
+}
+
+/**
+ * Fetch the data of a published level, in the compact format if the browser 
+ * can decompress it and as JSON otherwise
+ * @param {string} id 
+ * @returns {Promise<LevelData>}
+ */
+async function fetchLevelData(id) {
+    const compact = typeof DecompressionStream !== 'undefined';
+    const res = await fetch(`/api/levels/${id}/data`, {
+        headers: {
+            'Accept': compact ? `${LEVEL_FORMAT_MIMETYPE}, application/json;q=0.9` : 'application/json'
+        },
+        credentials: 'same-origin'
+    });
+    if (!res.ok) {
+        throw (await res.json()).reason;
+    }
+    if (res.headers.get('Content-Type')?.startsWith(LEVEL_FORMAT_MIMETYPE)) {
+        return await decodeLevelData(await res.arrayBuffer());
+    }
+    return /** @type {LevelData} */ (await res.json());
+}
+
 /**
  * Load a new level into a canvas by fetching it from an URL, replacing any existing level
  * @param {HTMLCanvasElement} canvas 
@@ -1459,17 +1728,15 @@ class Level {
 export async function loadLevelByID(canvas, id) {
     const level = new Level(canvas, id, false);
 
-    const res = await api.get(`/api/levels/${id}/data`);
-    if (!res.ok) {
+    try {
+        level.loadData(await fetchLevelData(id));
+    }
+    catch(e) {
         level.setError('Level not found');
         return Promise.reject('Level not found');
     }
-    else {
-        const data = /** @type {LevelData} */ (await res.value);
-        level.loadData(data);
-        api.post(`/api/levels/${id}/mark-as-played`);
-        return level;
-    }
+    api.post(`/api/levels/${id}/mark-as-played`);
+    return level;
 }
 
 /**
@@ -1487,8 +1754,10 @@ export async function loadEditorByID(canvas, id) {
         return Promise.reject('Level not found');
     }
     else {
-        const data = /** @type {LevelData} */ (await res.value);
+        const { data, revision } = /** @type {{ data: LevelData, revision: number }} */ (await res.value);
         level.loadData(data);
+        level.revision = revision;
+        level.savedData = structuredClone(data);
         return level;
     }
 }
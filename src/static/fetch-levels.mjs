@@ -3,74 +3,143 @@
 import { api } from "./api.mjs";
 
 /**
- * @typedef {{ name: string, publisher: string, plays: number, clears: number, reviews: number, play_url: string, edit_url?: string, published_at: string }} Level
+ * @typedef {{ name: string, publisher: string, plays: number, clears: number, reviews: number, rating: number, play_url: string, edit_url?: string, published_at: string }} Level
+ * @typedef {{ levels: Level[], next_cursor: string | null }} LevelPage
+ * @typedef {'newest' | 'trending' | 'plays' | 'clears' | 'rating' | 'hardest'} LevelSort
  * @typedef {{ name: string, url: string }} UnpublishedLevel
  */
 
 /**
- * @param {Element} target 
+ * Create the list entry for a level
+ * @param {Level} level 
+ * @returns {HTMLElement}
  */
-async function loadLevelsTo(target, my = false) {
-    const res = await api.get(`/api/levels${my ? '/my' : ''}`);
-    if (!res.ok) {
-        return alert(`Unable to load levels: ${res.error}`);
+function createLevelArticle(level) {
+    const article = document.createElement('article');
+    article.classList.add('level');
+
+    const column = document.createElement('div');
+    column.classList.add('column');
+    
+    const title = document.createElement('p');
+    title.classList.add('name');
+    title.innerText = level.name;
+    column.appendChild(title);
+    
+    const date = Date.parse(level.published_at);
+    const pub = document.createElement('p');
+    pub.classList.add('publisher');
+    pub.innerText = `by ${level.publisher} on ${isNaN(date) ? level.published_at : new Date(date).toDateString()}`;
+    column.appendChild(pub);
+
+    const plays = document.createElement('p');
+    plays.classList.add('play-count');
+    plays.innerText = `${level.clears} clears, ${level.reviews} reviews`;
+    column.appendChild(plays);
+
+    article.appendChild(column);
+
+    const row = document.createElement('div');
+    row.classList.add('row');
+
+    if (level.edit_url) {
+        const edit = document.createElement('a');
+        edit.innerText = 'Edit';
+        edit.href = level.edit_url;
+        row.appendChild(edit);
     }
 
-    // Clear target list if it had any levels previously
-    target.replaceChildren();
+    const play = document.createElement('a');
+    play.innerText = 'Play';
+    play.href = level.play_url;
+    row.appendChild(play);
 
-    const levels = /** @type {Level[]} */ (res.value);
-    for (const level of levels) {
-        const article = document.createElement('article');
-        article.classList.add('level');
+    article.appendChild(row);
 
-        const column = document.createElement('div');
-        column.classList.add('column');
-        
-        const title = document.createElement('p');
-        title.classList.add('name');
-        title.innerText = level.name;
-        column.appendChild(title);
-        
-        const date = Date.parse(level.published_at);
-        const pub = document.createElement('p');
-        pub.classList.add('publisher');
-        pub.innerText = `by ${level.publisher} on ${isNaN(date) ? level.published_at : new Date(date).toDateString()}`;
-        column.appendChild(pub);
+    return article;
+}
 
-        const plays = document.createElement('p');
-        plays.classList.add('play-count');
-        plays.innerText = `${level.clears} clears, ${level.reviews} reviews`;
-        column.appendChild(plays);
+/**
+ * Observers fetching more pages for each level list
+ * @type {WeakMap<Element, IntersectionObserver>}
+ */
+const pageObservers = new WeakMap();
 
-        article.appendChild(column);
+/**
+ * Load levels into a list. Only the first page is fetched immediately; the 
+ * rest are fetched as the user scrolls to the end of the list. If a search 
+ * query is given, the list shows the matching levels, best matches first
+ * @param {Element} target 
+ * @param {boolean} my
+ * @param {LevelSort} sort
+ * @param {string} search
+ */
+async function loadLevelsTo(target, my = false, sort = 'newest', search = '') {
+    // Stop fetching pages for whatever was previously listed in the target
+    pageObservers.get(target)?.disconnect();
 
-        const row = document.createElement('div');
-        row.classList.add('row');
+    // Clear target list if it had any levels previously
+    target.replaceChildren();
 
-        if (level.edit_url) {
-            const edit = document.createElement('a');
-            edit.innerText = 'Edit';
-            edit.href = level.edit_url;
-            row.appendChild(edit);
-        }
+    // Reaching this element at the end of the list loads the next page
+    const sentinel = document.createElement('p');
+    sentinel.classList.add('none-found');
+    sentinel.innerText = 'Loading levels...';
+    target.appendChild(sentinel);
 
-        const play = document.createElement('a');
-        play.innerText = 'Play';
-        play.href = level.play_url;
-        row.appendChild(play);
+    /** @type {string | undefined} */
+    let cursor = undefined;
+    let loading = false;
+    let count = 0;
 
-        article.appendChild(row);
+    const observer = new IntersectionObserver(async entries => {
+        if (loading || !entries.some(e => e.isIntersecting)) {
+            return;
+        }
+        loading = true;
 
-        target.appendChild(article);
-    }
+        /** @type {Record<string, string>} */
+        const params = search ? { q: search } : { sort };
+        if (cursor) {
+            params['cursor'] = cursor;
+        }
+        const res = await api.get(`/api/levels${search ? '/search' : my ? '/my' : ''}`, params);
+        loading = false;
 
-    if (levels.length === 0) {
-        const none = document.createElement('p');
-        none.innerText = 'No levels found :(';
-        none.classList.add('none-found');
-        target.appendChild(none);
-    }
+        // The list may have been reloaded while the page was being fetched
+        if (pageObservers.get(target) !== observer) {
+            return;
+        }
+        if (!res.ok) {
+            observer.disconnect();
+            return alert(`Unable to load levels: ${res.error}`);
+        }
+
+        const page = /** @type {LevelPage} */ (res.value);
+        for (const level of page.levels) {
+            target.insertBefore(createLevelArticle(level), sentinel);
+        }
+        count += page.levels.length;
+        cursor = page.next_cursor ?? undefined;
+
+        if (!page.next_cursor) {
+            observer.disconnect();
+            if (count === 0) {
+                sentinel.innerText = 'No levels found :(';
+            }
+            else {
+                sentinel.remove();
+            }
+        }
+        else {
+            // Re-observing makes the observer fire again right away if the 
+            // page was too short to push the sentinel out of view
+            observer.unobserve(sentinel);
+            observer.observe(sentinel);
+        }
+    });
+    pageObservers.set(target, observer);
+    observer.observe(sentinel);
 }
 
 /**
@@ -116,9 +185,32 @@ async function loadEditableLevelsTo(target) {
     }
 }
 
+/**
+ * How long to wait after the last keystroke before searching, in milliseconds
+ */
+const SEARCH_DELAY = 150;
+
 const levelList = document.querySelector('#levels-list');
+const levelSort = /** @type {HTMLSelectElement | null} */ (document.querySelector('#levels-sort'));
+const levelSearch = /** @type {HTMLInputElement | null} */ (document.querySelector('#levels-search'));
 if (levelList) {
-    loadLevelsTo(levelList);
+    const reload = () => {
+        const search = levelSearch?.value.trim() ?? '';
+        // Search results are sorted by relevance
+        if (levelSort) {
+            levelSort.disabled = search.length > 0;
+        }
+        loadLevelsTo(levelList, false, /** @type {LevelSort} */ (levelSort?.value ?? 'newest'), search);
+    };
+    reload();
+    levelSort?.addEventListener('change', reload);
+
+    /** @type {number | undefined} */
+    let searchTimeout = undefined;
+    levelSearch?.addEventListener('input', e => {
+        clearTimeout(searchTimeout);
+        searchTimeout = setTimeout(reload, SEARCH_DELAY);
+    });
 }
 
 const myLevelList = document.querySelector('#my-levels-list');
@@ -3,81 +3,173 @@
 import { api } from "./api.mjs";
 
 /**
- * @typedef {{ user_id: number, username: string, rating: number, body: string }} Review
+ * @typedef {{ user_id: number, username: string, rating: number, body: string, posted_at: string }} Review
+ * @typedef {{ reviews: Review[], next_cursor: string | null, review_count: number, rating: number, rating_counts: number[] }} ReviewPage
  */
 
 /**
- * @param {Element} target 
+ * Create the list entry for a review
+ * @param {Review} review 
+ * @param {string} starSVG 
+ * @param {number} id 
+ * @param {number | undefined} userID 
+ * @returns {HTMLElement}
  */
-async function loadReviewsTo(target, id, userID) {
-    const res = await api.get(`/api/levels/${id}/reviews`);
-    if (!res.ok) {
-        return alert(`Unable to load levels: ${res.error}`);
-    }
+function createReviewArticle(review, starSVG, id, userID) {
+    const article = document.createElement('article');
+    article.classList.add('review');
 
-    // Clear target list if it had any levels previously
-    target.replaceChildren();
+    const column = document.createElement('div');
+    column.classList.add('column');
 
-    // There has to be a better way to do this but I'm too dumb to figure it out
-    const starSVG = await (await fetch('/star-svg')).text();
-
-    const reviews = /** @type {Review[]} */ (res.value);
-    for (const review of reviews) {
-        const article = document.createElement('article');
-        article.classList.add('review');
+    const rating = document.createElement('div');
+    rating.classList.add('row', 'stars');
+    for (let i = 0; i < 5; i += 1) {
+        rating.innerHTML += starSVG;
+    }
+    for (let i = 0; i < review.rating; i += 1) {
+        rating.children.item(i)?.classList.add('filled');
+    }
+    column.appendChild(rating);
+    
+    const body = document.createElement('p');
+    body.classList.add('body');
+    body.innerText = review.body;
+    column.appendChild(body);
+
+    const poster = document.createElement('p');
+    poster.classList.add('name');
+    poster.innerText = `by ${review.username}`;
+    column.appendChild(poster);
+
+    article.appendChild(column);
+
+    const row = document.createElement('div');
+    row.classList.add('row');
+
+    if (review.user_id === userID) {
+        const remove = document.createElement('a');
+        remove.innerText = 'Unpublish';
+        remove.addEventListener('click', async e => {
+            const res = await api.delete(`/api/levels/${id}/reviews`);
+            if (!res.ok) {
+                return alert(`Unable to delete review: ${res.error}`);
+            }
+            window.location.reload();
+        });
+        row.appendChild(remove);
+    }
 
-        const column = document.createElement('div');
-        column.classList.add('column');
+    article.appendChild(row);
 
-        const rating = document.createElement('div');
-        rating.classList.add('row', 'stars');
-        for (let i = 0; i < 5; i += 1) {
-            rating.innerHTML += starSVG;
-        }
-        for (let i = 0; i < review.rating; i += 1) {
-            rating.children.item(i)?.classList.add('filled');
-        }
-        column.appendChild(rating);
-        
-        const body = document.createElement('p');
-        body.classList.add('body');
-        body.innerText = review.body;
-        column.appendChild(body);
+    return article;
+}
 
-        const poster = document.createElement('p');
-        poster.classList.add('name');
-        poster.innerText = `by ${review.username}`;
-        column.appendChild(poster);
+/**
+ * Create the average rating and rating histogram shown above the reviews
+ * @param {ReviewPage} page 
+ * @returns {HTMLElement}
+ */
+function createReviewSummary(page) {
+    const summary = document.createElement('div');
+    summary.classList.add('column', 'review-summary');
 
-        article.appendChild(column);
+    const average = document.createElement('p');
+    average.innerText = `Rated ${page.rating.toFixed(1)} from ${page.review_count} reviews`;
+    summary.appendChild(average);
 
+    for (let rating = page.rating_counts.length - 1; rating >= 0; rating -= 1) {
         const row = document.createElement('div');
         row.classList.add('row');
 
-        if (review.user_id === userID) {
-            const remove = document.createElement('a');
-            remove.innerText = 'Unpublish';
-            remove.addEventListener('click', async e => {
-                const res = await api.delete(`/api/levels/${id}/reviews`);
-                if (!res.ok) {
-                    return alert(`Unable to delete review: ${res.error}`);
-                }
-                window.location.reload();
-            });
-            row.appendChild(remove);
-        }
+        const label = document.createElement('span');
+        label.innerText = `${rating}`;
+        row.appendChild(label);
 
-        article.appendChild(row);
+        const bar = document.createElement('meter');
+        bar.max = Math.max(page.review_count, 1);
+        bar.value = page.rating_counts[rating];
+        row.appendChild(bar);
 
-        target.appendChild(article);
-    }
+        const count = document.createElement('span');
+        count.innerText = `${page.rating_counts[rating]}`;
+        row.appendChild(count);
 
-    if (reviews.length === 0) {
-        const none = document.createElement('p');
-        none.innerText = 'This level has no reviews';
-        none.classList.add('none-found');
-        target.appendChild(none);
+        summary.appendChild(row);
     }
+
+    return summary;
+}
+
+/**
+ * Load reviews into a list. Only the first page is fetched immediately; the 
+ * rest are fetched as the user scrolls to the end of the list
+ * @param {Element} target 
+ * @param {number} id 
+ * @param {number | undefined} userID 
+ */
+async function loadReviewsTo(target, id, userID) {
+    // Clear target list if it had any reviews previously
+    target.replaceChildren();
+
+    // There has to be a better way to do this but I'm too dumb to figure it out
+    const starSVG = await (await fetch('/star-svg')).text();
+
+    // Reaching this element at the end of the list loads the next page
+    const sentinel = document.createElement('p');
+    sentinel.classList.add('none-found');
+    sentinel.innerText = 'Loading reviews...';
+    target.appendChild(sentinel);
+
+    /** @type {string | undefined} */
+    let cursor = undefined;
+    let loading = false;
+
+    const observer = new IntersectionObserver(async entries => {
+        if (loading || !entries.some(e => e.isIntersecting)) {
+            return;
+        }
+        loading = true;
+
+        /** @type {Record<string, string>} */
+        const params = {};
+        if (cursor) {
+            params['cursor'] = cursor;
+        }
+        const res = await api.get(`/api/levels/${id}/reviews`, params);
+        loading = false;
+
+        if (!res.ok) {
+            observer.disconnect();
+            return alert(`Unable to load reviews: ${res.error}`);
+        }
+
+        const page = /** @type {ReviewPage} */ (res.value);
+        if (!cursor && page.review_count > 0) {
+            target.insertBefore(createReviewSummary(page), sentinel);
+        }
+        for (const review of page.reviews) {
+            target.insertBefore(createReviewArticle(review, starSVG, id, userID), sentinel);
+        }
+        cursor = page.next_cursor ?? undefined;
+
+        if (!page.next_cursor) {
+            observer.disconnect();
+            if (page.review_count === 0) {
+                sentinel.innerText = 'This level has no reviews';
+            }
+            else {
+                sentinel.remove();
+            }
+        }
+        else {
+            // Re-observing makes the observer fire again right away if the 
+            // page was too short to push the sentinel out of view
+            observer.unobserve(sentinel);
+            observer.observe(sentinel);
+        }
+    });
+    observer.observe(sentinel);
 }
 
 const reviewList = document.querySelector('.reviews-list');
@@ -0,0 +1,181 @@
+from flask import current_app
+from sqlalchemy import text
+from models import db
+from math import log
+
+### Level stats ###
+
+# Plays, clears, review counts, rating totals and rating histograms are kept
+# in LevelStats so that listings can read them with a single join instead of
+# counting the event tables per level
+
+RATINGS = range(6)
+
+BUMP_LEVEL_STATS = text("""
+    INSERT INTO LevelStats (level_id, plays, clears)
+    VALUES (:level_id, :plays, :clears)
+    ON CONFLICT (level_id) DO UPDATE
+    SET plays = LevelStats.plays + EXCLUDED.plays,
+        clears = LevelStats.clears + EXCLUDED.clears
+""")
+
+def bump_level_stats(level_id: int, plays: int = 0, clears: int = 0):
+    db.session.execute(BUMP_LEVEL_STATS, {
+        "level_id": level_id,
+        "plays": plays,
+        "clears": clears,
+    })
+
+def bump_level_rating(level_id: int, rating: int, count: int):
+    # Adds (or with a negative count, removes) reviews with the given rating
+    # to the level's review count, rating total and rating histogram
+    histogram = ", ".join(f"rating_{r}" for r in RATINGS)
+    db.session.execute(text(f"""
+        INSERT INTO LevelStats (level_id, reviews, rating_total, {histogram})
+        VALUES (:level_id, :count, :rating * :count, {", ".join(f":rating_{r}" for r in RATINGS)})
+        ON CONFLICT (level_id) DO UPDATE
+        SET reviews = LevelStats.reviews + EXCLUDED.reviews,
+            rating_total = LevelStats.rating_total + EXCLUDED.rating_total,
+            {", ".join(f"rating_{r} = LevelStats.rating_{r} + EXCLUDED.rating_{r}" for r in RATINGS)}
+    """), {
+        "level_id": level_id,
+        "rating": rating,
+        "count": count,
+        **{ f"rating_{r}": count if r == rating else 0 for r in RATINGS },
+    })
+
+def bump_many_level_stats(counts: dict[int, tuple[int, int]]):
+    if len(counts) == 0:
+        return
+
+    # Rows are locked in id order so that concurrent batches can't deadlock
+    level_ids = sorted(counts.keys())
+    db.session.execute(text("""
+        INSERT INTO LevelStats (level_id, plays, clears)
+        SELECT Counts.level_id, Counts.plays, Counts.clears
+        FROM unnest(CAST(:level_ids AS INT[]), CAST(:plays AS BIGINT[]), CAST(:clears AS BIGINT[]))
+            AS Counts(level_id, plays, clears)
+        JOIN Levels ON Levels.id = Counts.level_id
+        ORDER BY Counts.level_id
+        ON CONFLICT (level_id) DO UPDATE
+        SET plays = LevelStats.plays + EXCLUDED.plays,
+            clears = LevelStats.clears + EXCLUDED.clears
+    """), {
+        "level_ids": level_ids,
+        "plays": [counts[id][0] for id in level_ids],
+        "clears": [counts[id][1] for id in level_ids],
+    })
+
+### Trending ###
+
+# A level's trending score is its number of plays with each play decaying 
+# exponentially over time, halving every TRENDING_HALF_LIFE hours. Instead of 
+# decaying every score on every refresh, each play is weighted by 
+# exp(decay * seconds since TRENDING_EPOCH), which grows over time at the 
+# same rate for every level and so doesn't change their order. The scores 
+# are stored as the logarithm of the sum of the weights (plus one, so that a 
+# level without plays scores 0) to stay in range, which means that counting 
+# new plays only touches the levels that were played since the last refresh
+
+TRENDING_EPOCH = "2024-01-01"
+# Plays younger than this may have been inserted by transactions that 
+# haven't committed yet, so they're left for the next refresh
+SETTLED_PLAYS_UNTIL = "LOCALTIMESTAMP - INTERVAL '1 minute'"
+# Postgres raises an error instead of returning 0 when exp() underflows
+MIN_EXPONENT = -700
+
+def trending_decay() -> float:
+    return log(2) / (current_app.config.get("TRENDING_HALF_LIFE", 24) * 3600)
+
+def trending_scores(condition: str) -> str:
+    # Log of the sum of the weights of each level's matching plays, with the 
+    # largest weight factored out so that the sum can't overflow
+    return f"""
+        SELECT level_id, peak + ln(SUM(exp(greatest(weight - peak, {MIN_EXPONENT})))) AS score
+        FROM (
+            SELECT level_id, weight, MAX(weight) OVER (PARTITION BY level_id) AS peak
+            FROM (
+                SELECT level_id, CAST(:decay AS DOUBLE PRECISION) *
+                    CAST(EXTRACT(EPOCH FROM created_at - TIMESTAMP '{TRENDING_EPOCH}') AS DOUBLE PRECISION) AS weight
+                FROM LevelPlays
+                WHERE {condition}
+            ) AS Plays
+        ) AS Weighted
+        GROUP BY level_id, peak
+    """
+
+def refresh_level_trending() -> int | None:
+    # Returns the number of levels updated, or None if another worker is 
+    # already refreshing the scores
+    locked = db.session.execute(text("""
+        SELECT 1
+        FROM LevelTrending
+        FOR UPDATE SKIP LOCKED
+    """)).fetchone()
+    if locked == None:
+        db.session.rollback()
+        return None
+
+    count = add_trending_scores(f"""
+        created_at > (SELECT counted_until FROM LevelTrending) AND created_at <= {SETTLED_PLAYS_UNTIL}
+    """)
+    db.session.commit()
+
+    return count
+
+def add_trending_scores(condition: str) -> int:
+    # Adds the matching plays to the scores, which is a log-sum-exp of the 
+    # current score and the plays' score
+    count = db.session.execute(text(f"""
+        UPDATE LevelStats
+        SET trending = greatest(LevelStats.trending, Plays.score) +
+            ln(1 + exp(greatest(-abs(LevelStats.trending - Plays.score), {MIN_EXPONENT})))
+        FROM ({trending_scores(condition)}) AS Plays
+        WHERE LevelStats.level_id = Plays.level_id
+    """), {
+        "decay": trending_decay(),
+    }).rowcount
+    db.session.execute(text(f"""
+        UPDATE LevelTrending SET counted_until = {SETTLED_PLAYS_UNTIL}
+    """))
+    return count
+
+def rebuild_level_stats() -> int:
+    # Block writes to the event tables while recounting so that no increments
+    # made in the meantime get lost
+    db.session.execute(text("LOCK TABLE LevelPlays, LevelClears, Reviews IN SHARE MODE"))
+
+    db.session.execute(text("""
+        DELETE FROM LevelStats
+    """))
+    count = db.session.execute(text(f"""
+        INSERT INTO LevelStats (level_id, plays, clears, reviews, rating_total, {", ".join(f"rating_{r}" for r in RATINGS)})
+        SELECT Levels.id, COALESCE(Plays.count, 0), COALESCE(Clears.count, 0),
+            COALESCE(LevelReviews.count, 0), COALESCE(LevelReviews.rating_total, 0),
+            {", ".join(f"COALESCE(LevelReviews.rating_{r}, 0)" for r in RATINGS)}
+        FROM Levels
+        LEFT JOIN (
+            SELECT level_id, COUNT(*) AS count FROM LevelPlays GROUP BY level_id
+        ) AS Plays ON Plays.level_id = Levels.id
+        LEFT JOIN (
+            SELECT level_id, COUNT(*) AS count FROM LevelClears GROUP BY level_id
+        ) AS Clears ON Clears.level_id = Levels.id
+        LEFT JOIN (
+            SELECT level_id, COUNT(*) AS count, SUM(rating) AS rating_total,
+                {", ".join(f"COUNT(*) FILTER (WHERE rating = {r}) AS rating_{r}" for r in RATINGS)}
+            FROM Reviews
+            GROUP BY level_id
+        ) AS LevelReviews ON LevelReviews.level_id = Levels.id
+    """)).rowcount
+
+    # Trending scores are recounted from every play, which is also needed 
+    # after changing TRENDING_HALF_LIFE
+    db.session.execute(text("""
+        SELECT 1
+        FROM LevelTrending
+        FOR UPDATE
+    """))
+    add_trending_scores(f"created_at <= {SETTLED_PLAYS_UNTIL}")
+    db.session.commit()
+
+    return count
@@ -0,0 +1,80 @@
+from flask import Flask
+from threading import Event, Lock, Thread
+from models import db
+from stats import refresh_level_trending
+import atexit
+import os
+
+### Trending refresher ###
+
+# Counts new plays into the trending scores in LevelStats every
+# TRENDING_REFRESH_INTERVAL seconds from a background thread in each worker
+# process. Refreshes lock the LevelTrending row, so when several workers are
+# running only one of them does the work and the others skip that round.
+# With an interval of 0 no thread is started, and the scores are refreshed
+# with the refresh-trending command instead (for example from cron)
+
+class TrendingRefresher:
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.thread = None
+        self.pid = None
+        self.lock = Lock()
+        self.stopping = Event()
+        self.refreshes = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def init_app(self, app: Flask):
+        self.app = app
+        self.interval = app.config.get("TRENDING_REFRESH_INTERVAL", 60)
+        self.enabled = self.interval > 0
+        if self.enabled:
+            app.before_request(self.ensure_started)
+        app.extensions["trending_refresher"] = self
+        atexit.register(self.stop)
+
+    def ensure_started(self):
+        # Started on the first request so that every forked worker process
+        # gets its own thread
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.stopping.clear()
+                self.thread = Thread(target=self.run, name="trending-refresher", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.refresh()
+
+    def refresh(self):
+        with self.app.app_context():
+            try:
+                if refresh_level_trending() == None:
+                    self.skipped += 1
+                else:
+                    self.refreshes += 1
+            except Exception:
+                db.session.rollback()
+                self.failed += 1
+                self.app.logger.exception("Refreshing trending levels failed")
+
+    def stats(self) -> dict:
+        return {
+            "refreshes": self.refreshes,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
+
+trending_refresher = TrendingRefresher()
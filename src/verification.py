@@ -0,0 +1,62 @@
+from flask import Flask
+from workers import WorkerPool
+
+### Clear verification ###
+
+# Clears and published levels come with the inputs the player used, recorded
+# by the engine as a trace, which is replayed by the level simulation (see
+# simulation.py) to check that it reaches the goal. Replays are CPU-bound,
+# so they're run in a worker pool. The simulation needs NumPy, which is only
+# imported by the processes that run it, so web workers start up without it
+
+TICKS_PER_SECOND = 60
+# Longest trace that will be replayed (30 minutes of playing)
+MAX_TRACE_TICKS = 30 * 60 * TICKS_PER_SECOND
+
+KEY_LEFT = 1
+KEY_RIGHT = 2
+KEY_UP = 4
+
+class InvalidTrace(ValueError):
+    pass
+
+def parse_trace(trace) -> list[tuple[int, int]]:
+    # Traces are run-length encoded as [keys, ticks] pairs, where keys is a
+    # bitmask of KEY_LEFT, KEY_RIGHT and KEY_UP
+    if not isinstance(trace, list):
+        raise InvalidTrace("Trace must be a list")
+    runs = list()
+    total = 0
+    for run in trace:
+        if (
+            not isinstance(run, list) or len(run) != 2 or
+            not all(isinstance(v, int) and not isinstance(v, bool) for v in run)
+        ):
+            raise InvalidTrace("Trace entries must be pairs of integers")
+        keys, ticks = run
+        if not 0 <= keys <= KEY_LEFT | KEY_RIGHT | KEY_UP or ticks < 1:
+            raise InvalidTrace("Invalid trace entry")
+        total += ticks
+        if total > MAX_TRACE_TICKS:
+            raise InvalidTrace("Trace is too long")
+        runs.append((keys, ticks))
+    return runs
+
+def verify_clear(data: dict, trace: list[tuple[int, int]]) -> bool:
+    # Run in the simulation worker pool
+    from simulation import LevelSimulation
+    return LevelSimulation(data).run(trace)
+
+simulation_pool = WorkerPool("simulation")
+
+class ClearVerifier:
+    def init_app(self, app: Flask):
+        simulation_pool.init_app(app, "SIMULATION")
+        app.extensions["clear_verifier"] = self
+
+    def verify(self, data: dict, trace) -> bool:
+        # Raises InvalidTrace for malformed traces, and WorkerPoolFull or
+        # WorkerPoolTimeout if the pool is too busy
+        return simulation_pool.run(verify_clear, data, parse_trace(trace))
+
+clear_verifier = ClearVerifier()
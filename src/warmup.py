@@ -0,0 +1,54 @@
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from metrics import metrics
+from levelnames import level_names
+from verification import simulation_pool
+from time import perf_counter
+import os
+
+### Warm-up ###
+
+# With WARMUP=1, everything that would otherwise be done on the first
+# requests a worker serves is done while the app is created, before the
+# worker accepts any traffic: every template is compiled, each database pool
+# opens DB_POOL_SIZE connections, and the level name word list is loaded
+# (along with NumPy when simulations run on the request thread)
+#
+# How long creating the app took, including imports, is logged and exported
+# on /metrics. Taking longer than STARTUP_BUDGET seconds logs a warning
+
+startup_duration = metrics.gauge("app_startup_seconds", "Time spent creating the app, by phase")
+
+def warm_up(app: Flask, db: SQLAlchemy):
+    # Blueprints may share template folders, so names can be listed twice
+    for name in set(app.jinja_env.list_templates()):
+        app.jinja_env.get_template(name)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+            connections = [engine.connect() for _ in range(size)]
+            for connection in connections:
+                connection.close()
+        # Connections must not be shared with forked processes (for example
+        # when the app is preloaded by gunicorn), so children start with
+        # empty pools
+        engines = list(db.engines.values())
+        os.register_at_fork(after_in_child=lambda: [engine.dispose(close=False) for engine in engines])
+
+    level_names.load_words()
+    if simulation_pool.workers == 0:
+        import simulation
+
+def record_startup(app: Flask, started_at: float, warmed_up_at: float | None = None):
+    total = perf_counter() - started_at
+    startup_duration.set(total, phase="total")
+    if warmed_up_at != None:
+        startup_duration.set(perf_counter() - warmed_up_at, phase="warmup")
+
+    budget = app.config.get("STARTUP_BUDGET", 1.0)
+    message = f"App created in {total * 1000:.0f} ms"
+    if total > budget:
+        app.logger.warning(f"{message}, over the startup budget of {budget * 1000:.0f} ms")
+    else:
+        app.logger.info(message)
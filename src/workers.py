@@ -0,0 +1,121 @@
+from flask import Flask
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import Lock
+from time import time
+import atexit
+import os
+
+### Worker pools ###
+
+# CPU-heavy work (like password hashing) is run in a pool of worker processes
+# so that it doesn't hold up the request threads serving everything else. The
+# number of jobs waiting for the pool is bounded; once it's full, new jobs
+# are rejected right away instead of piling up behind each other
+
+class WorkerPoolFull(Exception):
+    pass
+
+class WorkerPoolTimeout(Exception):
+    pass
+
+def run_timed(fn, submitted_at: float, *args):
+    # Runs in the worker process. Wall clock time is used since it's
+    # comparable between processes
+    started_at = time()
+    result = fn(*args)
+    return result, started_at - submitted_at, time() - started_at
+
+class WorkerPool:
+    def __init__(self, name: str):
+        self.name = name
+        self.executor = None
+        self.pid = None
+        self.lock = Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.max_wait_time = 0.0
+        self.max_run_time = 0.0
+
+    def init_app(self, app: Flask, config_prefix: str):
+        # With 0 workers jobs are run on the request thread, which is handy
+        # for development
+        self.workers = app.config.get(f"{config_prefix}_WORKERS", 2)
+        self.max_pending = app.config.get(f"{config_prefix}_QUEUE", 32)
+        self.timeout = app.config.get(f"{config_prefix}_TIMEOUT", 10.0)
+        app.extensions[f"worker_pool:{self.name}"] = self
+        atexit.register(self.stop)
+
+    def ensure_started(self):
+        # The pool is started lazily so that every forked worker process
+        # gets its own instead of inheriting one it can't use
+        if self.executor is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pending = 0
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def stop(self):
+        if self.executor is None or self.pid != os.getpid():
+            return
+        self.executor.shutdown(cancel_futures=True)
+        self.executor = None
+
+    def run(self, fn, *args):
+        if self.workers == 0:
+            result, wait_time, run_time = run_timed(fn, time(), *args)
+            self.record(wait_time, run_time)
+            return result
+
+        self.ensure_started()
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise WorkerPoolFull()
+            self.pending += 1
+
+        try:
+            future = self.executor.submit(run_timed, fn, time(), *args)
+            future.add_done_callback(self.job_done)
+        except BaseException:
+            with self.lock:
+                self.pending -= 1
+            raise
+
+        try:
+            result, wait_time, run_time = future.result(timeout=self.timeout)
+        except TimeoutError:
+            self.timed_out += 1
+            raise WorkerPoolTimeout()
+        self.record(wait_time, run_time)
+        return result
+
+    def job_done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def record(self, wait_time: float, run_time: float):
+        with self.lock:
+            self.completed += 1
+            self.wait_time += wait_time
+            self.run_time += run_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.max_run_time = max(self.max_run_time, run_time)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_seconds_total": self.wait_time,
+            "run_seconds_total": self.run_time,
+            "wait_seconds_max": self.max_wait_time,
+            "run_seconds_max": self.max_run_time,
+        }